@@ -17,24 +17,47 @@ along with TheReposterminator.  If not, see <https://www.gnu.org/licenses/>.
 """
 from __future__ import annotations
 
+import asyncio
 import logging
+import os
+import socket
+import threading
+import time
 import traceback
-from typing import TYPE_CHECKING, cast
+from typing import TYPE_CHECKING, Any, cast
 
 import praw
 import psycopg2
+import requests
 import toml
 from prawcore import exceptions
 
+from .actions import ActionQueue
+from .budget import BudgetedRequestor, Priority, RequestBudget
+from .db import ConnectionPool, ReadRouter
+from .failures import FailureCache
+from .hosts import HostGuard
+from .index import IndexStore
 from .interactive import Interactive
+from .lag import LagTracker
+from .leases import LeaseManager
 from .messages import MessageHandler
+from .metrics import Metrics
+from .moderators import ModeratorCache
+from .notifications import NotificationListener
+from .profiling import Profiler
+from .retention import RetentionPolicy
+from .runtime import AsyncRuntime
 from .sentry import Sentry
 from .types import BotConfig, SubData, SubredditConfig
+from .whatif import WhatIf
 
 if TYPE_CHECKING:
     from praw.models import Comment
     from praw.models.reddit.mixins import ReplyableMixin
 
+    from .recording import Transport
+
 
 # Set up logging
 logger = logging.getLogger(__name__)
@@ -50,12 +73,14 @@ class BotClient:
 
     # The loaded configuration for the bot instance
     config: BotConfig
-    # The bot's database connection
-    db: psycopg2.connection
-    # A cursor to write to the database with
-    insert_cursor: psycopg2.cursor
-    # The bot's Reddit API connection
-    reddit: praw.Reddit
+    # The bot's pool of database connections
+    pool: ConnectionPool
+    # Routes read-only work to the replica database, if one is configured
+    reads: ReadRouter
+    # Allocates the bot's Reddit ratelimit between its consumers
+    budget: RequestBudget
+    # Counters and histograms describing the bot's work
+    metrics: Metrics
 
     # The class that manages automatic submission scanning and handling
     sentry: Sentry
@@ -63,6 +88,22 @@ class BotClient:
     interactive: Interactive
     # The class that handles incoming mod invitations and commands
     message_handler: MessageHandler
+    # Caches the moderators of subreddits, for authorizing commands
+    moderators: ModeratorCache
+    # The in-process hash indexes used for matching
+    index: IndexStore
+    # The policy that prunes media data which is no longer needed
+    retention: RetentionPolicy
+    # The queue of moderation actions to perform on Reddit
+    actions: ActionQueue
+    # Tracks submissions that failed to be processed
+    failures: FailureCache
+    # Fetches media, isolating the bot from unhealthy media hosts
+    hosts: HostGuard
+    # Distributes subreddits between workers, if multi-worker mode is enabled
+    leases: LeaseManager | None
+    # Applies changes made by other processes, if notifications are enabled
+    notifications: NotificationListener | None
 
     # List of loaded subreddits
     subreddits: list[SubData]
@@ -72,10 +113,30 @@ class BotClient:
     # String representation of fallback subreddit config
     default_sub_config: str
 
-    def __init__(self):
+    def __init__(
+        self,
+        *,
+        worker_id: str | None = None,
+        transport: Transport | None = None,
+    ):
         self.sentry = Sentry(self)
         self.interactive = Interactive(self)
         self.message_handler = MessageHandler(self)
+        self.moderators = ModeratorCache(self)
+        self.index = IndexStore(self)
+        self.retention = RetentionPolicy(self)
+        self.actions = ActionQueue(self)
+        self.failures = FailureCache(self)
+        self.hosts = HostGuard(self)
+        self.budget = RequestBudget(self)
+        self.metrics = Metrics(self)
+        self.lag = LagTracker(self)
+        self.profiler = Profiler(self)
+        self.whatif = WhatIf(self)
+
+        self.transport = transport
+        # Holds the Reddit API connection of each thread
+        self._local = threading.local()
 
         self.subreddits: list[SubData] = []
         self.subreddit_configs: dict[str, SubredditConfig] = {}
@@ -85,6 +146,29 @@ class BotClient:
         self.setup_connections()
         self.update_subs()
 
+        self.leases = None
+        workers_config = self.config.get("workers", {})
+        if worker_id or workers_config.get("enabled"):
+            self.leases = LeaseManager(
+                self,
+                worker_id
+                or workers_config.get("id")
+                or f"{socket.gethostname()}-{os.getpid()}",
+                lease_ttl=workers_config.get("lease_ttl", 60),
+            )
+
+        self.notifications = None
+        notifications_enabled = self.config.get("notifications", {}).get("enabled")
+        if self.leases is not None and not notifications_enabled:
+            # Workers rely on notifications for subreddits and configs that
+            # are changed by the worker handling the inbox
+            logger.warning("⚠️ Multi-worker mode requires notifications, enabling")
+            notifications_enabled = True
+        if notifications_enabled:
+            self.notifications = NotificationListener(self)
+            # Inserts by other processes are delivered as notifications
+            self.index.shared = False
+
     def load_config(self, fp="config.toml") -> BotConfig:
         """
         Loads the bot's config from a TOML file
@@ -102,20 +186,43 @@ class BotClient:
         Establishes a Reddit and database connection
 
         Attempts to connect to first the database, then to Reddit. The database
-        connection will timeout after 5 seconds. Also creates a server-side
-        database cursor for data insertion.
+        connection pool is created with its minimum number of connections, each
+        of which will timeout after 5 seconds. If a `[database.replica]` section
+        is configured, a pool is also created for the replica, which connects
+        lazily. Any connection keys it omits are inherited from the primary.
+
+        Every Reddit request is made through a `BudgetedRequestor`, which
+        spends it from `self.budget`. If the bot was given a `transport`, it
+        is mounted over the HTTP sessions used for Reddit and for media.
 
         If a timeout, or any other error is encountered, the exception will be
         logged, and the program will exit immediately. Otherwise, the
         connections have been successfully established.
         """
         try:
-            self.db: psycopg2.connection = psycopg2.connect(
-                **self.config["database"], connect_timeout=5
+            database = {**self.config["database"]}
+            replica_config = database.pop("replica", None)
+            pool_config = self.config.get("pool", {})
+
+            self.pool = ConnectionPool(database, **pool_config)
+
+            replica = None
+            max_staleness = 5.0
+            if replica_config is not None:
+                replica_config = {**replica_config}
+                max_staleness = replica_config.pop("max_staleness", 5.0)
+                replica = ConnectionPool(
+                    {**database, **replica_config},
+                    **{**pool_config, "min_connections": 0},
+                    name="replica",
+                )
+            self.reads = ReadRouter(
+                self.pool, replica, max_staleness=max_staleness
             )
-            self.insert_cursor = self.db.cursor()
 
-            self.reddit = praw.Reddit(**self.config["reddit"])
+            if self.transport is not None:
+                self.transport.mount(self.hosts.session)
+            self._local.reddit = self.connect_reddit()
 
         except Exception as e:
             logger.critical(f"Connection setup failed; exiting: {e}")
@@ -126,6 +233,37 @@ class BotClient:
                 "✅ Reddit and database connections successfully established"
             )
 
+    @property
+    def reddit(self) -> praw.Reddit:
+        """
+        The Reddit API connection of the calling thread
+
+        praw's clients aren't thread-safe, so each thread that makes Reddit
+        requests is given its own, all of which spend from `self.budget`.
+        """
+        if (reddit := getattr(self._local, "reddit", None)) is None:
+            reddit = self._local.reddit = self.connect_reddit()
+        return reddit
+
+    def connect_reddit(self) -> praw.Reddit:
+        """
+        Creates a Reddit API connection which spends from `self.budget`
+
+        :return: The connection
+        :rtype: ``praw.Reddit``
+        """
+        requestor_kwargs: dict[str, Any] = {"budget": self.budget}
+        if self.transport is not None:
+            session = requests.Session()
+            self.transport.mount(session)
+            requestor_kwargs["session"] = session
+
+        return praw.Reddit(
+            **self.config["reddit"],
+            requestor_class=BudgetedRequestor,
+            requestor_kwargs=requestor_kwargs,
+        )
+
     def run(self):
         """
         Runs the bot in an infinite, blocking loop
@@ -134,26 +272,89 @@ class BotClient:
         After the configs have been downloaded, an infinite loop is started,
         which does the following:
         - Attempts to handle messages
-        - For each subreddit in `self.subreddits`:
+        - For each subreddit in `self.active_subreddits()`:
             - Handles messages
             - If the sub isn't indexed, indexes the subreddit for the first time
             - Performs a standard scan of the subreddit
+        - Rewrites hash index snapshots, if the configured interval has elapsed
+        - Applies the retention policy, if the configured interval has elapsed
+
+        In multi-worker mode, only the subreddits leased to this worker are
+        scanned, and messages are only handled and the retention policy only
+        applied by the worker that holds the inbox lease.
+
+        Queued moderation actions are performed on a background thread, unless
+        `[actions] inline` is disabled, so that scans don't wait on them.
+
+        If notifications are enabled, changes made by other processes are
+        applied before handling messages.
+
+        Snapshots are also rewritten, and leases released, when the loop
+        terminates.
 
         If any of these steps fail and the error is a:
         - Reddit server error: The program terminates
-        - SQL error: The program terminates
+        - SQL error: The exception is logged, and the pass is retried once the
+        connection pool has reconnected
         - Another error: The exception is suppressed and logged
         """
 
         self.get_all_configs()  # This operation is very slow
+        if self.actions.inline:
+            self.actions.start()
+        try:
+            self._run_loop()
+        finally:
+            self.shutdown()
+
+        logger.info("Main loop terminated")
+
+    def run_async(self):
+        """
+        Runs the bot on an asyncio event loop, blocking until it terminates
+
+        Equivalent to `run`, except that the inbox, subreddit scans, and
+        maintenance run concurrently as configured by the `[runtime]` section.
+        See `AsyncRuntime` for details.
+        """
+        self.get_all_configs()  # This operation is very slow
+        runtime_config = self.config.get("runtime", {})
+        try:
+            asyncio.run(AsyncRuntime(self, **runtime_config).run())
+        finally:
+            self.shutdown()
+
+        logger.info("Async runtime terminated")
+
+    def shutdown(self):
+        """Rewrites snapshots and releases resources held by the bot"""
+        self.index.save_all()
+        if self.leases is not None:
+            self.leases.release()
+        if self.notifications is not None:
+            self.notifications.close()
+        self.metrics.close()
+        self.profiler.close()
+
+    def _run_loop(self):
+        """The body of `run`, kept separate so snapshots are saved on exit"""
         while True:
             try:
-                if not self.subreddits:
-                    self.message_handler.handle()  # In case there are no subs
+                if self.leases is not None:
+                    self.leases.refresh_if_due()
+
+                if not (subreddits := self.active_subreddits()):
+                    if not self.owns_inbox():
+                        time.sleep(5)  # Nothing to do until leases change
+                    self.handle_messages()  # In case there are no subs
+
+                for sub in subreddits:
+                    # Passes can outlast a lease, so scans renew as they go
+                    if not self.owns(sub.subname):
+                        continue
 
-                for sub in self.subreddits:
                     # check messages every loop to maximize responsiveness
-                    self.message_handler.handle()
+                    self.handle_messages()
 
                     if not sub.indexed:
                         # Needs to be full-scanned first
@@ -162,6 +363,10 @@ class BotClient:
                         # Scanned with intention of reporting now
                         self.sentry.scan_submissions(sub)
 
+                self.index.save_if_due()
+                if self.owns_inbox():
+                    self.retention.run_if_due()
+
             except exceptions.ServerError as e:
                 logger.critical(
                     f"Encountered server error, terminating loop"
@@ -170,10 +375,8 @@ class BotClient:
                 break
 
             except psycopg2.Error as e:
-                logger.critical(
-                    f"Encountered SQL error, terminating loop [{e}]"
-                )
-                break
+                logger.error(f"Encountered SQL error, retrying pass [{e}]")
+                logger.debug(f"Connection pool stats: {self.pool.stats}")
 
             except Exception as e:
                 exc_info = (type(e), e, e.__traceback__)
@@ -182,7 +385,49 @@ class BotClient:
                 ).rstrip()
                 logger.error(f"Suppressed unhandled exception\n{formatted}")
 
-        logger.info("Main loop terminated")
+    def owns_inbox(self) -> bool:
+        """Whether this process is responsible for the bot's inbox"""
+        return self.leases is None or self.leases.leader
+
+    def owns(self, subname: str) -> bool:
+        """
+        Whether this process is responsible for scanning a subreddit
+
+        Renews leases if they are due, so this may be checked throughout a
+        scan to keep the subreddit leased for as long as the scan runs.
+
+        :param subname: The subreddit to check
+        :type subname: ``str``
+
+        :return: Whether the subreddit should be scanned by this process
+        :rtype: ``bool``
+        """
+        return self.leases is None or self.leases.holds(subname)
+
+    def handle_messages(self):
+        """
+        Handles messages, if this process is responsible for the inbox
+
+        Any pending notifications are applied first, so that messages are
+        handled with up to date state.
+        """
+        if self.notifications is not None:
+            self.notifications.poll()
+        if self.owns_inbox():
+            self.message_handler.handle()
+
+    def active_subreddits(self) -> list[SubData]:
+        """
+        Gets the subreddits that this process is responsible for scanning
+
+        :return: Every subreddit, or the leased subreddits in multi-worker mode
+        :rtype: ``list[SubData]``
+        """
+        if self.leases is None:
+            return self.subreddits
+        return [
+            sub for sub in self.subreddits if sub.subname in self.leases.owned
+        ]
 
     def update_subs(self):
         """
@@ -191,13 +436,12 @@ class BotClient:
         Populates `self.subreddits` with `SubData` objects which are generated
         via selecting data from the database.
         """
-        self.subreddits.clear()
-
-        with self.db.cursor() as cur:
+        with self.pool.connection() as conn, conn.cursor() as cur:
             cur.execute("SELECT * FROM subreddits")
-            for sub, indexed in cur.fetchall():
-                self.subreddits.append(SubData(sub, indexed))
-        self.db.commit()
+            rows = cur.fetchall()
+
+        # Replaced in one step, as other threads may be iterating the list
+        self.subreddits[:] = [SubData(sub, indexed) for sub, indexed in rows]
 
         logger.debug("Updated list of subreddits")
 
@@ -243,9 +487,9 @@ class BotClient:
                 "thereposterminator_config"
             ]
 
-            sub_config = cast(
-                SubredditConfig, toml.loads(config_wiki.content_md)
-            )
+            with self.budget.priority(Priority.CONFIG):
+                content = config_wiki.content_md
+            sub_config = cast(SubredditConfig, toml.loads(content))
             template_config = cast(
                 SubredditConfig, toml.loads(self.default_sub_config)
             )
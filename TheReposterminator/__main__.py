@@ -15,38 +15,33 @@ GNU Affero General Public License for more details.
 You should have received a copy of the GNU Affero General Public License
 along with TheReposterminator.  If not, see <https://www.gnu.org/licenses/>.
 """
+import _thread
 import argparse
+import json
 import logging
 import os
+import sys
+import threading
+import time
+from collections.abc import Callable
+from pathlib import Path
 
-from TheReposterminator import BotClient, formatters
+from TheReposterminator import (
+    BotClient,
+    bench,
+    ingest,
+    loadgen,
+    logs,
+    migrations,
+    recording,
+    transfer,
+)
 
 # LOGGING
 
 if os.name == "nt":
     os.system("color")
 
-LOGGERS = [
-    logging.getLogger("TheReposterminator"),
-    logging.getLogger("prawcore"),
-    logging.getLogger("praw"),
-]
-
-formatter = formatters.ColoredLoggingFormatter(
-    fmt="[{asctime}] [{levelname} {name} {funcName}] {message}"
-)
-handler = logging.StreamHandler()
-handler.setFormatter(formatter)
-
-[
-    (
-        logger.setLevel(logging.INFO),
-        logger.addHandler(handler),
-        logger.addHandler(logging.FileHandler("rterm.log", "w", "utf-8")),
-    )
-    for logger in LOGGERS
-]
-
 # CLI
 
 LOG_LEVEL_MAPPING = {
@@ -69,19 +64,590 @@ parser.add_argument(
     choices=["info", "debug", "warning", "error", "notset", "critical"],
     help="Sets the logging level to use when running the bot",
 )
+parser.add_argument(
+    "-w",
+    "--worker-id",
+    help="Runs the bot as a named worker in multi-worker mode",
+)
+parser.add_argument(
+    "--async",
+    dest="use_async",
+    action="store_true",
+    help="Runs the bot on an asyncio event loop, scanning concurrently",
+)
+parser.add_argument(
+    "--metrics-port",
+    type=int,
+    help="Serves Prometheus metrics on localhost at this port while running",
+)
+parser.add_argument(
+    "--profile",
+    nargs="?",
+    const="all",
+    choices=["cpu", "memory", "all"],
+    help="Profiles the bot from startup (SIGUSR1/SIGUSR2 toggle it later)",
+)
+parser.add_argument(
+    "--drain-actions",
+    action="store_true",
+    help="Performs queued moderation actions until interrupted",
+)
+parser.add_argument(
+    "--prune",
+    action="store_true",
+    help="Applies the configured media data retention policy once",
+)
+parser.add_argument(
+    "--backfill-created-utc",
+    action="store_true",
+    help="Fills in post creation times for media stored by older versions",
+)
+parser.add_argument(
+    "--log-file",
+    default="rterm.log",
+    help="The log file, rotated once it reaches --log-max-bytes",
+)
+parser.add_argument(
+    "--log-format",
+    choices=["json", "text"],
+    default="json",
+    help="Writes the log file as JSON lines or as plain text",
+)
+parser.add_argument(
+    "--log-max-bytes",
+    type=int,
+    default=10 * 1024 * 1024,
+    help="The size at which the log file is rotated",
+)
+parser.add_argument(
+    "--log-backups",
+    type=int,
+    default=5,
+    help="How many rotated log files to keep",
+)
+parser.add_argument(
+    "--debug-sample-limit",
+    type=int,
+    default=100,
+    help="Debug logs per second per module before they're sampled",
+)
+
+commands = parser.add_subparsers(dest="command", metavar="command")
+
+lag_parser = commands.add_parser(
+    "lag", help="Prints detection lag percentiles per subreddit"
+)
+lag_parser.add_argument(
+    "-d",
+    "--days",
+    type=int,
+    help="How many days of submissions to include (defaults to the config)",
+)
+lag_parser.add_argument(
+    "-s", "--subreddit", help="Only includes this subreddit"
+)
+
+
+def resolution(value: str) -> tuple[int, int]:
+    width, _, height = value.lower().partition("x")
+    try:
+        return int(width), int(height)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected WIDTHxHEIGHT, got {value}")
+
+
+bench_parser = commands.add_parser(
+    "bench",
+    help="Benchmarks hashing and matching offline, printing results as JSON",
+)
+bench_parser.add_argument(
+    "-o", "--output", help="Writes the results to this file instead of stdout"
+)
+bench_parser.add_argument(
+    "--baseline", help="Compares the results against those in this file"
+)
+bench_parser.add_argument(
+    "--formats",
+    nargs="+",
+    choices=[*bench.ENCODERS],
+    default=[*bench.ENCODERS],
+    help="The image formats to hash",
+)
+bench_parser.add_argument(
+    "--resolutions",
+    nargs="+",
+    type=resolution,
+    default=[*bench.DEFAULT_RESOLUTIONS],
+    help="The image resolutions to hash, as WIDTHxHEIGHT",
+)
+bench_parser.add_argument(
+    "--rows",
+    nargs="+",
+    type=int,
+    default=[*bench.DEFAULT_ROWS],
+    help="The sizes of the indexes to match against",
+)
+bench_parser.add_argument(
+    "--global-max-rows",
+    type=int,
+    default=1_000_000,
+    help="The largest global index to build",
+)
+bench_parser.add_argument(
+    "--threshold",
+    type=int,
+    default=90,
+    help="The similarity threshold to match with",
+)
+bench_parser.add_argument(
+    "--queries", type=int, default=50, help="The searches to run per index"
+)
+bench_parser.add_argument(
+    "--seed", type=int, default=0, help="The seed of the synthetic data"
+)
+bench_parser.add_argument(
+    "--skip-hashing", action="store_true", help="Only benchmarks matching"
+)
+bench_parser.add_argument(
+    "--skip-matching", action="store_true", help="Only benchmarks hashing"
+)
+bench_parser.add_argument(
+    "--corpus",
+    help="Matches against the hashes of this export instead of random ones",
+)
+bench_parser.add_argument(
+    "--corpus-subreddit", help="Only uses the corpus hashes of this subreddit"
+)
+
+record_parser = commands.add_parser(
+    "record",
+    help="Runs the bot, recording Reddit and media responses to an archive",
+)
+record_parser.add_argument(
+    "-a", "--archive", required=True, help="The directory to record into"
+)
+record_parser.add_argument(
+    "--duration", type=float, help="Stops recording after this many seconds"
+)
+
+replay_parser = commands.add_parser(
+    "replay",
+    help=(
+        "Runs the bot against a recorded archive instead of Reddit and media "
+        "hosts, then prints its throughput (use a scratch database)"
+    ),
+)
+replay_parser.add_argument(
+    "-a", "--archive", required=True, help="The directory to replay from"
+)
+replay_parser.add_argument(
+    "--speed",
+    type=float,
+    default=0,
+    help=(
+        "How many times faster than recorded to replay, "
+        "or 0 to replay as fast as possible (the default)"
+    ),
+)
+replay_parser.add_argument(
+    "--duration",
+    type=float,
+    help="Stops after this many seconds, instead of once the archive is used up",
+)
+
+loadgen_parser = commands.add_parser(
+    "loadgen",
+    help=(
+        "Runs the bot against many simulated subreddits, then prints how it "
+        "kept up as JSON (use a scratch database)"
+    ),
+)
+loadgen_parser.add_argument(
+    "--subreddits", type=int, default=50, help="The number of subreddits"
+)
+loadgen_parser.add_argument(
+    "--rate",
+    type=float,
+    default=2,
+    help="The mean number of posts per minute in each subreddit",
+)
+loadgen_parser.add_argument(
+    "--repost-ratio",
+    type=float,
+    default=0.1,
+    help="The fraction of posts that reuse an earlier post's image",
+)
+loadgen_parser.add_argument(
+    "--sizes",
+    nargs="+",
+    type=loadgen.parse_size,
+    default=[(640, 480, 5), (1280, 720, 3), (1920, 1080, 2)],
+    help="The image sizes to post, as WIDTHxHEIGHT[:WEIGHT]",
+)
+loadgen_parser.add_argument(
+    "--mention-rate",
+    type=float,
+    default=0,
+    help="The mean number of username mentions per minute, across all subs",
+)
+loadgen_parser.add_argument(
+    "--duration", type=float, default=600, help="How long to run for, in seconds"
+)
+loadgen_parser.add_argument(
+    "--interval",
+    type=float,
+    default=10,
+    help="How often to sample progress, in seconds",
+)
+loadgen_parser.add_argument(
+    "--seed", type=int, default=0, help="The seed of the simulation"
+)
+loadgen_parser.add_argument(
+    "-o", "--output", help="Writes the report to this file instead of stdout"
+)
+
+ingest_parser = commands.add_parser(
+    "ingest",
+    help="Backfills stored media data from local dumps of submissions",
+)
+ingest_parser.add_argument(
+    "dumps",
+    nargs="+",
+    type=Path,
+    help="Dumps with a JSON submission per line, optionally gzipped",
+)
+ingest_parser.add_argument(
+    "--images",
+    type=Path,
+    help="A directory of submission images, named by their submission ID",
+)
+ingest_parser.add_argument(
+    "--no-fetch",
+    dest="fetch",
+    action="store_false",
+    help="Only ingests submissions with an image in --images",
+)
+ingest_parser.add_argument(
+    "-s",
+    "--subreddit",
+    action="append",
+    help="Only ingests this subreddit (may be repeated)",
+)
+ingest_parser.add_argument(
+    "--workers",
+    type=int,
+    default=16,
+    help="The number of threads fetching and hashing media",
+)
+ingest_parser.add_argument(
+    "--batch-size",
+    type=int,
+    default=1000,
+    help="The number of submissions loaded into the database at once",
+)
+ingest_parser.add_argument(
+    "--checkpoints",
+    type=Path,
+    default=Path("checkpoints"),
+    help="The directory in which the progress through each dump is kept",
+)
+ingest_parser.add_argument(
+    "--restart",
+    action="store_true",
+    help="Ignores the checkpoints of the dumps, ingesting them from the start",
+)
+
+export_parser = commands.add_parser(
+    "export", help="Writes stored media data to a compact binary export"
+)
+export_parser.add_argument(
+    "output", help="The file to write the export to, or - for stdout"
+)
+export_parser.add_argument(
+    "-s",
+    "--subreddit",
+    action="append",
+    help="Only exports this subreddit (may be repeated)",
+)
+
+import_parser = commands.add_parser(
+    "import",
+    help="Loads an export into the database (the bot should not be running)",
+)
+import_parser.add_argument("input", help="The export to load, or - for stdin")
+import_parser.add_argument(
+    "--keep-indexes",
+    action="store_true",
+    help="Updates media_storage indexes row by row instead of rebuilding them",
+)
+
+whatif_parser = commands.add_parser(
+    "whatif",
+    help="Estimates reports and removals per day under different thresholds",
+)
+whatif_parser.add_argument(
+    "-s",
+    "--subreddit",
+    action="append",
+    help="Only reports on this subreddit (may be repeated)",
+)
+whatif_parser.add_argument(
+    "--analyze",
+    action="store_true",
+    help="Analyzes the stored posts before reporting, which may take a while",
+)
+whatif_parser.add_argument(
+    "--jobs",
+    type=int,
+    help="The number of processes to analyze with, defaults to the config",
+)
+whatif_parser.add_argument(
+    "--sentry", type=int, help="The sentry threshold to estimate"
+)
+whatif_parser.add_argument(
+    "--autoremove", type=int, help="The autoremove threshold to estimate"
+)
 
 # RUNNER
 
 
+def stop_when(condition: Callable[[], bool]):
+    """Interrupts the main thread once a condition is met"""
+
+    def watch():
+        while not condition():
+            time.sleep(0.5)
+        _thread.interrupt_main()
+
+    threading.Thread(target=watch, name="stopper", daemon=True).start()
+
+
+def run_until_stopped(client: BotClient, *, use_async: bool = False) -> float:
+    """Runs the bot until interrupted, returning how long it ran for"""
+    started = time.monotonic()
+    try:
+        if use_async:
+            client.run_async()
+        else:
+            client.run()
+    except KeyboardInterrupt:
+        pass
+    return time.monotonic() - started
+
+
 def main():
     args = parser.parse_args()
 
-    if args.level:
-        [logger.setLevel(LOG_LEVEL_MAPPING[args.level]) for logger in LOGGERS]
+    logs.setup_logging(
+        level=LOG_LEVEL_MAPPING[args.level] if args.level else logging.INFO,
+        file=args.log_file or None,
+        file_format=args.log_format,
+        max_bytes=args.log_max_bytes,
+        backups=args.log_backups,
+        debug_limit=args.debug_sample_limit,
+    )
 
-    if args.run:
+    if args.command == "lag":
         client = BotClient()
-        client.run()
+        days = args.days or client.lag.config.get("window_days", 7)
+        print(client.lag.report(days=days, subname=args.subreddit))
+        return
+
+    if args.command == "bench":
+        corpus = None
+        if args.corpus:
+            with open(args.corpus, "rb") as file:
+                corpus = transfer.read_hashes(
+                    file, subname=args.corpus_subreddit
+                )
+        results = bench.run(
+            formats=args.formats,
+            resolutions=args.resolutions,
+            rows=args.rows,
+            global_max_rows=args.global_max_rows,
+            threshold=args.threshold,
+            queries=args.queries,
+            seed=args.seed,
+            skip_hashing=args.skip_hashing,
+            skip_matching=args.skip_matching,
+            corpus=corpus,
+        )
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as file:
+                json.dump(results, file, indent=2)
+        else:
+            print(json.dumps(results, indent=2))
+
+        if args.baseline:
+            with open(args.baseline, encoding="utf-8") as file:
+                baseline = json.load(file)
+            for line in bench.compare(baseline, results):
+                logging.getLogger("TheReposterminator").info(line)
+        return
+
+    if args.command == "record":
+        recorder = recording.Recorder(args.archive)
+        client = BotClient(transport=recorder)
+        if args.duration:
+            deadline = time.monotonic() + args.duration
+            stop_when(lambda: time.monotonic() >= deadline)
+        try:
+            run_until_stopped(client)
+        finally:
+            recorder.close()
+        return
+
+    if args.command == "replay":
+        replayer = recording.Replayer(args.archive, speed=args.speed)
+        client = BotClient(transport=replayer)
+        if args.duration:
+            deadline = time.monotonic() + args.duration
+            stop_when(lambda: time.monotonic() >= deadline)
+        else:
+            stop_when(lambda: replayer.exhausted)
+        elapsed = run_until_stopped(client)
+        print(recording.summarize(client, elapsed))
+        print(
+            f"Replayed {replayer.hits} responses, "
+            f"{replayer.misses} requests weren't recorded"
+        )
+        return
+
+    if args.command == "loadgen":
+        generator = loadgen.LoadGenerator(
+            subreddits=args.subreddits,
+            rate=args.rate,
+            repost_ratio=args.repost_ratio,
+            sizes=args.sizes,
+            mention_rate=args.mention_rate,
+            seed=args.seed,
+        )
+        client = BotClient(transport=generator)
+        generator.attach(client, interval=args.interval)
+        deadline = time.monotonic() + args.duration
+        stop_when(lambda: time.monotonic() >= deadline)
+        try:
+            run_until_stopped(client, use_async=args.use_async)
+        finally:
+            generator.close()
+
+        report = json.dumps(generator.report(), indent=2)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as file:
+                file.write(report)
+        else:
+            print(report)
+        return
+
+    if args.command == "ingest":
+        client = BotClient()
+        ingester = ingest.Ingester(
+            client,
+            images=args.images,
+            fetch=args.fetch,
+            workers=args.workers,
+            batch_size=args.batch_size,
+            subreddits=args.subreddit,
+            checkpoints=args.checkpoints,
+        )
+        try:
+            for dump in args.dumps:
+                ingester.ingest(dump, restart=args.restart)
+        finally:
+            ingester.save_snapshots()
+        return
+
+    if args.command == "export":
+        client = BotClient()
+        if args.output == "-":
+            rows = transfer.export(
+                client, sys.stdout.buffer, subreddits=args.subreddit
+            )
+        else:
+            with open(args.output, "wb") as file:
+                rows = transfer.export(client, file, subreddits=args.subreddit)
+        logging.getLogger("TheReposterminator").info(
+            f"✅ Exported {rows} rows"
+        )
+        return
+
+    if args.command == "import":
+        client = BotClient()
+        if args.input == "-":
+            counts = transfer.import_(
+                client, sys.stdin.buffer, defer_indexes=not args.keep_indexes
+            )
+        else:
+            with open(args.input, "rb") as file:
+                counts = transfer.import_(
+                    client, file, defer_indexes=not args.keep_indexes
+                )
+        logging.getLogger("TheReposterminator").info(
+            f"✅ Imported {sum(counts.values())} rows of "
+            f"{len(counts)} subreddits"
+        )
+        return
+
+    if args.command == "whatif":
+        client = BotClient()
+        subnames = args.subreddit or [sub.subname for sub in client.subreddits]
+        for subname in subnames:
+            client.get_config(subname)
+        if args.analyze:
+            client.whatif.analyze(
+                subnames, jobs=args.jobs or client.whatif.config.get("jobs", 1)
+            )
+
+        for subname in subnames:
+            if (analysis := client.whatif.load(subname)) is None:
+                print(f"r/{subname} hasn't been analyzed, run with --analyze\n")
+                continue
+            sub_config = client.subreddit_configs[subname]
+            sentry = args.sentry
+            if sentry is None:
+                sentry = sub_config["sentry_threshold"]
+            autoremove = args.autoremove
+            if autoremove is None and sub_config["autoremove"]:
+                autoremove = sub_config["autoremove_threshold"]
+            try:
+                print(
+                    client.whatif.report(
+                        analysis,
+                        sentry_threshold=sentry,
+                        autoremove_threshold=autoremove,
+                    )
+                )
+            except ValueError as e:
+                print(f"r/{subname}: {e}\n")
+        return
+
+    if args.backfill_created_utc:
+        client = BotClient()
+        migrations.backfill_created_utc(client)
+
+    if args.prune:
+        client = BotClient()
+        client.retention.apply()
+
+    if args.drain_actions:
+        client = BotClient()
+        if args.metrics_port:
+            client.metrics.serve(args.metrics_port)
+        client.actions.run()
+
+    if args.run:
+        client = BotClient(worker_id=args.worker_id)
+        if args.metrics_port:
+            client.metrics.serve(args.metrics_port)
+        client.profiler.install_signals()
+        if args.profile in ("cpu", "all"):
+            client.profiler.start()
+        if args.profile in ("memory", "all"):
+            client.profiler.start_memory()
+        if args.use_async:
+            client.run_async()
+        else:
+            client.run()
 
 
 if __name__ == "__main__":
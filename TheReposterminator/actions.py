@@ -0,0 +1,425 @@
+"""
+TheReposterminator Reddit bot to detect reposts
+Copyright (C) 2023 sardonicism-04
+
+TheReposterminator is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TheReposterminator is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with TheReposterminator.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import html
+import logging
+import threading
+import time
+from collections.abc import Iterable
+from typing import TYPE_CHECKING, Any
+
+import psycopg2
+from praw.exceptions import RedditAPIException
+from praw.models.reddit.comment import CommentModeration
+from praw.models.reddit.submission import SubmissionModeration
+from prawcore import exceptions
+from psycopg2.extras import Json
+
+from .budget import Priority
+from .db import PoolExhausted
+from .types import Action
+
+if TYPE_CHECKING:
+    from TheReposterminator import BotClient
+    from TheReposterminator.types import ActionsConfig
+
+
+logger = logging.getLogger(__name__)
+
+# Errors after which retrying an action can't succeed
+PERMANENT_ERRORS = (
+    RedditAPIException,
+    exceptions.Forbidden,
+    exceptions.NotFound,
+    exceptions.BadRequest,
+)
+
+
+class ActionQueue:
+    """
+    A durable queue of moderation actions to perform on Reddit
+
+    Actions are stored in the `moderation_actions` table, so that scanning
+    never waits on Reddit writes, and pending actions survive restarts. Each
+    action has an idempotency key, and enqueuing an action whose key already
+    exists does nothing, so an action is never queued twice.
+
+    Actions are claimed with `FOR UPDATE SKIP LOCKED`, so any number of
+    processes may drain the queue at once. A claimed action is hidden from
+    other processes until its claim expires, after which it is retried in
+    case the process that claimed it died. Failed actions are retried with
+    exponential backoff until `max_attempts` is reached, and errors that
+    can't be resolved by retrying fail the action immediately.
+
+    An action may enqueue follow-up actions once it succeeds, such as the
+    removal of a reply that it made.
+    """
+
+    def __init__(self, bot: BotClient):
+        self.bot = bot
+
+        self.completed = 0
+        self.retried = 0
+        self.failed = 0
+
+    @property
+    def config(self) -> ActionsConfig:
+        return self.bot.config.get("actions", {})
+
+    @property
+    def inline(self) -> bool:
+        """Whether the bot drains the queue itself, rather than another process"""
+        return self.config.get("inline", True)
+
+    @property
+    def stats(self) -> dict[str, int]:
+        """Counters describing the outcomes of drained actions"""
+        return {
+            "completed": self.completed,
+            "retried": self.retried,
+            "failed": self.failed,
+        }
+
+    def enqueue(self, *actions: Action):
+        """
+        Adds actions to the queue, in a single transaction
+
+        Actions whose idempotency key is already queued are ignored.
+
+        :param actions: The actions to add
+        :type actions: ``Action``
+        """
+        with self.bot.pool.connection() as conn, conn.cursor() as cur:
+            self.insert(cur, actions)
+
+    @staticmethod
+    def insert(cur: psycopg2.cursor, actions: Iterable[Action]):
+        cur.executemany(
+            """
+            INSERT INTO moderation_actions
+                (idempotency_key, kind, target, payload)
+            VALUES(%s, %s, %s, %s)
+            ON CONFLICT (idempotency_key) DO NOTHING""",
+            [
+                (action.key, action.kind, action.target, Json(action.payload))
+                for action in actions
+            ],
+        )
+
+    def claim(self) -> list[tuple[int, str, str, dict[str, Any], int]]:
+        """
+        Claims the oldest due actions, hiding them from other processes
+
+        :return: The `(id, kind, target, payload, attempts)` of each action
+        :rtype: ``list[tuple[int, str, str, dict[str, Any], int]]``
+        """
+        with self.bot.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                """
+                UPDATE moderation_actions
+                SET
+                    attempts=attempts+1,
+                    next_attempt_at=NOW() + make_interval(secs => %s)
+                WHERE id IN (
+                    SELECT id FROM moderation_actions
+                    WHERE status='pending' AND next_attempt_at <= NOW()
+                    ORDER BY id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, kind, target, payload, attempts""",
+                (
+                    self.config.get("claim_timeout", 300),
+                    self.config.get("batch_size", 10),
+                ),
+            )
+            return sorted(cur.fetchall())
+
+    def drain(self) -> int:
+        """
+        Performs every due action, until none remain
+
+        :return: The number of actions attempted
+        :rtype: ``int``
+        """
+        attempted = 0
+        while claimed := self.claim():
+            with self.bot.budget.priority(Priority.WRITE):
+                for id, kind, target, payload, attempts in claimed:
+                    self.attempt(id, kind, target, payload, attempts)
+            attempted += len(claimed)
+
+        return attempted
+
+    def run(self):
+        """
+        Drains the queue forever, for use as a dedicated process or thread
+
+        Errors are logged, and the queue is drained again after the poll
+        interval.
+        """
+        logger.info("✅ Draining moderation actions")
+        while True:
+            try:
+                attempted = self.drain()
+            except Exception as e:
+                logger.error(f"Failed to drain moderation actions: {e}")
+                attempted = 0
+            if not attempted:
+                time.sleep(self.config.get("poll_interval", 5))
+
+    def start(self):
+        """Drains the queue forever on a background thread"""
+        threading.Thread(target=self.run, name="actions", daemon=True).start()
+
+    def attempt(
+        self,
+        id: int,
+        kind: str,
+        target: str,
+        payload: dict[str, Any],
+        attempts: int,
+    ):
+        """
+        Performs a claimed action, and records its outcome
+
+        :param id: The ID of the action
+        :type id: ``int``
+
+        :param kind: The kind of action to perform
+        :type kind: ``str``
+
+        :param target: The ID of the submission or comment acted upon
+        :type target: ``str``
+
+        :param payload: The parameters of the action
+        :type payload: ``dict[str, Any]``
+
+        :param attempts: The number of times the action has been attempted
+        :type attempts: ``int``
+        """
+        started = time.perf_counter()
+        try:
+            follow_ups = self.perform(
+                kind, target, payload, retry=attempts > 1
+            )
+
+        except Exception as e:
+            self.bot.metrics.action_seconds.observe(
+                time.perf_counter() - started, kind=kind, outcome="failed"
+            )
+            error = f"{type(e).__name__}: {e}"
+            max_attempts = self.config.get("max_attempts", 5)
+
+            if isinstance(e, PERMANENT_ERRORS) or attempts >= max_attempts:
+                self.failed += 1
+                status, delay = "failed", 0
+                logger.error(
+                    f"❌ Gave up on {kind} of {target} after {attempts} "
+                    f"attempts: {error}"
+                )
+            else:
+                self.retried += 1
+                status = "pending"
+                delay = min(
+                    self.config.get("base_delay", 30) * 2 ** (attempts - 1),
+                    self.config.get("max_delay", 3600),
+                )
+                logger.warning(
+                    f"⚠️ Failed to {kind} {target}, retrying in {delay}s: "
+                    f"{error}"
+                )
+
+            with self.bot.pool.connection() as conn, conn.cursor() as cur:
+                cur.execute(
+                    """
+                    UPDATE moderation_actions
+                    SET
+                        status=%s,
+                        last_error=%s,
+                        next_attempt_at=NOW() + make_interval(secs => %s)
+                    WHERE id=%s""",
+                    (status, error, delay, id),
+                )
+            return
+
+        self.bot.metrics.action_seconds.observe(
+            time.perf_counter() - started, kind=kind, outcome="done"
+        )
+
+        # Follow-ups are queued in the same transaction that completes the
+        # action, so they are never lost or queued for an incomplete action
+        with self.bot.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                """
+                UPDATE moderation_actions
+                SET status='done', last_error=NULL
+                WHERE id=%s""",
+                (id,),
+            )
+            self.insert(cur, follow_ups)
+
+        self.completed += 1
+        logger.debug("Performed %s of %s", kind, target)
+
+        if kind == "report":
+            # Recorded once the report is done, so that failing to record it
+            # can't cause the submission to be reported again
+            try:
+                self.bot.lag.record_report(target)
+            except (psycopg2.Error, PoolExhausted) as e:
+                logger.warning(f"⚠️ Failed to record report of {target}: {e}")
+
+    def perform(
+        self, kind: str, target: str, payload: dict[str, Any], *, retry: bool
+    ) -> list[Action]:
+        """
+        Performs an action on Reddit
+
+        Supported kinds of action are:
+        - `report`: Reports a submission with `payload["reason"]`
+        - `reply`: Replies to a submission with `payload["body"]`, then
+        follows up by removing the reply if `payload["remove"]` is set, or
+        distinguishing and stickying it if `payload["sticky"]` is set
+        - `remove`: Removes a submission with `payload["mod_note"]`
+        - `remove_comment`: Removes a comment
+        - `sticky_comment`: Distinguishes and stickies a comment
+
+        :param kind: The kind of action to perform
+        :type kind: ``str``
+
+        :param target: The ID of the submission or comment to act upon
+        :type target: ``str``
+
+        :param payload: The parameters of the action
+        :type payload: ``dict[str, Any]``
+
+        :param retry: Whether the action has been attempted before
+        :type retry: ``bool``
+
+        :return: Any follow-up actions to enqueue
+        :rtype: ``list[Action]``
+        """
+        match kind:
+            case "report":
+                self.bot.reddit.submission(target).report(payload["reason"])
+
+            case "reply":
+                submission = self.bot.reddit.submission(target)
+                # A previous attempt may have replied before it failed
+                if (
+                    not retry
+                    or (reply := self.find_reply(target, payload["body"]))
+                    is None
+                ):
+                    reply = self.bot.reply(payload["body"], target=submission)
+                if reply is None:
+                    return []
+
+                if payload.get("remove"):
+                    return [
+                        Action(
+                            f"remove_comment:{reply.id}",
+                            "remove_comment",
+                            reply.id,
+                            {},
+                        )
+                    ]
+                if payload.get("sticky"):
+                    return [
+                        Action(
+                            f"sticky_comment:{reply.id}",
+                            "sticky_comment",
+                            reply.id,
+                            {},
+                        )
+                    ]
+
+            case "remove":
+                submission = self.bot.reddit.submission(target)
+                SubmissionModeration(submission).remove(
+                    mod_note=payload.get("mod_note"), spam=False
+                )
+                logger.info(
+                    f"✅ Successfully auto-removed https://redd.it/{target}"
+                )
+
+            case "remove_comment":
+                CommentModeration(self.bot.reddit.comment(target)).remove(
+                    spam=False
+                )
+
+            case "sticky_comment":
+                CommentModeration(self.bot.reddit.comment(target)).distinguish(
+                    how="yes", sticky=True
+                )
+
+            case _:
+                raise ValueError(f"Unknown action kind {kind!r}")
+
+        return []
+
+    def find_reply(self, submission_id: str, body: str):
+        """
+        Finds the bot's top-level reply to a submission with a given body
+
+        The bot may have made other replies to the same submission, such as a
+        report table before an autoremoval message, so replies are matched on
+        their body as well as their author.
+
+        :param submission_id: The ID of the submission
+        :type submission_id: ``str``
+
+        :param body: The body the reply was made with, without the bot notice
+        :type body: ``str``
+
+        :return: The reply if found, `None` if not found
+        :rtype: ``Comment | None``
+        """
+        username = self.bot.config["reddit"]["username"].lower()
+        expected = (body + self.bot.config["templates"]["bot_notice"]).strip()
+        submission = self.bot.reddit.submission(submission_id)
+        submission.comments.replace_more(limit=0)
+        for comment in submission.comments:
+            if (
+                getattr(comment.author, "name", "").lower() == username
+                # Reddit escapes HTML entities in comment bodies
+                and html.unescape(comment.body).strip() == expected
+            ):
+                return comment
+        return None
+
+    def prune(self, days: int):
+        """
+        Deletes finished actions older than a number of days
+
+        :param days: The number of days to keep finished actions
+        :type days: ``int``
+        """
+        with self.bot.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                """
+                DELETE FROM moderation_actions
+                WHERE
+                    status<>'pending' AND
+                    created_at < NOW() - make_interval(days => %s)""",
+                (days,),
+            )
+            if cur.rowcount:
+                logger.info(f"✅ Pruned {cur.rowcount} finished actions")
@@ -0,0 +1,621 @@
+"""
+TheReposterminator Reddit bot to detect reposts
+Copyright (C) 2023 sardonicism-04
+
+TheReposterminator is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TheReposterminator is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with TheReposterminator.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import logging
+import os
+import platform
+import random
+import struct
+import sys
+import tempfile
+import time
+import zlib
+from array import array
+from collections.abc import Callable, Iterable, Iterator
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any
+
+from image_hash import generate_hash
+
+from .common import max_distance
+from .index import (
+    ID_WIDTH,
+    SNAPSHOT_HEADER,
+    SNAPSHOT_MAGIC,
+    SNAPSHOT_VERSION,
+    GlobalIndex,
+    SubredditIndex,
+)
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+
+logger = logging.getLogger(__name__)
+
+# Bumped whenever the meaning of a result field changes, so that results
+# from incompatible versions aren't compared
+RESULTS_VERSION = 1
+
+DEFAULT_RESOLUTIONS = ((320, 240), (1280, 720), (1920, 1080), (3840, 2160))
+DEFAULT_ROWS = (10_000, 100_000, 1_000_000, 10_000_000)
+
+# Result fields compared between runs, and whether higher values are better
+COMPARED_FIELDS = {"per_second": True, "p50_ms": False, "p95_ms": False}
+
+
+# Synthetic images
+
+
+def image_rows(width: int, height: int, seed: int) -> Iterator[bytes]:
+    """
+    Yields the RGB rows of a synthetic image
+
+    Each row is a gradient with a band of noise, shifted by its row number,
+    so that the image compresses somewhere between a photo and a flat fill.
+
+    :param width: The width of the image
+    :type width: ``int``
+
+    :param height: The height of the image
+    :type height: ``int``
+
+    :param seed: The seed of the noise
+    :type seed: ``int``
+
+    :return: An iterator of rows of `width * 3` bytes
+    :rtype: ``Iterator[bytes]``
+    """
+    rng = random.Random(seed)
+    noise = width * 3 // 4
+    smooth = width * 3 - noise
+    base = bytes(i * 256 // smooth for i in range(smooth)) + rng.randbytes(noise)
+    shifts = [
+        bytes((i + shift) & 0xFF for i in range(256)) for shift in range(256)
+    ]
+
+    for y in range(height):
+        yield base.translate(shifts[y & 0xFF])
+
+
+def encode_png(width: int, height: int, seed: int) -> bytes:
+    """Encodes a synthetic image as an 8-bit RGB PNG"""
+    return png(width, height, image_rows(width, height, seed))
+
+
+def png(width: int, height: int, rows: Iterable[bytes]) -> bytes:
+    """
+    Encodes RGB rows as an 8-bit RGB PNG
+
+    :param width: The width of the image
+    :type width: ``int``
+
+    :param height: The height of the image
+    :type height: ``int``
+
+    :param rows: The rows of the image, of `width * 3` bytes each
+    :type rows: ``Iterable[bytes]``
+
+    :return: The encoded image
+    :rtype: ``bytes``
+    """
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return (
+            struct.pack(">I", len(data))
+            + kind
+            + data
+            + struct.pack(">I", zlib.crc32(kind + data))
+        )
+
+    # Every row is prefixed with filter type 0 (none)
+    raw = b"".join(b"\x00" + row for row in rows)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(raw, 6))
+        + chunk(b"IEND", b"")
+    )
+
+
+def encode_bmp(width: int, height: int, seed: int) -> bytes:
+    """Encodes a synthetic image as a 24-bit BMP"""
+    padding = b"\x00" * (-width * 3 % 4)
+    # BMP rows are stored bottom-up, in BGR order
+    rows = [row[::-1] + padding for row in image_rows(width, height, seed)]
+    pixels = b"".join(reversed(rows))
+
+    offset = 14 + 40  # The file header, then the info header
+    return (
+        struct.pack("<2sIHHI", b"BM", offset + len(pixels), 0, 0, offset)
+        + struct.pack(
+            "<IiiHHIIiiII",
+            40,  # Size of the info header
+            width,
+            height,
+            1,  # Planes
+            24,  # Bits per pixel
+            0,  # No compression
+            len(pixels),
+            2835,  # 72 DPI, in pixels per metre
+            2835,
+            0,  # No palette
+            0,
+        )
+        + pixels
+    )
+
+
+def encode_ppm(width: int, height: int, seed: int) -> bytes:
+    """Encodes a synthetic image as a binary PPM"""
+    return f"P6 {width} {height} 255\n".encode() + b"".join(
+        image_rows(width, height, seed)
+    )
+
+
+ENCODERS: dict[str, Callable[[int, int, int], bytes]] = {
+    "png": encode_png,
+    "bmp": encode_bmp,
+    "ppm": encode_ppm,
+}
+
+
+# Resource usage
+
+
+def max_rss_kib() -> int | None:
+    """The peak resident set size of the process, in KiB, if known"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS, and in KiB elsewhere
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def cpu_seconds() -> float:
+    return time.process_time()
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+# Benchmarks
+
+
+def bench_hashing(
+    *,
+    formats: list[str],
+    resolutions: list[tuple[int, int]],
+    min_time: float,
+    seed: int,
+) -> list[dict[str, Any]]:
+    """
+    Measures the throughput of `generate_hash` on synthetic images
+
+    Cases run from the smallest image to the largest, so that the growth of
+    the peak RSS between cases reflects the memory used by each one.
+
+    :param formats: The image formats to encode, from `ENCODERS`
+    :type formats: ``list[str]``
+
+    :param resolutions: The `(width, height)` of the images to encode
+    :type resolutions: ``list[tuple[int, int]]``
+
+    :param min_time: The minimum number of seconds to hash each image for
+    :type min_time: ``float``
+
+    :param seed: The seed of the synthetic images
+    :type seed: ``int``
+
+    :return: A result for each format and resolution
+    :rtype: ``list[dict[str, Any]]``
+    """
+    results: list[dict[str, Any]] = []
+    for width, height in sorted(resolutions, key=lambda size: size[0] * size[1]):
+        for image_format in formats:
+            image = ENCODERS[image_format](width, height, seed)
+            if generate_hash(image) == 0:
+                logger.warning(
+                    f"⚠️ Failed to decode {image_format} at {width}x{height}"
+                )
+                continue
+
+            rss_before = max_rss_kib()
+            cpu_before = cpu_seconds()
+            started = time.perf_counter()
+            iterations = 0
+            while (elapsed := time.perf_counter() - started) < min_time or (
+                iterations < 3
+            ):
+                generate_hash(image)
+                iterations += 1
+            rss_after = max_rss_kib()
+
+            result = {
+                "name": f"hash/{image_format}/{width}x{height}",
+                "format": image_format,
+                "width": width,
+                "height": height,
+                "bytes": len(image),
+                "iterations": iterations,
+                "seconds": elapsed,
+                "per_second": iterations / elapsed,
+                "mb_per_second": len(image) * iterations / elapsed / 1e6,
+                "cpu_seconds": cpu_seconds() - cpu_before,
+                "max_rss_kib": rss_after,
+                "rss_growth_kib": (
+                    None
+                    if rss_before is None or rss_after is None
+                    else rss_after - rss_before
+                ),
+            }
+            logger.info(
+                f"{result['name']}: {result['per_second']:.1f} hashes/s "
+                f"({result['mb_per_second']:.1f} MB/s)"
+            )
+            results.append(result)
+    return results
+
+
+def build_subreddit_index(
+    rows: int,
+    directory: Path,
+    rng: random.Random,
+    *,
+    corpus: array | None = None,
+) -> tuple[SubredditIndex, array]:
+    """
+    Builds a snapshot-backed subreddit index of random rows
+
+    The snapshot is written directly rather than through `add`, so that large
+    indexes are built quickly, and is then mapped as it would be in the bot.
+    If a `corpus` is given, its first hashes are used instead of random ones.
+
+    :param rows: The number of rows in the index
+    :type rows: ``int``
+
+    :param directory: Where to write the snapshot
+    :type directory: ``Path``
+
+    :param rng: The source of random hashes
+    :type rng: ``random.Random``
+
+    :param corpus: Real hashes to use, at least `rows` of them
+    :type corpus: ``array | None``
+
+    :return: The index, and its column of hashes
+    :rtype: ``tuple[SubredditIndex, array]``
+    """
+    if corpus is not None:
+        hashes = corpus[:rows]
+    else:
+        hashes = array("Q", rng.randbytes(rows * 8))
+    now = int(time.time())
+    created = array("q", range(now - rows, now))
+
+    path = directory / f"bench-{rows}.snap"
+    with open(path, "wb") as file:
+        file.write(
+            SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, rows, rows, 0)
+        )
+        file.write(hashes)
+        file.write(created)
+        for start in range(0, rows, 100_000):
+            file.write(
+                b"".join(
+                    f"{position:x}".encode().ljust(ID_WIDTH, b"\x00")
+                    for position in range(start, min(start + 100_000, rows))
+                )
+            )
+
+    index = SubredditIndex("bench")
+    if not index.load_snapshot(path):
+        raise RuntimeError(f"Failed to load benchmark snapshot {path}")
+    return index, hashes
+
+
+def build_global_index(hashes: array) -> GlobalIndex:
+    index = GlobalIndex()
+    index.subnames.add("bench")
+    for position, image_hash in enumerate(hashes):
+        index.add(image_hash, f"{position:x}", "bench", 0, position + 1)
+    return index
+
+
+def bench_index(
+    name: str,
+    index: SubredditIndex | GlobalIndex,
+    hashes: array,
+    *,
+    distance: int,
+    queries: int,
+    max_seconds: float,
+    rng: random.Random,
+) -> dict[str, Any]:
+    """
+    Measures the latency of searching an index
+
+    Half of the queries are near-duplicates of a row in the index, with up to
+    `distance` bits flipped, and the other half are random hashes.
+
+    :param name: The name of the result
+    :type name: ``str``
+
+    :param index: The index to search
+    :type index: ``SubredditIndex | GlobalIndex``
+
+    :param hashes: The hashes of the rows in the index
+    :type hashes: ``array``
+
+    :param distance: The maximum Hamming distance to search for
+    :type distance: ``int``
+
+    :param queries: The number of queries to run
+    :type queries: ``int``
+
+    :param max_seconds: Stops after this long, once at least 5 queries ran
+    :type max_seconds: ``float``
+
+    :param rng: The source of random queries
+    :type rng: ``random.Random``
+
+    :return: The result
+    :rtype: ``dict[str, Any]``
+    """
+    latencies: list[float] = []
+    scanned = matches = 0
+    started = time.perf_counter()
+
+    for query in range(queries):
+        if query % 2:
+            image_hash = rng.getrandbits(64)
+        else:
+            image_hash = hashes[rng.randrange(len(hashes))]
+            for bit in rng.sample(range(64), rng.randint(1, max(distance, 1))):
+                image_hash ^= 1 << bit
+
+        query_started = time.perf_counter()
+        matches += sum(1 for _ in index.search(image_hash, distance, exclude=""))
+        latencies.append(time.perf_counter() - query_started)
+        scanned += index.scanned
+
+        if query >= 4 and time.perf_counter() - started > max_seconds:
+            break
+
+    elapsed = sum(latencies)
+    result = {
+        "name": name,
+        "rows": len(hashes),
+        "distance": distance,
+        "queries": len(latencies),
+        "per_second": len(latencies) / elapsed,
+        "mean_ms": elapsed / len(latencies) * 1000,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "max_ms": max(latencies) * 1000,
+        "rows_scanned_mean": scanned / len(latencies),
+        "matches_mean": matches / len(latencies),
+        "max_rss_kib": max_rss_kib(),
+    }
+    logger.info(
+        f"{name}: p50 {result['p50_ms']:.2f}ms, p95 {result['p95_ms']:.2f}ms "
+        f"({result['rows_scanned_mean']:.0f} rows scanned)"
+    )
+    return result
+
+
+def bench_matching(
+    *,
+    rows: list[int],
+    global_max_rows: int,
+    threshold: int,
+    queries: int,
+    max_seconds: float,
+    seed: int,
+    corpus: array | None = None,
+) -> list[dict[str, Any]]:
+    """
+    Measures match latency against synthetic indexes of increasing size
+
+    Subreddit indexes are searched linearly from a mapped snapshot, as in the
+    bot. The global index is only built up to `global_max_rows`, since every
+    row is added to it individually. Sizes larger than the `corpus`, if one
+    is given, are skipped.
+
+    :param rows: The sizes of the indexes to search
+    :type rows: ``list[int]``
+
+    :param global_max_rows: The largest global index to build
+    :type global_max_rows: ``int``
+
+    :param threshold: The similarity threshold to search with
+    :type threshold: ``int``
+
+    :param queries: The number of queries to run against each index
+    :type queries: ``int``
+
+    :param max_seconds: The time to spend querying each index, at most
+    :type max_seconds: ``float``
+
+    :param seed: The seed of the synthetic hashes and queries
+    :type seed: ``int``
+
+    :param corpus: Real hashes, read from an export, to build indexes from
+        instead of random hashes
+    :type corpus: ``array | None``
+
+    :return: A result for each kind and size of index
+    :rtype: ``list[dict[str, Any]]``
+    """
+    distance = max_distance(threshold)
+    results: list[dict[str, Any]] = []
+
+    with tempfile.TemporaryDirectory(prefix="rterm-bench-") as directory:
+        for count in sorted(rows):
+            if corpus is not None and count > len(corpus):
+                logger.warning(
+                    f"⚠️ Skipping indexes of {count} rows, as the corpus "
+                    f"only has {len(corpus)}"
+                )
+                continue
+
+            rng = random.Random(seed)
+            started = time.perf_counter()
+            index, hashes = build_subreddit_index(
+                count, Path(directory), rng, corpus=corpus
+            )
+            build_seconds = time.perf_counter() - started
+
+            result = bench_index(
+                f"match/subreddit/{count}",
+                index,
+                hashes,
+                distance=distance,
+                queries=queries,
+                max_seconds=max_seconds,
+                rng=rng,
+            )
+            results.append(result | {"build_seconds": build_seconds})
+            index.close()
+
+            if count > global_max_rows:
+                continue
+
+            started = time.perf_counter()
+            global_index = build_global_index(hashes)
+            build_seconds = time.perf_counter() - started
+
+            result = bench_index(
+                f"match/global/{count}",
+                global_index,
+                hashes,
+                distance=distance,
+                queries=queries,
+                max_seconds=max_seconds,
+                rng=rng,
+            )
+            results.append(result | {"build_seconds": build_seconds})
+            del global_index
+
+    return results
+
+
+def run(
+    *,
+    formats: list[str],
+    resolutions: list[tuple[int, int]],
+    rows: list[int],
+    global_max_rows: int = 1_000_000,
+    threshold: int = 90,
+    queries: int = 50,
+    min_time: float = 1.0,
+    max_seconds: float = 30.0,
+    seed: int = 0,
+    skip_hashing: bool = False,
+    skip_matching: bool = False,
+    corpus: array | None = None,
+) -> dict[str, Any]:
+    """
+    Runs the benchmark suite, without any network or database access
+
+    The arguments are passed on to `bench_hashing` and `bench_matching`,
+    either of which can be skipped. Matching results against a `corpus`
+    should only be compared with results against the same corpus.
+
+    :return: The results, with details of the environment they came from
+    :rtype: ``dict[str, Any]``
+    """
+    results: dict[str, Any] = {
+        "version": RESULTS_VERSION,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "seed": seed,
+        "corpus_rows": None if corpus is None else len(corpus),
+        "hashing": [],
+        "matching": [],
+    }
+    if not skip_hashing:
+        results["hashing"] = bench_hashing(
+            formats=formats,
+            resolutions=resolutions,
+            min_time=min_time,
+            seed=seed,
+        )
+    if not skip_matching:
+        results["matching"] = bench_matching(
+            rows=rows,
+            global_max_rows=global_max_rows,
+            threshold=threshold,
+            queries=queries,
+            max_seconds=max_seconds,
+            seed=seed,
+            corpus=corpus,
+        )
+    return results
+
+
+def compare(baseline: dict[str, Any], results: dict[str, Any]) -> list[str]:
+    """
+    Describes how results changed from a baseline run
+
+    :param baseline: The results of the earlier run
+    :type baseline: ``dict[str, Any]``
+
+    :param results: The results of the later run
+    :type results: ``dict[str, Any]``
+
+    :return: A line per result and field present in both runs
+    :rtype: ``list[str]``
+    """
+    if baseline.get("version") != results["version"]:
+        return [
+            f"Baseline results are version {baseline.get('version')}, "
+            f"expected {results['version']}"
+        ]
+
+    previous = {
+        result["name"]: result
+        for result in baseline["hashing"] + baseline["matching"]
+    }
+    lines: list[str] = []
+    for result in results["hashing"] + results["matching"]:
+        if (old := previous.get(result["name"])) is None:
+            continue
+        for field, higher_is_better in COMPARED_FIELDS.items():
+            if field not in result or not old.get(field):
+                continue
+            change = (result[field] - old[field]) / old[field] * 100
+            if change == 0:
+                verdict = "unchanged"
+            elif (change > 0) == higher_is_better:
+                verdict = "better"
+            else:
+                verdict = "worse"
+            lines.append(
+                f"{result['name']} {field}: {old[field]:.2f} -> "
+                f"{result[field]:.2f} ({change:+.1f}%, {verdict})"
+            )
+    return lines
@@ -0,0 +1,288 @@
+"""
+TheReposterminator Reddit bot to detect reposts
+Copyright (C) 2023 sardonicism-04
+
+TheReposterminator is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TheReposterminator is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with TheReposterminator.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import logging
+import re
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from enum import IntEnum
+from typing import TYPE_CHECKING, Any
+from urllib.parse import urlsplit
+
+from prawcore import Requestor
+
+if TYPE_CHECKING:
+    from requests import Response
+
+    from TheReposterminator import BotClient
+    from TheReposterminator.types import BudgetConfig
+
+
+logger = logging.getLogger(__name__)
+
+# Collapses the variable parts of API paths, so requests are grouped by what
+# they do rather than what they do it to
+ENDPOINT_PATTERNS = (
+    (re.compile(r"^/(r|user|u)/[^/]+"), r"/\1/{name}"),
+    (re.compile(r"/comments/[^/]+(/[^/]+)?"), "/comments/{id}"),
+    (re.compile(r"/wiki/.+"), "/wiki/{page}"),
+    (re.compile(r"/+$"), ""),
+)
+
+
+class Priority(IntEnum):
+    """The consumers of Reddit requests, from most to least important"""
+
+    WRITE = 0
+    MENTION = 1
+    INBOX = 2
+    SCAN = 3
+    CONFIG = 4
+    BACKFILL = 5
+
+
+# The fraction of each ratelimit window that lower priorities can't spend,
+# and which is therefore reserved for requests of the given priority or higher
+DEFAULT_RESERVES = {
+    Priority.WRITE: 0.0,
+    Priority.MENTION: 0.0,
+    Priority.INBOX: 0.05,
+    Priority.SCAN: 0.1,
+    Priority.CONFIG: 0.15,
+    Priority.BACKFILL: 0.3,
+}
+
+
+def endpoint(method: str, url: str) -> str:
+    """
+    Names the endpoint of a request
+
+    :param method: The HTTP method of the request
+    :type method: ``str``
+
+    :param url: The URL of the request
+    :type url: ``str``
+
+    :return: The method and normalized path, i.e. `GET /r/{name}/new`
+    :rtype: ``str``
+    """
+    path = urlsplit(url).path
+    for pattern, replacement in ENDPOINT_PATTERNS:
+        path = pattern.sub(replacement, path)
+    return f"{method.upper()} {path or '/'}"
+
+
+class EndpointStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def as_dict(self) -> dict[str, int | float]:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "latency_avg": self.latency_total / max(self.calls, 1),
+            "latency_max": self.latency_max,
+        }
+
+
+class RequestBudget:
+    """
+    Allocates the bot's Reddit ratelimit between its consumers by priority
+
+    The ratelimit state is read from the `X-Ratelimit-*` headers of every
+    response. Each priority may only spend requests while more than its
+    reserved fraction of the window remains, so as the window is used up,
+    backfilling stops first and writes and mentions stop last. A consumer
+    that has run out waits for the window to reset.
+
+    Consumers declare their priority with the `priority` context manager,
+    which applies to every request made on the current thread within it.
+    Requests made outside of one are treated as scans.
+
+    Call counts, errors and latency are also recorded per endpoint.
+    """
+
+    def __init__(self, bot: BotClient):
+        self.bot = bot
+
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+        self.remaining: float | None = None
+        self.used = 0
+        self.reset_at = 0.0
+
+        self.endpoints: dict[str, EndpointStats] = {}
+        self.throttled = dict.fromkeys(Priority, 0)
+
+    @property
+    def config(self) -> BudgetConfig:
+        return self.bot.config.get("budget", {})
+
+    @property
+    def stats(self) -> dict[str, Any]:
+        """The ratelimit state, and counters describing spent requests"""
+        with self.lock:
+            return {
+                "remaining": self.remaining,
+                "used": self.used,
+                "reset_in": max(self.reset_at - time.monotonic(), 0),
+                "throttled": {
+                    priority.name.lower(): count
+                    for priority, count in self.throttled.items()
+                },
+                "endpoints": {
+                    name: stats.as_dict()
+                    for name, stats in self.endpoints.items()
+                },
+            }
+
+    @property
+    def current(self) -> Priority:
+        """The priority of requests made on the current thread"""
+        return getattr(self.local, "priority", Priority.SCAN)
+
+    @contextmanager
+    def priority(self, priority: Priority) -> Iterator[None]:
+        """
+        Sets the priority of requests made on the current thread
+
+        :param priority: The priority to use within the block
+        :type priority: ``Priority``
+
+        :return: A context manager which restores the previous priority
+        :rtype: ``Iterator[None]``
+        """
+        previous = self.current
+        self.local.priority = priority
+        try:
+            yield
+        finally:
+            self.local.priority = previous
+
+    def reserve(self, priority: Priority) -> float:
+        reserves = self.config.get("reserves", {})
+        return reserves.get(priority.name.lower(), DEFAULT_RESERVES[priority])
+
+    def acquire(self):
+        """Waits until the current thread's priority may spend a request"""
+        priority = self.current
+        reserve = self.reserve(priority)
+        throttled = False
+
+        while True:
+            with self.lock:
+                if self.remaining is None:
+                    break
+                window = self.remaining + self.used
+                wait = self.reset_at - time.monotonic()
+                if self.remaining > window * reserve or wait <= 0:
+                    break
+                if not throttled:
+                    self.throttled[priority] += 1
+
+            if not throttled:
+                logger.debug(
+                    "Throttling %s requests for %.0fs (%.0f requests remaining)",
+                    priority.name.lower(),
+                    wait,
+                    self.remaining,
+                )
+                throttled = True
+            time.sleep(min(wait, 5))
+
+    def record(
+        self, method: str, url: str, latency: float, response: Response | None
+    ):
+        """
+        Records a completed request, and updates the ratelimit state from it
+
+        :param method: The HTTP method of the request
+        :type method: ``str``
+
+        :param url: The URL of the request
+        :type url: ``str``
+
+        :param latency: How long the request took, in seconds
+        :type latency: ``float``
+
+        :param response: The response, or `None` if the request failed
+        :type response: ``Response | None``
+        """
+        name = endpoint(method, url)
+        with self.lock:
+            stats = self.endpoints.setdefault(name, EndpointStats())
+            stats.calls += 1
+            stats.latency_total += latency
+            stats.latency_max = max(stats.latency_max, latency)
+            if response is None or response.status_code >= 400:
+                stats.errors += 1
+            if response is None:
+                return
+
+            headers = response.headers
+            try:
+                remaining = float(headers["x-ratelimit-remaining"])
+                used = int(headers["x-ratelimit-used"])
+                reset = float(headers["x-ratelimit-reset"])
+            except (KeyError, ValueError):
+                return
+
+            self.remaining = remaining
+            self.used = used
+            self.reset_at = time.monotonic() + reset
+
+        if response.status_code == 429:
+            logger.warning(
+                f"⚠️ Ratelimited by Reddit on {name}, "
+                f"resets in {reset:.0f}s"
+            )
+
+
+class BudgetedRequestor(Requestor):
+    """
+    A prawcore `Requestor` that spends requests through a `RequestBudget`
+
+    Passed to `praw.Reddit` as its `requestor_class`, with the budget in its
+    `requestor_kwargs`.
+    """
+
+    def __init__(self, *args: Any, budget: RequestBudget, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.budget = budget
+
+    def request(
+        self, method: str, url: str, *args: Any, **kwargs: Any
+    ) -> Response:
+        self.budget.acquire()
+
+        started = time.perf_counter()
+        response = None
+        try:
+            response = super().request(method, url, *args, **kwargs)
+            return response
+        finally:
+            self.budget.record(
+                method, url, time.perf_counter() - started, response
+            )
@@ -31,6 +31,44 @@ if TYPE_CHECKING:
     from TheReposterminator import BotClient
 
 
+def max_distance(threshold: int) -> int:
+    """
+    Returns the largest Hamming distance that still meets a similarity threshold
+
+    Mirrors the truncating percentage calculation of `compare_hashes`, so that
+    a row is within the returned distance exactly when its compared similarity
+    is >= the threshold.
+
+    :param threshold: The minimum percent similarity
+    :type threshold: ``int``
+
+    :return: The maximum number of differing bits
+    :rtype: ``int``
+    """
+    return (6400 - 64 * threshold) // 100
+
+
+def annotate_title(title: str, match: Match, submission: Submission) -> str:
+    """
+    Annotates a matched post's title with its subreddit, if it is foreign
+
+    :param title: The title of the matched post
+    :type title: ``str``
+
+    :param match: The match being displayed
+    :type match: ``Match``
+
+    :param submission: The submission that the match was found for
+    :type submission: ``Submission``
+
+    :return: The title, suffixed with the origin subreddit if it differs
+    :rtype: ``str``
+    """
+    if match.subname.lower() == str(submission.subreddit).lower():
+        return title
+    return f"{title} (r/{match.subname})"
+
+
 def get_matches(
     bot: BotClient,
     parent: MediaData,
@@ -41,10 +79,19 @@ def get_matches(
     """
     Returns a generator of posts that match the provided parent submission
 
-    Requests all stored media data from the relevant subreddit for which the post
-    ID does not match the parent post ID, and yields all posts for which the hash
+    Searches the in-process index of the relevant subreddit for posts whose ID
+    does not match the parent post ID, and yields all posts for which the hash
     comparison value is >= the configured minimum similarity.
 
+    In sentry mode, posts older than the subreddit's configured `max_post_age`
+    are excluded before their hashes are compared, so that they can't crowd
+    out posts that are within the window. Posts older than the retention
+    policy's horizon are always excluded.
+
+    If the subreddit has enabled `global_matching`, the global index is
+    searched instead, and matches may come from any participating subreddit.
+    Each match's `subname` is the subreddit that it originated from.
+
     :param bot: The bot client to perform method calls to
     :type bot: ``BotClient``
 
@@ -62,32 +109,39 @@ def get_matches(
     """
     match mode:
         case "sentry":
-            cursor_name = "fetch_media"
             threshold_key = "sentry_threshold"
         case "mentioned":
-            cursor_name = "fetch_media_requested"
             threshold_key = "mentioned_threshold"
 
-    # Use a named cursor because queries to the media_storage table are very
-    # large in terms of data quantity, and will cause high amounts of memory to
-    # be allocated if using a client-side cursor
-    cursor = bot.db.cursor(cursor_name)
-    cursor.execute(
-        """
-        SELECT * FROM
-            media_storage
-        WHERE
-            subname=%s AND
-            NOT submission_id=%s
-        """,
-        (parent.subname, submission.id),
-    )
-
-    for item in cursor:
-        post = MediaData(*item)
-        compared = compare_hashes(parent.hash, post.hash)
-        if compared >= bot.subreddit_configs[parent.subname][threshold_key]:
-            yield Match(*post, compared)
-
-    cursor.close()
-    bot.db.commit()
+    sub_config = bot.subreddit_configs[parent.subname]
+    threshold = sub_config[threshold_key]
+
+    # Pruned posts may linger in the global index, or in indexes that haven't
+    # expired them yet
+    min_created = bot.retention.horizon
+    if mode == "sentry" and sub_config["max_post_age"] > 0:
+        min_created = max(
+            min_created,
+            int(submission.created_utc) - sub_config["max_post_age"] * 86_400,
+        )
+
+    # Search eagerly, so that the store isn't locked while matches are used
+    with bot.index.lock:
+        index = (
+            bot.index.get_global()
+            if sub_config.get("global_matching")
+            else bot.index.get(parent.subname)
+        )
+        rows = [
+            *index.search(
+                int(parent.hash),
+                max_distance(threshold),
+                exclude=submission.id,
+                min_created=min_created,
+            )
+        ]
+        bot.metrics.rows_scanned.observe(index.scanned, mode=mode)
+
+    for post_hash, post_id, subname in rows:
+        compared = compare_hashes(parent.hash, str(post_hash))
+        yield Match(str(post_hash), post_id, subname, compared)
@@ -0,0 +1,403 @@
+"""
+TheReposterminator Reddit bot to detect reposts
+Copyright (C) 2023 sardonicism-04
+
+TheReposterminator is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TheReposterminator is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with TheReposterminator.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from typing import Any
+
+import psycopg2
+
+logger = logging.getLogger(__name__)
+
+
+# How often the replica's replay position may be checked while reads are
+# waiting for it to catch up with a write
+REPLAY_CHECK_INTERVAL = 0.5
+
+
+class PoolExhausted(Exception):
+    """Raised when no connection becomes available within the timeout"""
+
+
+def parse_lsn(lsn: str) -> int:
+    """Converts a `pg_lsn` in its `XXX/XXX` text form to an integer"""
+    high, low = lsn.split("/")
+    return int(high, 16) << 32 | int(low, 16)
+
+
+class ConnectionPool:
+    """
+    A thread-safe pool of database connections
+
+    Connections are handed out for a single unit of work with `connection`,
+    which commits when the work succeeds and rolls back when it fails.
+    Connections that have been idle for a while are health-checked before
+    they are handed out, and connections that break during use are discarded
+    and transparently replaced, retrying with exponential backoff while the
+    database is unreachable.
+    """
+
+    def __init__(
+        self,
+        connect_kwargs: dict[str, Any],
+        *,
+        name: str = "primary",
+        min_connections: int = 1,
+        max_connections: int = 4,
+        acquire_timeout: float = 30,
+        health_check_interval: float = 30,
+        max_retries: int = 8,
+        max_backoff: float = 60,
+    ):
+        self.connect_kwargs = connect_kwargs
+        self.name = name
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self.acquire_timeout = acquire_timeout
+        self.health_check_interval = health_check_interval
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+
+        self._lock = threading.Condition()
+        # Idle connections, paired with the time they were returned
+        self._idle: list[tuple[psycopg2.connection, float]] = []
+        self._size = 0
+
+        self.acquisitions = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.reconnects = 0
+        self.discarded = 0
+
+        for _ in range(min_connections):
+            self._idle.append((self._connect(), time.monotonic()))
+            self._size += 1
+
+    @property
+    def stats(self) -> dict[str, int | float]:
+        """Counters describing the utilization of the pool"""
+        with self._lock:
+            return {
+                "size": self._size,
+                "in_use": self._size - len(self._idle),
+                "idle": len(self._idle),
+                "max_connections": self.max_connections,
+                "acquisitions": self.acquisitions,
+                "waits": self.waits,
+                "wait_seconds": self.wait_seconds,
+                "reconnects": self.reconnects,
+                "discarded": self.discarded,
+            }
+
+    def _connect(self) -> psycopg2.connection:
+        """
+        Opens a new connection, retrying with exponential backoff
+
+        :return: The new connection
+        :rtype: ``psycopg2.connection``
+
+        :raises psycopg2.OperationalError: If every attempt fails
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                return psycopg2.connect(**self.connect_kwargs, connect_timeout=5)
+            except psycopg2.OperationalError as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = min(2**attempt, self.max_backoff)
+                logger.warning(
+                    f"⚠️ Failed to connect to {self.name} database, "
+                    f"retrying in {delay}s: {e}"
+                )
+                time.sleep(delay)
+
+        raise AssertionError("unreachable")
+
+    @staticmethod
+    def _is_healthy(conn: psycopg2.connection) -> bool:
+        if conn.closed:
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    @staticmethod
+    def _close(conn: psycopg2.connection):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _discard(self, conn: psycopg2.connection):
+        self._close(conn)
+        with self._lock:
+            self._size -= 1
+            self.discarded += 1
+            self._lock.notify()
+
+    def _acquire(self) -> psycopg2.connection:
+        started = time.monotonic()
+
+        with self._lock:
+            self.acquisitions += 1
+            while not self._idle and self._size >= self.max_connections:
+                self.waits += 1
+                remaining = self.acquire_timeout - (time.monotonic() - started)
+                if remaining <= 0 or not self._lock.wait(remaining):
+                    raise PoolExhausted(
+                        f"No {self.name} database connection available"
+                    )
+            self.wait_seconds += time.monotonic() - started
+
+            if self._idle:
+                conn, returned_at = self._idle.pop()
+            else:
+                conn, returned_at = None, 0.0
+                self._size += 1
+
+        if (
+            conn is not None
+            and (
+                conn.closed
+                or time.monotonic() - returned_at >= self.health_check_interval
+            )
+            and not self._is_healthy(conn)
+        ):
+            # The broken connection's slot is kept for its replacement, so
+            # that no other thread can claim it in between
+            logger.info(f"Replacing broken {self.name} database connection")
+            self._close(conn)
+            with self._lock:
+                self.discarded += 1
+                self.reconnects += 1
+            conn = None
+
+        if conn is None:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._size -= 1
+                    self._lock.notify()
+                raise
+
+        return conn
+
+    def _release(self, conn: psycopg2.connection):
+        with self._lock:
+            self._idle.append((conn, time.monotonic()))
+            self._lock.notify()
+
+    @contextmanager
+    def connection(self) -> Iterator[psycopg2.connection]:
+        """
+        Borrows a connection from the pool for a unit of work
+
+        The transaction is committed if the block exits normally, and rolled
+        back if it raises. Connections that were broken by the error are
+        discarded rather than returned to the pool.
+
+        :return: A context manager yielding the borrowed connection
+        :rtype: ``Iterator[psycopg2.connection]``
+        """
+        conn = self._acquire()
+        try:
+            yield conn
+            conn.commit()
+        except BaseException as e:
+            if conn.closed or isinstance(
+                e, (psycopg2.OperationalError, psycopg2.InterfaceError)
+            ):
+                self._discard(conn)
+            else:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    self._discard(conn)
+                else:
+                    self._release(conn)
+            raise
+        else:
+            self._release(conn)
+
+    def close(self):
+        """Closes every idle connection in the pool"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+        for conn, _ in idle:
+            conn.close()
+
+
+class ReadRouter:
+    """
+    Routes read-only work to a replica database when it is fresh enough
+
+    A replica is used only while its replication lag is within the configured
+    bound, and once it has replayed the WAL position of the most recent write
+    recorded with `note_write`. Otherwise, and when no replica is configured,
+    reads go to the primary.
+    """
+
+    def __init__(
+        self,
+        primary: ConnectionPool,
+        replica: ConnectionPool | None = None,
+        *,
+        max_staleness: float = 5,
+        lag_check_interval: float = 5,
+    ):
+        self.primary = primary
+        self.replica = replica
+        self.max_staleness = max_staleness
+        self.lag_check_interval = lag_check_interval
+
+        # The WAL position the replica must replay to observe the most recent
+        # noted write, and its replay position when it was last checked
+        self.write_lsn = 0
+        self._replay_lsn = 0
+        self._replay_checked = 0.0
+        self._lag = float("inf")
+        self._lag_checked = 0.0
+
+        self.replica_reads = 0
+        self.primary_reads = 0
+
+    @property
+    def stats(self) -> dict[str, int | float]:
+        """Counters describing where reads have been routed"""
+        return {
+            "replica_reads": self.replica_reads,
+            "primary_reads": self.primary_reads,
+            "replica_lag": self._lag,
+            "replica_behind_write": int(self._replay_lsn < self.write_lsn),
+        }
+
+    def note_write(self, lsn: str):
+        """
+        Records that a write which reads must observe was committed
+
+        The write's commit record follows the position read within its
+        transaction, so the replica must have replayed beyond that position.
+
+        :param lsn: The primary's WAL position, as read with
+            `pg_current_wal_lsn()` within the write's transaction
+        :type lsn: ``str``
+        """
+        if self.replica is not None:
+            self.write_lsn = max(self.write_lsn, parse_lsn(lsn) + 1)
+
+    def replica_lag(self) -> float:
+        """
+        Gets the replication lag of the replica in seconds
+
+        The lag is measured at most once per check interval. A replica that has
+        replayed everything it has received is considered to have no lag, and
+        one that can't be reached is considered infinitely stale.
+
+        :return: The replication lag
+        :rtype: ``float``
+        """
+        if self.replica is None:
+            return float("inf")
+
+        if time.monotonic() - self._lag_checked >= self.lag_check_interval:
+            self._lag_checked = time.monotonic()
+            self.check_replica()
+
+        return self._lag
+
+    def check_replica(self):
+        """Measures the replica's replication lag and replay position"""
+        assert self.replica is not None
+        self._replay_checked = time.monotonic()
+        try:
+            with self.replica.connection() as conn, conn.cursor() as cur:
+                cur.execute(
+                    """
+                    SELECT
+                        CASE
+                            WHEN pg_last_wal_receive_lsn()=pg_last_wal_replay_lsn()
+                                THEN 0
+                            ELSE EXTRACT(
+                                EPOCH FROM NOW()-pg_last_xact_replay_timestamp()
+                            )
+                        END,
+                        pg_last_wal_replay_lsn()::text
+                    """
+                )
+                lag, replay_lsn = cur.fetchone() or (None, None)
+                self._lag = float("inf") if lag is None else float(lag)
+                if replay_lsn is not None:
+                    self._replay_lsn = parse_lsn(replay_lsn)
+        except (psycopg2.Error, PoolExhausted) as e:
+            logger.warning(f"⚠️ Failed to check replica lag: {e}")
+            self._lag = float("inf")
+
+    def use_replica(self) -> bool:
+        """
+        Whether reads may currently go to the replica
+
+        While the replica hasn't replayed the most recent noted write, its
+        replay position is rechecked at most every `REPLAY_CHECK_INTERVAL`
+        seconds rather than every lag check interval.
+
+        :return: Whether the replica is fresh enough to read from
+        :rtype: ``bool``
+        """
+        if self.replica_lag() > self.max_staleness:
+            return False
+        if (
+            self._replay_lsn < self.write_lsn
+            and time.monotonic() - self._replay_checked >= REPLAY_CHECK_INTERVAL
+        ):
+            self.check_replica()
+        return self._lag <= self.max_staleness and (
+            self._replay_lsn >= self.write_lsn
+        )
+
+    @contextmanager
+    def connection(
+        self, *, primary: bool = False
+    ) -> Iterator[psycopg2.connection]:
+        """
+        Borrows a connection for read-only work
+
+        :param primary: Whether to force the read onto the primary, defaults
+            to `False`
+        :type primary: ``bool``
+
+        :return: A context manager yielding the borrowed connection
+        :rtype: ``Iterator[psycopg2.connection]``
+        """
+        if not primary and self.replica is not None and self.use_replica():
+            self.replica_reads += 1
+            with self.replica.connection() as conn:
+                yield conn
+        else:
+            self.primary_reads += 1
+            with self.primary.connection() as conn:
+                yield conn
@@ -0,0 +1,313 @@
+"""
+TheReposterminator Reddit bot to detect reposts
+Copyright (C) 2023 sardonicism-04
+
+TheReposterminator is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TheReposterminator is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with TheReposterminator.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from TheReposterminator import BotClient
+    from TheReposterminator.types import FailuresConfig
+
+
+logger = logging.getLogger(__name__)
+
+
+class PermanentFailure(Exception):
+    """Raised when a submission's media can never be processed"""
+
+
+class TransientFailure(Exception):
+    """Raised when a submission's media may be processed if retried later"""
+
+
+class DeferredFailure(TransientFailure):
+    """
+    Raised when a submission's media can't be fetched right now, through no
+    fault of the submission
+
+    Deferred submissions are retried after `retry_in` seconds, without the
+    deferral counting as an attempt.
+    """
+
+    def __init__(self, message: str, retry_in: float):
+        super().__init__(message)
+        self.retry_in = retry_in
+
+
+def is_permanent(error: Exception) -> bool:
+    """
+    Classifies an error raised while processing a submission
+
+    Errors that aren't known to be permanent are assumed to be transient, and
+    only become permanent once they have been retried too many times.
+
+    :param error: The error to classify
+    :type error: ``Exception``
+
+    :return: Whether retrying can't resolve the error
+    :rtype: ``bool``
+    """
+    return isinstance(error, PermanentFailure)
+
+
+class FailureCache:
+    """
+    Tracks submissions that failed to be processed, so they aren't retried
+    too eagerly
+
+    Failures are persisted in the `submission_failures` table along with their
+    error class, and transient failures are retried with exponential backoff
+    until `max_attempts` is reached. Permanent failures are also marked in
+    `indexed_submissions`, so they never cost a fetch again.
+
+    Failures that are known to be waiting out their backoff are cached in a
+    bounded, least-recently-used map, so that submissions seen repeatedly in
+    listings don't each cost a query while they wait.
+
+    When each failed submission was first seen is kept too, so that its
+    detection lag is measured from its first attempt rather than its last.
+    Deferred submissions aren't persisted, so theirs is only kept in memory.
+    """
+
+    def __init__(self, bot: BotClient):
+        self.bot = bot
+
+        # Maps submission IDs to the monotonic time they may be retried at
+        self.cache: OrderedDict[str, float] = OrderedDict()
+        # Maps deferred submission IDs to when they were first seen
+        self.deferred_seen: OrderedDict[str, float] = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.permanent = 0
+        self.transient = 0
+
+    @property
+    def config(self) -> FailuresConfig:
+        return self.bot.config.get("failures", {})
+
+    @property
+    def stats(self) -> dict[str, int]:
+        """Counters describing the failures recorded by this process"""
+        return {
+            "permanent": self.permanent,
+            "transient": self.transient,
+            "cached": len(self.cache),
+        }
+
+    def waiting(self, submission_id: str) -> bool:
+        """
+        Checks the cache for whether a submission is waiting to be retried
+
+        :param submission_id: The ID of the submission
+        :type submission_id: ``str``
+
+        :return: Whether the submission should be skipped for now
+        :rtype: ``bool``
+        """
+        with self.lock:
+            if (retry_at := self.cache.get(submission_id)) is None:
+                return False
+            if time.monotonic() >= retry_at:
+                del self.cache[submission_id]
+                return False
+
+            self.cache.move_to_end(submission_id)
+            return True
+
+    def first_seen(
+        self, submission_id: str, now: float, stored: float | None = None
+    ) -> float:
+        """
+        Gets when a submission was first seen, including by earlier attempts
+
+        The time kept for a deferred submission is taken, and is kept again
+        by `record` if the submission is deferred once more.
+
+        :param submission_id: The ID of the submission
+        :type submission_id: ``str``
+
+        :param now: When the current attempt saw the submission
+        :type now: ``float``
+
+        :param stored: The `first_seen_at` of its recorded failure, if any
+        :type stored: ``float | None``
+
+        :return: The earliest time the submission was seen
+        :rtype: ``float``
+        """
+        with self.lock:
+            deferred = self.deferred_seen.pop(submission_id, None)
+        return min(seen for seen in (now, stored, deferred) if seen is not None)
+
+    def remember(self, submission_id: str, retry_in: float):
+        """
+        Caches that a submission is waiting out its backoff
+
+        :param submission_id: The ID of the submission
+        :type submission_id: ``str``
+
+        :param retry_in: The number of seconds until it may be retried
+        :type retry_in: ``float``
+        """
+        with self.lock:
+            self.cache[submission_id] = time.monotonic() + retry_in
+            self.cache.move_to_end(submission_id)
+            while len(self.cache) > self.config.get("max_cached", 100_000):
+                self.cache.popitem(last=False)
+
+    def record(self, submission_id: str, error: Exception, *, first_seen: float):
+        """
+        Records that processing a submission failed
+
+        :param submission_id: The ID of the submission
+        :type submission_id: ``str``
+
+        :param error: The error that processing failed with
+        :type error: ``Exception``
+
+        :param first_seen: When the submission was first seen, as returned by
+            `first_seen`
+        :type first_seen: ``float``
+        """
+        if isinstance(error, DeferredFailure):
+            with self.lock:
+                self.deferred_seen[submission_id] = first_seen
+                while len(self.deferred_seen) > self.config.get(
+                    "max_cached", 100_000
+                ):
+                    self.deferred_seen.popitem(last=False)
+            self.remember(submission_id, error.retry_in)
+            logger.debug(
+                "Deferring %s for %.0fs: %s", submission_id, error.retry_in, error
+            )
+            return
+
+        base_delay = self.config.get("base_delay", 300)
+        max_delay = self.config.get("max_delay", 86_400)
+
+        with self.bot.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO submission_failures AS failures
+                    (submission_id, error_class, permanent, last_error,
+                    first_seen_at)
+                VALUES(
+                    %(id)s, %(error_class)s, %(permanent)s, %(error)s,
+                    %(first_seen)s
+                )
+                ON CONFLICT (submission_id) DO UPDATE SET
+                    error_class=EXCLUDED.error_class,
+                    permanent=EXCLUDED.permanent OR
+                        failures.attempts + 1 >= %(max_attempts)s,
+                    attempts=failures.attempts + 1,
+                    last_error=EXCLUDED.last_error,
+                    failed_at=NOW(),
+                    first_seen_at=COALESCE(
+                        failures.first_seen_at, EXCLUDED.first_seen_at
+                    )
+                RETURNING permanent, attempts""",
+                {
+                    "id": submission_id,
+                    "error_class": type(error).__name__,
+                    "permanent": is_permanent(error),
+                    "error": str(error),
+                    "max_attempts": self.config.get("max_attempts", 4),
+                    "first_seen": first_seen,
+                },
+            )
+            permanent, attempts = cur.fetchone() or (True, 1)
+
+            if permanent:
+                cur.execute(
+                    """
+                    INSERT INTO indexed_submissions (id) VALUES (%s)
+                    ON CONFLICT DO NOTHING""",
+                    (submission_id,),
+                )
+            else:
+                retry_in = min(base_delay * 2 ** (attempts - 1), max_delay)
+                cur.execute(
+                    """
+                    UPDATE submission_failures
+                    SET next_attempt_at=NOW() + make_interval(secs => %s)
+                    WHERE submission_id=%s""",
+                    (retry_in, submission_id),
+                )
+
+        if permanent:
+            self.permanent += 1
+            with self.lock:
+                self.cache.pop(submission_id, None)
+            logger.debug(
+                "Permanently ignoring %s after %s attempts: %s: %s",
+                submission_id,
+                attempts,
+                type(error).__name__,
+                error,
+            )
+        else:
+            self.transient += 1
+            self.remember(submission_id, retry_in)
+            logger.debug(
+                "Retrying %s in %ss: %s: %s",
+                submission_id,
+                retry_in,
+                type(error).__name__,
+                error,
+            )
+
+    def clear(self, submission_id: str):
+        """
+        Forgets a previous failure of a submission, once it has succeeded
+
+        :param submission_id: The ID of the submission
+        :type submission_id: ``str``
+        """
+        with self.lock:
+            self.cache.pop(submission_id, None)
+        with self.bot.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                "DELETE FROM submission_failures WHERE submission_id=%s",
+                (submission_id,),
+            )
+
+    def prune(self, days: int):
+        """
+        Deletes permanent failures older than a number of days
+
+        Permanent failures are also recorded in `indexed_submissions`, so they
+        remain ignored once their failure has been pruned.
+
+        :param days: The number of days to keep permanent failures
+        :type days: ``int``
+        """
+        with self.bot.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                """
+                DELETE FROM submission_failures
+                WHERE
+                    permanent AND
+                    failed_at < NOW() - make_interval(days => %s)""",
+                (days,),
+            )
+            if cur.rowcount:
+                logger.info(f"✅ Pruned {cur.rowcount} submission failures")
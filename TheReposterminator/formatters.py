@@ -1,6 +1,16 @@
+import copy
+import json
+from datetime import datetime, timezone
 from enum import Enum
 from logging import Formatter, LogRecord
 
+# The attributes of every log record, so that any others can be told apart as
+# having been passed through `extra`
+RECORD_ATTRIBUTES = frozenset(vars(LogRecord("", 0, "", 0, "", (), None))) | {
+    "message",
+    "asctime",
+}
+
 
 class Color(Enum):
     RESET = "0"
@@ -37,8 +47,38 @@ class ColoredLoggingFormatter(Formatter):
         super().__init__(**kwargs)
 
     def format(self, record: LogRecord):
-        record.asctime = Color.CYAN(self.formatTime(record, self.datefmt))
-        record.msg = Color.GREY(record.msg)
-        record.name = Color.PURPLE(record.name)
-        record.levelname = self.COLORS[record.levelname](record.levelname)
-        return super().format(record)
+        # Colours a copy, so other handlers of the record aren't affected
+        colored = copy.copy(record)
+        colored.msg = Color.GREY(record.getMessage())
+        colored.args = None
+        colored.name = Color.PURPLE(record.name)
+        colored.levelname = self.COLORS.get(record.levelname, Color.GREY)(
+            record.levelname
+        )
+        return super().format(colored)
+
+
+class JsonFormatter(Formatter):
+    """Formats each record as a single line of JSON, including any extras"""
+
+    def format(self, record: LogRecord):
+        data = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "function": record.funcName,
+            "line": record.lineno,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data["exception"] = record.exc_text
+        if record.stack_info:
+            data["stack"] = record.stack_info
+
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES and key not in data:
+                data[key] = value
+        return json.dumps(data, default=str, ensure_ascii=False)
@@ -0,0 +1,286 @@
+"""
+TheReposterminator Reddit bot to detect reposts
+Copyright (C) 2023 sardonicism-04
+
+TheReposterminator is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TheReposterminator is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with TheReposterminator.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import logging
+import math
+import threading
+import time
+from typing import TYPE_CHECKING
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .failures import DeferredFailure, PermanentFailure, TransientFailure
+
+if TYPE_CHECKING:
+    from TheReposterminator import BotClient
+    from TheReposterminator.types import HostConfig, MediaConfig
+
+
+logger = logging.getLogger(__name__)
+
+# Images at least this large are never hashed
+MAX_IMAGE_SIZE = 89_478_485
+
+
+class HostState:
+    """
+    The concurrency limit, rate limit, circuit breaker, and statistics of a
+    single media host
+
+    The circuit breaker opens after `failure_threshold` consecutive failures,
+    rejecting every request for `cooldown` seconds. After the cooldown, a
+    single probe request is let through, which closes the breaker if it
+    succeeds and reopens it if it fails.
+    """
+
+    def __init__(self, host: str, config: HostConfig):
+        self.host = host
+        self.rate = config.get("rate", 5.0)
+        self.burst = config.get("burst", 10)
+        self.failure_threshold = config.get("failure_threshold", 5)
+        self.cooldown = config.get("cooldown", 60.0)
+
+        self.slots = threading.BoundedSemaphore(
+            config.get("max_concurrent", 4)
+        )
+        self.lock = threading.Lock()
+
+        self.tokens = float(self.burst)
+        self.refilled_at = time.monotonic()
+
+        self.consecutive_failures = 0
+        self.opened_at: float | None = None
+        self.probing = False
+
+        self.requests = 0
+        self.errors = 0
+        self.rejected = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return "open"
+        return "half-open"
+
+    @property
+    def stats(self) -> dict[str, int | float | str]:
+        return {
+            "state": self.state,
+            "requests": self.requests,
+            "errors": self.errors,
+            "rejected": self.rejected,
+            "latency_avg": self.latency_total / max(self.requests, 1),
+            "latency_max": self.latency_max,
+        }
+
+    def admit(self) -> float:
+        """
+        Admits a request through the circuit breaker and the token bucket
+
+        :return: The number of seconds to wait before the request is admitted,
+            `math.inf` while another request is probing the host, or `0` if
+            it has been admitted
+        :rtype: ``float``
+        """
+        with self.lock:
+            now = time.monotonic()
+
+            if self.opened_at is not None:
+                remaining = self.cooldown - (now - self.opened_at)
+                if remaining > 0:
+                    return remaining
+                if self.probing:
+                    return math.inf
+                self.probing = True  # Half-open, let a single probe through
+
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.refilled_at) * self.rate
+            )
+            self.refilled_at = now
+            if self.tokens < 1:
+                if self.probing:
+                    self.probing = False
+                return (1 - self.tokens) / self.rate
+
+            self.tokens -= 1
+            return 0
+
+    def abandon(self):
+        """Gives up on an admitted request that was never made"""
+        with self.lock:
+            self.probing = False
+
+    def record(self, latency: float, *, failed: bool):
+        """
+        Records the outcome of an admitted request
+
+        :param latency: How long the request took, in seconds
+        :type latency: ``float``
+
+        :param failed: Whether the host failed to serve the request
+        :type failed: ``bool``
+        """
+        with self.lock:
+            self.requests += 1
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+            was_open = self.opened_at is not None
+            self.probing = False
+
+            if not failed:
+                self.consecutive_failures = 0
+                self.opened_at = None
+                if was_open:
+                    logger.info(f"✅ Media host {self.host} has recovered")
+                return
+
+            self.errors += 1
+            self.consecutive_failures += 1
+            if was_open or self.consecutive_failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                logger.warning(
+                    f"⚠️ Media host {self.host} is failing, deferring its "
+                    f"requests for {self.cooldown}s"
+                )
+
+
+class HostGuard:
+    """
+    Fetches media while isolating the bot from unhealthy media hosts
+
+    Each host has its own `HostState`, which caps the number of concurrent
+    requests to it, rate limits it with a token bucket, and trips a circuit
+    breaker when it keeps failing. Requests that a host can't accept in time
+    fail fast with a `DeferredFailure`, so that submissions linking to it are
+    retried later without costing a request now.
+
+    Hosts share defaults from the `[media]` config section, which may be
+    overridden per host in `[media.hosts."<host>"]`.
+    """
+
+    def __init__(self, bot: BotClient):
+        self.bot = bot
+
+        self.hosts: dict[str, HostState] = {}
+        self.lock = threading.Lock()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    @property
+    def config(self) -> MediaConfig:
+        return self.bot.config.get("media", {})
+
+    @property
+    def stats(self) -> dict[str, dict[str, int | float | str]]:
+        """Statistics of every host that has been requested"""
+        return {host: state.stats for host, state in self.hosts.items()}
+
+    def host(self, host: str) -> HostState:
+        with self.lock:
+            if (state := self.hosts.get(host)) is None:
+                config: HostConfig = {
+                    **self.config,  # type: ignore
+                    **self.config.get("hosts", {}).get(host, {}),
+                }
+                state = self.hosts[host] = HostState(host, config)
+            return state
+
+    def fetch(self, url: str) -> bytes:
+        """
+        Fetches the content of a media URL
+
+        :param url: The URL to fetch
+        :type url: ``str``
+
+        :return: The content of the response
+        :rtype: ``bytes``
+
+        :raises DeferredFailure: If the host can't accept the request in time
+        :raises PermanentFailure: If the media is gone, or excessively large
+        :raises TransientFailure: If the request times out, fails to connect,
+            or is met with a server error or ratelimit
+        """
+        state = self.host(urlsplit(url).hostname or "")
+        deadline = time.monotonic() + self.config.get("max_wait", 5.0)
+
+        while (wait := state.admit()) > 0:
+            if time.monotonic() + wait > deadline:
+                state.rejected += 1
+                raise DeferredFailure(
+                    f"Media host {state.host} is busy",
+                    state.cooldown if wait == math.inf else wait,
+                )
+            time.sleep(wait)
+
+        try:
+            if not state.slots.acquire(
+                timeout=max(deadline - time.monotonic(), 0)
+            ):
+                state.rejected += 1
+                raise DeferredFailure(f"Media host {state.host} is saturated", 5)
+        except BaseException:
+            # The request won't be recorded, so it can't be left as the probe
+            state.abandon()
+            raise
+
+        started = time.perf_counter()
+        failed = True
+        try:
+            with self.session.get(
+                url, timeout=self.config.get("timeout", 30), stream=True
+            ) as resp:
+                if resp.status_code >= 500 or resp.status_code == 429:
+                    raise TransientFailure(f"HTTP {resp.status_code}")
+
+                if resp.status_code >= 400:
+                    failed = False  # The host itself is healthy
+                    raise PermanentFailure(f"HTTP {resp.status_code}")
+
+                length = resp.headers.get("Content-Length", "")
+                if length.isdigit() and int(length) >= MAX_IMAGE_SIZE:
+                    failed = False
+                    raise PermanentFailure("Excessively large image")
+
+                content = resp.content
+                failed = False
+
+        except (
+            requests.Timeout,
+            requests.ConnectionError,
+            requests.exceptions.ChunkedEncodingError,
+        ) as e:
+            raise TransientFailure(str(e)) from e
+
+        finally:
+            state.slots.release()
+            state.record(time.perf_counter() - started, failed=failed)
+
+        if len(content) >= MAX_IMAGE_SIZE:
+            raise PermanentFailure("Excessively large image")
+
+        return content
@@ -0,0 +1,1058 @@
+"""
+TheReposterminator Reddit bot to detect reposts
+Copyright (C) 2023 sardonicism-04
+
+TheReposterminator is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TheReposterminator is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with TheReposterminator.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+from collections import OrderedDict, deque
+from collections.abc import Iterator
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from TheReposterminator import BotClient
+
+
+logger = logging.getLogger(__name__)
+
+# Snapshot files are laid out as a fixed-size header, followed by a column of
+# native unsigned 64-bit hashes, a column of signed 64-bit creation
+# timestamps, and a column of fixed-width, NUL-padded submission IDs. Keeping
+# the numeric values in their own columns lets them be viewed directly out of
+# the mapped pages without copying. The columns are followed by the row IDs
+# of the rows above the settled watermark, which aren't all known to be in
+# the snapshot by the watermark alone.
+SNAPSHOT_MAGIC = b"RTSNAP\x00\x00"
+SNAPSHOT_VERSION = 3
+# magic, version, count, settled watermark, row IDs above the watermark
+SNAPSHOT_HEADER = struct.Struct("<8sH6xQQQ")
+SNAPSHOT_SUFFIX = ".snap"
+
+HASH_WIDTH = 8
+CREATED_WIDTH = 8
+ID_WIDTH = 10  # Matches the width of media_storage.submission_id
+
+# The size of a list slot holding a reference to a tail submission ID
+POINTER_WIDTH = 8
+# The approximate size of a tail row ID's entry in a set
+ROW_ID_ENTRY_WIDTH = 64
+
+ROW_ID_WIDTH = 8
+
+# Seconds within which every transaction inserting into media_storage is
+# assumed to commit. Rows committed out of row ID order are caught by
+# replaying this far behind the highest row ID seen.
+REPLAY_WINDOW = 300
+
+
+class Watermark:
+    """
+    Tracks how far through `media_storage` an index has been brought up to date
+
+    Row IDs are allocated when rows are inserted, but rows only become
+    visible once their transaction commits, so concurrent transactions can
+    commit rows below the highest row ID that has already been seen.
+    `highest` is the highest row ID seen, and `settled` trails it by
+    `REPLAY_WINDOW` seconds, by when every row below it has committed and
+    been replayed. Replays start from the settled watermark.
+    """
+
+    def __init__(self, settled: int = 0, highest: int = 0):
+        self.settled = settled
+        self.highest = max(settled, highest)
+        # When each replay finished, and the highest row ID it had seen
+        self._marks: deque[tuple[float, int]] = deque()
+
+    def advance(self, row_id: int):
+        self.highest = max(self.highest, row_id)
+
+    def mark(self, started: float):
+        """
+        Records a replay, settling the marks of earlier replays whose rows
+        have all committed since
+
+        :param started: The `time.monotonic()` at which the replay's query
+            was made
+        :type started: ``float``
+        """
+        while self._marks and started - self._marks[0][0] >= REPLAY_WINDOW:
+            self.settled = max(self.settled, self._marks.popleft()[1])
+        if not self._marks or self._marks[-1][1] != self.highest:
+            self._marks.append((time.monotonic(), self.highest))
+
+
+class SubredditIndex:
+    """
+    The in-process hash index for a single subreddit
+
+    Consists of a read-only base loaded from a memory-mapped snapshot, and a
+    tail of rows that have been added since the snapshot was written. The
+    index contains every `media_storage.row_id` up to its settled watermark,
+    and the rows above it whose IDs are kept in `_base_rows` or `_tail_rows`.
+
+    Creation timestamps of 0 mean that the post's age is unknown.
+    """
+
+    def __init__(self, subname: str):
+        self.subname = subname
+        self.watermark = Watermark()
+        # The number of rows compared by the last search
+        self.scanned = 0
+
+        self._mapping: mmap.mmap | None = None
+        self._base_hashes: memoryview | None = None
+        self._base_created: memoryview | None = None
+        self._base_ids: memoryview | None = None
+        self._base_count = 0
+        self._base_rows: set[int] = set()
+
+        self._hashes = array("Q")
+        self._created = array("q")
+        self._ids: list[str] = []
+        self._tail_rows: set[int] = set()
+        self._tail_bytes = 0
+
+    def __len__(self) -> int:
+        return self._base_count + len(self._hashes)
+
+    @property
+    def nbytes(self) -> int:
+        """The approximate amount of memory occupied by the index"""
+        return (
+            self._base_count * (HASH_WIDTH + CREATED_WIDTH + ID_WIDTH)
+            + len(self._hashes) * (HASH_WIDTH + CREATED_WIDTH)
+            + len(self._base_rows) * ROW_ID_ENTRY_WIDTH
+            + self._tail_bytes
+        )
+
+    @property
+    def dirty(self) -> bool:
+        """Whether the index contains rows that are not in its snapshot"""
+        return len(self._hashes) > 0
+
+    def load_snapshot(self, path: Path) -> bool:
+        """
+        Maps a snapshot file into the index as its base
+
+        The file is validated before it is used; a snapshot with a mismatched
+        magic number, version, or size is ignored so that the index can be
+        rebuilt from the database instead.
+
+        :param path: The snapshot file to map
+        :type path: ``Path``
+
+        :return: Whether the snapshot was successfully loaded
+        :rtype: ``bool``
+        """
+        try:
+            with open(path, "rb") as file:
+                if os.fstat(file.fileno()).st_size < SNAPSHOT_HEADER.size:
+                    return False
+                mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except OSError as e:
+            logger.debug(f"Failed to open snapshot {path}: {e}")
+            return False
+
+        magic, version, count, settled, recent = SNAPSHOT_HEADER.unpack_from(
+            mapping
+        )
+        expected_size = (
+            SNAPSHOT_HEADER.size
+            + count * (HASH_WIDTH + CREATED_WIDTH + ID_WIDTH)
+            + recent * ROW_ID_WIDTH
+        )
+        if (
+            magic != SNAPSHOT_MAGIC
+            or version != SNAPSHOT_VERSION
+            or len(mapping) != expected_size
+        ):
+            logger.warning(f"⚠️ Ignoring invalid snapshot {path}")
+            mapping.close()
+            return False
+
+        self.close()
+        view = memoryview(mapping)
+        hashes_end = SNAPSHOT_HEADER.size + count * HASH_WIDTH
+        created_end = hashes_end + count * CREATED_WIDTH
+        ids_end = created_end + count * ID_WIDTH
+
+        self._mapping = mapping
+        self._base_hashes = view[SNAPSHOT_HEADER.size:hashes_end].cast("Q")
+        self._base_created = view[hashes_end:created_end].cast("q")
+        self._base_ids = view[created_end:ids_end]
+        self._base_count = count
+        self._base_rows = set(array("Q", view[ids_end:].tobytes()))
+        self.watermark = Watermark(settled, max(self._base_rows, default=0))
+        return True
+
+    def write_snapshot(self, path: Path):
+        """
+        Writes the full contents of the index to a snapshot file
+
+        The file is written next to its destination and then atomically
+        renamed into place, so processes that still have the previous
+        snapshot mapped are unaffected.
+
+        :param path: The destination snapshot file
+        :type path: ``Path``
+        """
+        temp_path = path.with_suffix(f"{SNAPSHOT_SUFFIX}.{os.getpid()}.tmp")
+        settled = self.watermark.settled
+        recent = array(
+            "Q",
+            sorted(
+                row_id
+                for row_id in self._base_rows | self._tail_rows
+                if row_id > settled
+            ),
+        )
+
+        with open(temp_path, "wb") as file:
+            file.write(
+                SNAPSHOT_HEADER.pack(
+                    SNAPSHOT_MAGIC,
+                    SNAPSHOT_VERSION,
+                    len(self),
+                    settled,
+                    len(recent),
+                )
+            )
+            if self._base_hashes is not None:
+                file.write(self._base_hashes)
+            file.write(self._hashes)
+
+            if self._base_created is not None:
+                file.write(self._base_created)
+            file.write(self._created)
+
+            if self._base_ids is not None:
+                file.write(self._base_ids)
+            for submission_id in self._ids:
+                file.write(submission_id.encode().ljust(ID_WIDTH, b"\x00"))
+
+            file.write(recent)
+
+        os.replace(temp_path, path)
+
+    def close(self):
+        """Releases the mapped snapshot, if there is one"""
+        for view in (self._base_hashes, self._base_created, self._base_ids):
+            if view is not None:
+                view.release()
+        if self._mapping is not None:
+            self._mapping.close()
+
+        self._mapping = None
+        self._base_hashes = self._base_created = self._base_ids = None
+        self._base_count = 0
+        self._base_rows = set()
+
+    def add(
+        self, image_hash: int, submission_id: str, created_utc: int, row_id: int
+    ):
+        """
+        Appends a row to the tail of the index
+
+        :param image_hash: The image hash of the row
+        :type image_hash: ``int``
+
+        :param submission_id: The submission ID of the row
+        :type submission_id: ``str``
+
+        :param created_utc: The creation timestamp of the row's post
+        :type created_utc: ``int``
+
+        :param row_id: The `media_storage.row_id` of the row
+        :type row_id: ``int``
+        """
+        self._hashes.append(image_hash)
+        self._created.append(created_utc)
+        self._ids.append(submission_id)
+        self._tail_rows.add(row_id)
+        self._tail_bytes += (
+            sys.getsizeof(submission_id) + POINTER_WIDTH + ROW_ID_ENTRY_WIDTH
+        )
+        self.watermark.advance(row_id)
+
+    def contains(self, row_id: int) -> bool:
+        """
+        Whether a row has already been added to the index
+
+        :param row_id: The `media_storage.row_id` of the row
+        :type row_id: ``int``
+
+        :return: Whether the row is in the index
+        :rtype: ``bool``
+        """
+        return (
+            row_id <= self.watermark.settled
+            or row_id in self._base_rows
+            or row_id in self._tail_rows
+        )
+
+    def expire(self, horizon: int) -> SubredditIndex:
+        """
+        Copies the index, leaving out the rows of posts created before a horizon
+
+        Rows of an unknown age are kept. The copy keeps the index's watermark
+        and row IDs, so that the rows left out are not replayed again.
+
+        :param horizon: The earliest creation timestamp to keep
+        :type horizon: ``int``
+
+        :return: The copy, which holds all of its rows in its tail
+        :rtype: ``SubredditIndex``
+        """
+        kept = SubredditIndex(self.subname)
+        kept.watermark = self.watermark
+        kept._tail_rows = self._base_rows | self._tail_rows
+        kept._tail_bytes = len(kept._tail_rows) * ROW_ID_ENTRY_WIDTH
+
+        for hashes, created, offset in (
+            (self._base_hashes, self._base_created, 0),
+            (self._hashes, self._created, self._base_count),
+        ):
+            if hashes is None or created is None:
+                continue
+
+            for position, (image_hash, created_utc) in enumerate(
+                zip(hashes, created), offset
+            ):
+                if 0 < created_utc < horizon:
+                    continue
+                submission_id = self.submission_id(position)
+                kept._hashes.append(image_hash)
+                kept._created.append(created_utc)
+                kept._ids.append(submission_id)
+                kept._tail_bytes += sys.getsizeof(submission_id) + POINTER_WIDTH
+
+        return kept
+
+    def submission_id(self, position: int) -> str:
+        """
+        Gets the submission ID stored at a position in the index
+
+        :param position: The position to look up
+        :type position: ``int``
+
+        :return: The submission ID
+        :rtype: ``str``
+        """
+        if position < self._base_count and self._base_ids is not None:
+            start = position * ID_WIDTH
+            raw = self._base_ids[start:start + ID_WIDTH].tobytes()
+            return raw.rstrip(b"\x00").decode()
+        return self._ids[position - self._base_count]
+
+    def search(
+        self,
+        image_hash: int,
+        max_distance: int,
+        *,
+        exclude: str,
+        min_created: int = 0,
+    ) -> Iterator[tuple[int, str, str]]:
+        """
+        Yields every row within a Hamming distance of the provided hash
+
+        Rows whose post was created before `min_created` are skipped before
+        their hashes are compared. Rows of an unknown age are never skipped.
+
+        :param image_hash: The hash to search for
+        :type image_hash: ``int``
+
+        :param max_distance: The maximum number of differing bits
+        :type max_distance: ``int``
+
+        :param exclude: A submission ID to leave out of the results
+        :type exclude: ``str``
+
+        :param min_created: The earliest creation timestamp to include,
+            defaults to `0` (no limit)
+        :type min_created: ``int``
+
+        :return: An iterator of `(hash, submission_id, subname)` triples
+        :rtype: ``Iterator[tuple[int, str, str]]``
+        """
+        # Every row is compared
+        self.scanned = len(self)
+
+        for hashes, created, offset in (
+            (self._base_hashes, self._base_created, 0),
+            (self._hashes, self._created, self._base_count),
+        ):
+            if hashes is None or created is None:
+                continue
+
+            for position, (candidate, created_utc) in enumerate(
+                zip(hashes, created), offset
+            ):
+                if 0 < created_utc < min_created:
+                    continue
+                if (candidate ^ image_hash).bit_count() > max_distance:
+                    continue
+                if (submission_id := self.submission_id(position)) != exclude:
+                    yield candidate, submission_id, self.subname
+
+
+class GlobalIndex:
+    """
+    A hash index shared by every subreddit that has opted into global matching
+
+    Rows are sharded by multi-index hashing: each 64-bit hash is split into
+    `SEGMENTS` segments, and every segment value maps to the positions of the
+    rows that share it. If two hashes differ by at most `d` bits, at least one
+    of their segments differs by at most `d // SEGMENTS` bits, so a search only
+    has to visit the shards within that radius of each of the query's
+    segments. The number of rows visited depends on the size of those shards
+    rather than on the total number of rows in the index.
+
+    `loaded` holds the subreddits whose rows are in the index, and `subnames`
+    holds the subreddits that currently participate, whose rows are searched.
+    """
+
+    SEGMENTS = 4
+    SEGMENT_BITS = 64 // SEGMENTS
+    SEGMENT_MASK = (1 << SEGMENT_BITS) - 1
+
+    def __init__(self):
+        self.subnames: set[str] = set()
+        self.loaded: set[str] = set()
+        self.watermark = Watermark()
+        # The number of rows compared by the last search
+        self.scanned = 0
+        # The IDs of rows above the settled watermark, so that a row which
+        # arrives both by notification and by replay is only added once
+        self._rows: set[int] = set()
+
+        self._hashes = array("Q")
+        self._created = array("q")
+        self._ids: list[str] = []
+        self._subnames: list[str] = []
+        self._shards: list[dict[int, array]] = [
+            {} for _ in range(self.SEGMENTS)
+        ]
+        self._flips: dict[int, list[int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._hashes)
+
+    def _segments(self, image_hash: int) -> Iterator[tuple[int, int]]:
+        for segment in range(self.SEGMENTS):
+            yield segment, (
+                image_hash >> (segment * self.SEGMENT_BITS) & self.SEGMENT_MASK
+            )
+
+    def _flip_masks(self, radius: int) -> list[int]:
+        """Returns every segment-wide bit mask with at most `radius` bits set"""
+        if (masks := self._flips.get(radius)) is None:
+            masks = [
+                mask
+                for mask in range(1 << self.SEGMENT_BITS)
+                if mask.bit_count() <= radius
+            ]
+            self._flips[radius] = masks
+        return masks
+
+    def add(
+        self,
+        image_hash: int,
+        submission_id: str,
+        subname: str,
+        created_utc: int,
+        row_id: int,
+    ):
+        """
+        Adds a row to the index and to each of its segments' shards
+
+        :param image_hash: The image hash of the row
+        :type image_hash: ``int``
+
+        :param submission_id: The submission ID of the row
+        :type submission_id: ``str``
+
+        :param subname: The subreddit the row belongs to
+        :type subname: ``str``
+
+        :param created_utc: The creation timestamp of the row's post
+        :type created_utc: ``int``
+
+        :param row_id: The `media_storage.row_id` of the row
+        :type row_id: ``int``
+        """
+        if row_id > self.watermark.settled:
+            if row_id in self._rows:
+                return
+            self._rows.add(row_id)
+
+        self.watermark.advance(row_id)
+        position = len(self._hashes)
+        self._hashes.append(image_hash)
+        self._created.append(created_utc)
+        self._ids.append(submission_id)
+        self._subnames.append(sys.intern(subname))
+
+        for segment, value in self._segments(image_hash):
+            shard = self._shards[segment]
+            if (positions := shard.get(value)) is None:
+                positions = shard[value] = array("L")
+            positions.append(position)
+
+    def settle(self, started: float):
+        """
+        Records a replay, forgetting the IDs of rows that have been settled
+
+        :param started: The `time.monotonic()` at which the replay's query
+            was made
+        :type started: ``float``
+        """
+        settled = self.watermark.settled
+        self.watermark.mark(started)
+        if self.watermark.settled != settled:
+            self._rows = {
+                row_id
+                for row_id in self._rows
+                if row_id > self.watermark.settled
+            }
+
+    def search(
+        self,
+        image_hash: int,
+        max_distance: int,
+        *,
+        exclude: str,
+        min_created: int = 0,
+    ) -> Iterator[tuple[int, str, str]]:
+        """
+        Yields every row within a Hamming distance of the provided hash
+
+        Only rows belonging to currently participating subreddits are yielded.
+
+        :param image_hash: The hash to search for
+        :type image_hash: ``int``
+
+        :param max_distance: The maximum number of differing bits
+        :type max_distance: ``int``
+
+        :param exclude: A submission ID to leave out of the results
+        :type exclude: ``str``
+
+        :param min_created: The earliest creation timestamp to include,
+            defaults to `0` (no limit)
+        :type min_created: ``int``
+
+        :return: An iterator of `(hash, submission_id, subname)` triples
+        :rtype: ``Iterator[tuple[int, str, str]]``
+        """
+        masks = self._flip_masks(max_distance // self.SEGMENTS)
+        seen: set[int] = set()
+
+        for segment, value in self._segments(image_hash):
+            shard = self._shards[segment]
+            for mask in masks:
+                for position in shard.get(value ^ mask, ()):
+                    if position in seen:
+                        continue
+                    seen.add(position)
+
+                    if 0 < self._created[position] < min_created:
+                        continue
+                    candidate = self._hashes[position]
+                    if (candidate ^ image_hash).bit_count() > max_distance:
+                        continue
+                    if (
+                        self._ids[position] != exclude
+                        and self._subnames[position] in self.subnames
+                    ):
+                        yield (
+                            candidate,
+                            self._ids[position],
+                            self._subnames[position],
+                        )
+
+        # Only the candidates sharing a segment with the hash are compared
+        self.scanned = len(seen)
+
+
+class IndexStore:
+    """
+    Manages the in-process hash indexes of every subreddit
+
+    Indexes are loaded on first use from their snapshot file, after which any
+    rows above the snapshot's settled watermark are replayed from the
+    database. Snapshots are periodically rewritten so that restarts only need
+    to replay a small amount of history.
+
+    Loaded indexes are kept in least-recently-used order. Whenever their
+    combined size exceeds the configured memory budget, the coldest indexes
+    are saved and evicted, to be loaded again the next time they are needed.
+
+    Subreddits that opt into global matching are additionally loaded into a
+    single `GlobalIndex`, which is not subject to the memory budget.
+
+    Other processes, such as the `ingest` and `import` subcommands, may insert
+    rows for the same subreddits, so while the store is `shared`, loaded
+    indexes are brought up to date from the database every time they are used
+    instead of only when they are loaded. The bot stops sharing the store when
+    the rows inserted by other processes are instead delivered to `add` by a
+    `NotificationListener`.
+
+    The store is not safe to use from several threads at once. Threads must
+    hold `lock` while using it, or any index obtained from it.
+    """
+
+    def __init__(self, bot: BotClient):
+        self.bot = bot
+
+        self.indexes: OrderedDict[str, SubredditIndex] = OrderedDict()
+        self.last_saved = time.monotonic()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.global_index = GlobalIndex()
+        self.shared = True
+
+        self.lock = threading.RLock()
+
+    @property
+    def directory(self) -> Path:
+        return Path(
+            self.bot.config.get("snapshots", {}).get("directory", "snapshots")
+        )
+
+    @property
+    def memory_budget(self) -> int:
+        megabytes = self.bot.config.get("index", {}).get("memory_budget", 0)
+        return megabytes * 1024 * 1024
+
+    @property
+    def resident_bytes(self) -> int:
+        return sum(index.nbytes for index in self.indexes.values())
+
+    @property
+    def stats(self) -> dict[str, int]:
+        """Counters describing the effectiveness of the index cache"""
+        # Read from other threads, such as the metrics exporter's
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "resident_indexes": len(self.indexes),
+                "resident_bytes": self.resident_bytes,
+                "global_rows": len(self.global_index),
+            }
+
+    def snapshot_path(self, subname: str) -> Path:
+        return self.directory / f"{subname.lower()}{SNAPSHOT_SUFFIX}"
+
+    def get(self, subname: str) -> SubredditIndex:
+        """
+        Gets the index for a subreddit, loading it if necessary
+
+        :param subname: The subreddit to get the index of
+        :type subname: ``str``
+
+        :return: The subreddit's index
+        :rtype: ``SubredditIndex``
+        """
+        if (index := self.indexes.get(subname)) is not None:
+            self.hits += 1
+            self.indexes.move_to_end(subname)
+            if self.shared:
+                self.replay(index)
+            return index
+
+        self.misses += 1
+        index = self.load(subname)
+        self.indexes[subname] = index
+        self.evict(keep=subname)
+        return index
+
+    def evict(self, *, keep: str):
+        """
+        Evicts the least recently used indexes until the budget is satisfied
+
+        Indexes with unsaved rows have their snapshot rewritten before they
+        are evicted, so that reloading them does not require a long replay.
+        A budget of 0 disables eviction.
+
+        :param keep: A subreddit whose index must not be evicted
+        :type keep: ``str``
+        """
+        if (budget := self.memory_budget) <= 0:
+            return
+
+        while self.resident_bytes > budget and len(self.indexes) > 1:
+            subname = next(iter(self.indexes))
+            if subname == keep:
+                self.indexes.move_to_end(subname)
+                continue
+
+            try:
+                self.save(subname)
+            except OSError as e:
+                logger.error(f"Failed to save snapshot for r/{subname}: {e}")
+
+            self.indexes.pop(subname).close()
+            self.evictions += 1
+            logger.debug("Evicted index for r/%s", subname)
+
+    def load(self, subname: str) -> SubredditIndex:
+        """
+        Builds a subreddit's index from its snapshot and the database
+
+        :param subname: The subreddit to load the index of
+        :type subname: ``str``
+
+        :return: The loaded index
+        :rtype: ``SubredditIndex``
+        """
+        started = time.perf_counter()
+        index = SubredditIndex(subname)
+        index.load_snapshot(self.snapshot_path(subname))
+        snapshot_rows = len(index)
+
+        self.replay(index)
+
+        logger.debug(
+            f"Loaded index for r/{subname} ({snapshot_rows} from snapshot, "
+            f"{len(index) - snapshot_rows} replayed) in "
+            f"{time.perf_counter() - started:.2f}s"
+        )
+        return index
+
+    def get_global(self) -> GlobalIndex:
+        """
+        Gets the global index, loading any newly participating subreddits
+
+        Subreddits participate when their config enables `global_matching`.
+        Rows of subreddits that stop participating remain in the index, but
+        are excluded from search results.
+
+        :return: The global index
+        :rtype: ``GlobalIndex``
+        """
+        participants = {
+            subname
+            for subname, config in self.bot.subreddit_configs.items()
+            if config.get("global_matching")
+        }
+        joined = participants - self.global_index.loaded
+        if joined or self.shared:
+            self.load_global(joined)
+        self.global_index.subnames = participants
+        return self.global_index
+
+    def load_global(self, joined: set[str]):
+        """
+        Brings the global index up to date and loads newly joined subreddits
+
+        Rows of already loaded subreddits are replayed from the global index's
+        settled watermark, and every row of the joined subreddits is loaded,
+        both in a single query so that no rows fall between the two.
+
+        :param joined: The subreddits to load in full
+        :type joined: ``set[str]``
+        """
+        started = time.perf_counter()
+        replayed_at = time.monotonic()
+        rows = len(self.global_index)
+
+        with self.bot.reads.connection() as conn:
+            cursor = conn.cursor("load_global_media")
+            cursor.execute(
+                """
+                SELECT
+                    hash, submission_id, subname, COALESCE(created_utc, 0), row_id
+                FROM
+                    media_storage
+                WHERE
+                    (subname=ANY(%s) AND row_id>%s) OR
+                    subname=ANY(%s)
+                """,
+                (
+                    [*self.global_index.loaded],
+                    self.global_index.watermark.settled,
+                    [*joined],
+                ),
+            )
+
+            for image_hash, submission_id, subname, created_utc, row_id in cursor:
+                self.global_index.add(
+                    int(image_hash), submission_id, subname, created_utc, row_id
+                )
+
+            cursor.close()
+
+        self.global_index.loaded |= joined
+        self.global_index.settle(replayed_at)
+
+        if len(self.global_index) > rows:
+            logger.debug(
+                f"Loaded {len(self.global_index) - rows} rows from "
+                f"{len(joined)} new subreddits into the global index in "
+                f"{time.perf_counter() - started:.2f}s"
+            )
+
+    def replay(self, index: SubredditIndex):
+        """
+        Adds every row above the index's settled watermark to the index
+
+        Rows above the settled watermark that the index already contains are
+        skipped, while rows that committed after rows with a higher ID are
+        picked up.
+
+        :param index: The index to bring up to date
+        :type index: ``SubredditIndex``
+        """
+        replayed_at = time.monotonic()
+        # A named cursor keeps a large first-time replay from being buffered
+        # in its entirety on the client
+        with self.bot.reads.connection() as conn:
+            cursor = conn.cursor("replay_media")
+            cursor.execute(
+                """
+                SELECT hash, submission_id, COALESCE(created_utc, 0), row_id FROM
+                    media_storage
+                WHERE
+                    subname=%s AND
+                    row_id>%s
+                ORDER BY row_id
+                """,
+                (index.subname, index.watermark.settled),
+            )
+
+            for image_hash, submission_id, created_utc, row_id in cursor:
+                if not index.contains(row_id):
+                    index.add(
+                        int(image_hash), submission_id, created_utc, row_id
+                    )
+
+            cursor.close()
+
+        index.watermark.mark(replayed_at)
+
+    def add(
+        self,
+        subname: str,
+        image_hash: int,
+        submission_id: str,
+        created_utc: int,
+        row_id: int,
+    ):
+        """
+        Adds a newly inserted row to its subreddit's index, if it is loaded
+
+        Rows that are already in the index are ignored, so rows may safely be
+        delivered more than once, and in any order. Unloaded indexes pick the
+        row up by replaying it when they are loaded.
+        The row is also added to the global index if its subreddit is loaded
+        there. Shared stores replay rather than append, so that rows inserted
+        by other processes are not skipped over by the watermark.
+
+        :param subname: The subreddit the row belongs to
+        :type subname: ``str``
+
+        :param image_hash: The image hash of the row
+        :type image_hash: ``int``
+
+        :param submission_id: The submission ID of the row
+        :type submission_id: ``str``
+
+        :param created_utc: The creation timestamp of the row's post
+        :type created_utc: ``int``
+
+        :param row_id: The `media_storage.row_id` of the row
+        :type row_id: ``int``
+        """
+        with self.lock:
+            if self.shared:
+                if (index := self.indexes.get(subname)) is not None:
+                    self.replay(index)
+                return
+
+            if (
+                index := self.indexes.get(subname)
+            ) is not None and not index.contains(row_id):
+                index.add(image_hash, submission_id, created_utc, row_id)
+
+            if subname in self.global_index.loaded:
+                self.global_index.add(
+                    image_hash, submission_id, subname, created_utc, row_id
+                )
+
+    def refresh(self, subname: str):
+        """
+        Replays a subreddit's index, and the global index if it participates
+
+        :param subname: The subreddit whose rows were inserted
+        :type subname: ``str``
+        """
+        with self.lock:
+            if (index := self.indexes.get(subname)) is not None:
+                self.replay(index)
+            if subname in self.global_index.loaded:
+                self.load_global(set())
+
+    def refresh_all(self):
+        """Replays every loaded index, including the global index"""
+        with self.lock:
+            for index in self.indexes.values():
+                self.replay(index)
+            if self.global_index.loaded:
+                self.load_global(set())
+
+    def invalidate(self, subname: str, *, unlink: bool = True):
+        """
+        Discards a subreddit's index and snapshot after its rows were deleted
+
+        The global index is also discarded if the subreddit participates in
+        it, and is rebuilt the next time it is needed.
+
+        :param subname: The subreddit to invalidate the index of
+        :type subname: ``str``
+
+        :param unlink: Whether to also delete the snapshot, defaults to `True`
+        :type unlink: ``bool``
+        """
+        with self.lock:
+            if (index := self.indexes.pop(subname, None)) is not None:
+                index.close()
+            if unlink:
+                self.snapshot_path(subname).unlink(missing_ok=True)
+
+            if subname in self.global_index.loaded:
+                self.global_index = GlobalIndex()
+
+        logger.debug("Invalidated index for r/%s", subname)
+
+    def save(self, subname: str):
+        """
+        Rewrites a subreddit's snapshot and remaps it as the index's base
+
+        The index is replayed first, so that its settled watermark is as far
+        along as possible and few row IDs have to be written with it.
+
+        :param subname: The subreddit to save the index of
+        :type subname: ``str``
+        """
+        if (index := self.indexes.get(subname)) is None or not index.dirty:
+            return
+
+        self.replay(index)
+        self.indexes[subname] = self.write_snapshot(index)
+
+        logger.debug(
+            f"Saved snapshot for r/{subname} ({len(self.indexes[subname])} rows)"
+        )
+
+    def write_snapshot(self, index: SubredditIndex) -> SubredditIndex:
+        """
+        Writes an index's snapshot, and maps it into a replacement index
+
+        :param index: The index to write the snapshot of
+        :type index: ``SubredditIndex``
+
+        :return: The replacement index, or the index itself if the written
+            snapshot couldn't be mapped
+        :rtype: ``SubredditIndex``
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.snapshot_path(index.subname)
+        index.write_snapshot(path)
+
+        # Swap the written rows out of the heap and into shared pages
+        fresh = SubredditIndex(index.subname)
+        if not fresh.load_snapshot(path):
+            return index
+        # Carries over the replays that haven't settled yet
+        fresh.watermark = index.watermark
+        index.close()
+        return fresh
+
+    def expire(self, subname: str, horizon: int):
+        """
+        Removes the rows of posts created before a horizon from a subreddit's
+        index and snapshot, after they were pruned from the database
+
+        The snapshots of indexes that aren't loaded are rewritten without being
+        replayed. The global index keeps the rows until it is next rebuilt, but
+        `get_matches` never matches them.
+
+        :param subname: The subreddit to expire the rows of
+        :type subname: ``str``
+
+        :param horizon: The earliest creation timestamp to keep
+        :type horizon: ``int``
+        """
+        with self.lock:
+            resident = (index := self.indexes.get(subname)) is not None
+            if index is None:
+                index = SubredditIndex(subname)
+                if not index.load_snapshot(self.snapshot_path(subname)):
+                    return
+
+            kept = index.expire(horizon)
+            index.close()
+            try:
+                kept = self.write_snapshot(kept)
+            except OSError as e:
+                logger.error(f"Failed to save snapshot for r/{subname}: {e}")
+
+            if resident:
+                self.indexes[subname] = kept
+            else:
+                kept.close()
+
+        logger.debug(f"Expired rows created before {horizon} from r/{subname}")
+
+    def save_all(self):
+        """
+        Saves the snapshot of every loaded index with unsaved rows
+
+        The global index is also replayed, so that its settled watermark
+        advances even when its rows are only delivered by notifications.
+        """
+        with self.lock:
+            for subname in [*self.indexes]:
+                try:
+                    self.save(subname)
+                except OSError as e:
+                    logger.error(
+                        f"Failed to save snapshot for r/{subname}: {e}"
+                    )
+            if self.global_index.loaded:
+                self.load_global(set())
+
+        self.last_saved = time.monotonic()
+        logger.debug(f"Saved index snapshots, cache stats: {self.stats}")
+
+    def save_if_due(self):
+        """Saves all snapshots if the configured interval has elapsed"""
+        interval = self.bot.config.get("snapshots", {}).get("interval", 3600)
+        if time.monotonic() - self.last_saved >= interval:
+            self.save_all()
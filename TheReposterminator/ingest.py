@@ -0,0 +1,455 @@
+"""
+TheReposterminator Reddit bot to detect reposts
+Copyright (C) 2023 sardonicism-04
+
+TheReposterminator is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TheReposterminator is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with TheReposterminator.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import gzip
+import io
+import json
+import logging
+import os
+import time
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import IO, TYPE_CHECKING, Any, Iterator, NamedTuple
+
+from image_hash import generate_hash
+
+from .failures import DeferredFailure, PermanentFailure
+from .hosts import MAX_IMAGE_SIZE
+from .notifications import REFRESH_CHANNEL, publish
+
+if TYPE_CHECKING:
+    from TheReposterminator import BotClient
+
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_VERSION = 1
+IMAGE_EXTENSIONS = (".jpg", ".png", ".jpeg")
+# Times a fetch deferred by a busy media host is retried before giving up
+MAX_DEFERRALS = 5
+
+
+class Post(NamedTuple):
+    id: str
+    subname: str
+    url: str
+    created_utc: int
+
+
+class Outcome(NamedTuple):
+    post: Post
+    kind: str  # One of "indexed", "not_image", "skipped", "failed"
+    image_hash: int | None = None
+    permanent: bool = False
+
+
+def parse_post(line: bytes) -> Post | None:
+    """
+    Reads a submission from a line of a dump
+
+    Dumps contain a JSON object per line, with at least the `id`, `subreddit`,
+    `url` and `created_utc` fields of each submission, as written by Pushshift
+    and by `praw`'s `Submission.__dict__`.
+
+    :param line: The line to read
+    :type line: ``bytes``
+
+    :return: The submission, or `None` if it's malformed or a self post
+    :rtype: ``Post | None``
+    """
+    try:
+        data = json.loads(line)
+        if data.get("is_self"):
+            return None
+        return Post(
+            str(data["id"]).removeprefix("t3_"),
+            str(data["subreddit"]),
+            str(data.get("url") or ""),
+            int(float(data["created_utc"])),
+        )
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def open_dump(path: Path) -> IO[bytes]:
+    """Opens a dump for reading, decompressing it if it's gzipped"""
+    if path.suffix == ".gz":
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def find_images(directory: Path) -> dict[str, Path]:
+    """
+    Finds the local images of submissions, named by their submission ID
+
+    :param directory: The directory to search, including its subdirectories
+    :type directory: ``Path``
+
+    :return: The path to the image of each submission ID
+    :rtype: ``dict[str, Path]``
+    """
+    return {
+        path.stem: path
+        for path in directory.rglob("*")
+        if path.suffix.lower() in IMAGE_EXTENSIONS and path.is_file()
+    }
+
+
+class Ingester:
+    """
+    Backfills stored media data from local dumps of subreddit submissions
+
+    Dumps are read in batches. The media of each batch is fetched (or read
+    from a local image directory) and hashed by a pool of threads while the
+    previous batch is bulk-loaded into the database, through `COPY` into a
+    temporary table. Only submissions to subreddits the bot moderates are
+    ingested, and submissions that are already indexed are skipped.
+
+    After each batch is committed, the position in the dump is written to a
+    checkpoint, from which an interrupted ingest resumes.
+
+    Rows are loaded without notifying other processes of each of them.
+    Instead, a single notification per batch asks other processes to bring
+    the indexes of the batch's subreddits up to date from the database.
+    """
+
+    def __init__(
+        self,
+        bot: BotClient,
+        *,
+        images: Path | None = None,
+        fetch: bool = True,
+        workers: int = 16,
+        batch_size: int = 1000,
+        subreddits: list[str] | None = None,
+        checkpoints: Path = Path("checkpoints"),
+    ):
+        self.bot = bot
+        self.images = find_images(images) if images is not None else {}
+        self.fetch = fetch
+        self.workers = workers
+        self.batch_size = batch_size
+        self.checkpoints = checkpoints
+
+        self.subnames = {
+            sub.subname.lower(): sub.subname for sub in bot.subreddits
+        }
+        if subreddits:
+            wanted = {subreddit.lower() for subreddit in subreddits}
+            self.subnames = {
+                name: subname
+                for name, subname in self.subnames.items()
+                if name in wanted
+            }
+
+        self.counts: Counter[str] = Counter()
+        self.touched: set[str] = set()
+
+    def checkpoint_path(self, dump: Path) -> Path:
+        return self.checkpoints / f"{dump.name}.json"
+
+    def read_checkpoint(self, dump: Path) -> dict[str, Any]:
+        """
+        Reads the checkpoint of a dump, if one was written for the same file
+
+        :param dump: The dump to read the checkpoint of
+        :type dump: ``Path``
+
+        :return: The checkpoint, which is empty if there isn't one
+        :rtype: ``dict[str, Any]``
+        """
+        try:
+            checkpoint = json.loads(self.checkpoint_path(dump).read_text())
+        except (OSError, ValueError):
+            return {}
+
+        if (
+            checkpoint.get("version") != CHECKPOINT_VERSION
+            or checkpoint.get("path") != str(dump.resolve())
+            or checkpoint.get("size") != dump.stat().st_size
+        ):
+            logger.warning(f"⚠️ Ignoring stale checkpoint for {dump}")
+            return {}
+        return checkpoint
+
+    def write_checkpoint(
+        self, dump: Path, offset: int, counts: Counter[str], *, complete=False
+    ):
+        """Atomically replaces the checkpoint of a dump"""
+        self.checkpoints.mkdir(parents=True, exist_ok=True)
+        path = self.checkpoint_path(dump)
+        temporary = path.with_suffix(".tmp")
+        temporary.write_text(
+            json.dumps(
+                {
+                    "version": CHECKPOINT_VERSION,
+                    "path": str(dump.resolve()),
+                    "size": dump.stat().st_size,
+                    "offset": offset,
+                    "counts": counts,
+                    "complete": complete,
+                }
+            )
+        )
+        os.replace(temporary, path)
+
+    def batches(
+        self, file: IO[bytes], offset: int
+    ) -> Iterator[tuple[list[Post], int, Counter[str]]]:
+        """
+        Reads the ingestible submissions of a dump in batches
+
+        :param file: The opened dump
+        :type file: ``IO[bytes]``
+
+        :param offset: The offset in the dump to start reading from
+        :type offset: ``int``
+
+        :return: Each batch, the offset in the dump following it, and the
+            number of lines it passed over for each reason
+        :rtype: ``Iterator[tuple[list[Post], int, Counter[str]]]``
+        """
+        file.seek(offset)
+        batch: list[Post] = []
+        passed: Counter[str] = Counter()
+        for line in file:
+            offset += len(line)
+            if (post := parse_post(line)) is None:
+                passed["skipped"] += 1
+            elif (subname := self.subnames.get(post.subname.lower())) is None:
+                passed["other_subreddit"] += 1
+            else:
+                batch.append(post._replace(subname=subname))
+
+            if len(batch) >= self.batch_size:
+                yield batch, offset, passed
+                batch, passed = [], Counter()
+        yield batch, offset, passed
+
+    def unindexed(self, posts: list[Post]) -> list[Post]:
+        """Filters out the submissions that have already been indexed"""
+        with self.bot.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                "SELECT id FROM indexed_submissions WHERE id=ANY(%s)",
+                ([post.id for post in posts],),
+            )
+            indexed = {row[0] for row in cur.fetchall()}
+        return [post for post in posts if post.id not in indexed]
+
+    def read_media(self, post: Post) -> bytes | None:
+        """
+        Reads a submission's media from the local images, or fetches it
+
+        :param post: The submission to read the media of
+        :type post: ``Post``
+
+        :return: The media, or `None` if it isn't an image
+        :rtype: ``bytes | None``
+
+        :raises PermanentFailure: If the media is gone, or excessively large
+        :raises TransientFailure: If the media couldn't be fetched right now
+        """
+        if (path := self.images.get(post.id)) is not None:
+            if path.stat().st_size >= MAX_IMAGE_SIZE:
+                raise PermanentFailure("Image is excessively large")
+            return path.read_bytes()
+
+        url = post.url.replace("m.imgur.com", "i.imgur.com")
+        if not any(ext in url for ext in IMAGE_EXTENSIONS):
+            return None
+
+        for _ in range(MAX_DEFERRALS):
+            try:
+                return self.bot.hosts.fetch(url)
+            except DeferredFailure as e:
+                time.sleep(e.retry_in)
+        return self.bot.hosts.fetch(url)
+
+    def hash_post(self, post: Post) -> Outcome:
+        """
+        Hashes the media of a submission
+
+        Runs on the ingest's thread pool.
+
+        :param post: The submission to hash
+        :type post: ``Post``
+
+        :return: The outcome of hashing the submission
+        :rtype: ``Outcome``
+        """
+        if not self.fetch and post.id not in self.images:
+            return Outcome(post, "skipped")
+
+        try:
+            if (media := self.read_media(post)) is None:
+                return Outcome(post, "not_image")
+            if (image_hash := generate_hash(media)) == 0:
+                raise PermanentFailure("Undecodable image")
+        except PermanentFailure as e:
+            logger.debug("Failed to hash %s: %s", post.id, e)
+            return Outcome(post, "failed", permanent=True)
+        except Exception as e:
+            logger.debug("Failed to hash %s: %s", post.id, e)
+            return Outcome(post, "failed")
+        return Outcome(post, "indexed", image_hash)
+
+    def load(self, outcomes: list[Outcome]):
+        """
+        Bulk-loads a batch of hashed submissions into the database
+
+        Submissions whose media was stored, that aren't images, or that can
+        never be processed are marked as indexed, like they would be when
+        handled by the `Sentry`.
+
+        :param outcomes: The outcomes of the batch
+        :type outcomes: ``list[Outcome]``
+        """
+        buffer = io.StringIO()
+        for outcome in outcomes:
+            if outcome.kind == "skipped" or (
+                outcome.kind == "failed" and not outcome.permanent
+            ):
+                continue
+            post = outcome.post
+            image_hash = outcome.image_hash
+            if image_hash is None:
+                image_hash = "\\N"  # NULL, for submissions without media
+            buffer.write(
+                f"{image_hash}\t{post.id}\t{post.subname}\t{post.created_utc}\n"
+            )
+        if not buffer.tell():
+            return
+        buffer.seek(0)
+
+        with self.bot.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                """
+                CREATE TEMPORARY TABLE IF NOT EXISTS ingest_media (
+                    hash          VARCHAR(32),
+                    submission_id VARCHAR(10),
+                    subname       VARCHAR(21),
+                    created_utc   BIGINT
+                ) ON COMMIT DELETE ROWS
+                """
+            )
+            cur.copy_from(buffer, "ingest_media")
+
+            # Other processes are notified once for the whole batch instead
+            cur.execute("SET LOCAL rterm.bulk_load = 'on'")
+            cur.execute(
+                """
+                INSERT INTO media_storage
+                    (hash, submission_id, subname, created_utc)
+                SELECT hash, submission_id, subname, created_utc FROM
+                    ingest_media
+                WHERE hash IS NOT NULL
+                ON CONFLICT DO NOTHING
+                """
+            )
+            cur.execute(
+                """
+                INSERT INTO indexed_submissions (id)
+                SELECT DISTINCT submission_id FROM ingest_media
+                ON CONFLICT DO NOTHING
+                """
+            )
+
+        subnames = {
+            outcome.post.subname
+            for outcome in outcomes
+            if outcome.image_hash is not None
+        }
+        for subname in subnames:
+            publish(self.bot, REFRESH_CHANNEL, subname)
+        self.touched |= subnames
+
+    def ingest(self, dump: Path, *, restart: bool = False):
+        """
+        Ingests a dump, resuming from its checkpoint
+
+        :param dump: The dump to ingest
+        :type dump: ``Path``
+
+        :param restart: Whether to ignore the dump's checkpoint
+        :type restart: ``bool``
+        """
+        checkpoint = {} if restart else self.read_checkpoint(dump)
+        if checkpoint.get("complete"):
+            logger.info(f"Skipping {dump}, which has already been ingested")
+            return
+
+        offset = checkpoint.get("offset", 0)
+        self.counts = Counter(checkpoint.get("counts", {}))
+        if offset:
+            logger.info(f"Resuming {dump} from byte {offset}")
+
+        started = time.monotonic()
+        handled = sum(self.counts.values())
+
+        def commit(
+            futures: list[Future[Outcome]], end: int, passed: Counter[str]
+        ):
+            outcomes = [future.result() for future in futures]
+            self.load(outcomes)
+            self.counts.update(passed)
+            self.counts.update(outcome.kind for outcome in outcomes)
+            self.write_checkpoint(dump, end, self.counts)
+
+            rate = (sum(self.counts.values()) - handled) / max(
+                time.monotonic() - started, 1e-9
+            )
+            logger.info(
+                f"{dump.name}: {self.counts['indexed']} indexed, "
+                f"{self.counts['failed']} failed ({rate:.0f} posts/s)"
+            )
+
+        with (
+            open_dump(dump) as file,
+            ThreadPoolExecutor(self.workers, "ingest") as executor,
+        ):
+            # Each batch is hashed while the previous one is being loaded
+            pending: tuple[list[Future[Outcome]], int, Counter[str]] | None
+            pending = None
+            for batch, end, passed in self.batches(file, offset):
+                posts = self.unindexed(batch) if batch else []
+                passed["already_indexed"] += len(batch) - len(posts)
+                futures = [executor.submit(self.hash_post, post) for post in posts]
+                if pending is not None:
+                    commit(*pending)
+                pending = (futures, end, passed)
+
+            if pending is not None:
+                commit(*pending)
+
+        self.write_checkpoint(dump, end, self.counts, complete=True)
+        logger.info(f"✅ Finished ingesting {dump}: {dict(self.counts)}")
+
+    def save_snapshots(self):
+        """
+        Rebuilds the snapshots of the subreddits that rows were loaded for
+
+        Otherwise, the bot would replay every ingested row from the database
+        the next time it loads their indexes.
+        """
+        with self.bot.index.lock:
+            for subname in sorted(self.touched):
+                self.bot.index.get(subname)
+                self.bot.index.save(subname)
+                logger.info(f"Saved snapshot for r/{subname}")
@@ -22,7 +22,7 @@ import operator
 from datetime import datetime
 from typing import TYPE_CHECKING, cast
 
-from .common import get_matches
+from .common import annotate_title, get_matches
 from .types import Match, MediaData, SubData
 
 if TYPE_CHECKING:
@@ -95,15 +95,9 @@ class Interactive:
 
         # Depends upon the fact that any submission which is being requested has
         # already been scanned and indexed
-        cur = self.bot.db.cursor()
-        cur.execute(
-            "SELECT * FROM media_storage WHERE submission_id=%s", (submission.id,)
-        )
-        if not (data := cur.fetchone()):
+        if not (data := self.fetch_media_data(submission)):
             return
             # TODO: Make this more informative on front end
-        cur.close()
-        self.bot.db.commit()
 
         parent_data = MediaData(*data)
         if matches := [
@@ -124,6 +118,40 @@ class Interactive:
                 f"Unique - Requested by user"
             )
 
+    def fetch_media_data(self, submission: Submission) -> tuple | None:
+        """
+        Looks up the stored media data of a submission
+
+        The lookup is routed to the replica database when it is fresh enough.
+        If the replica doesn't have the submission, the primary is checked, in
+        case the submission was indexed too recently to have been replicated.
+
+        :param submission: The submission to look up
+        :type submission: ``Submission``
+
+        :return: The stored row if found, `None` if not found
+        :rtype: ``tuple | None``
+        """
+        for primary in (False, True):
+            with self.bot.reads.connection(primary=primary) as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        """
+                        SELECT
+                            hash, submission_id, subname, COALESCE(created_utc, 0)
+                        FROM
+                            media_storage
+                        WHERE
+                            subname=%s AND
+                            submission_id=%s
+                        """,
+                        (str(submission.subreddit), submission.id),
+                    )
+                    if data := cur.fetchone():
+                        return data
+
+        return None
+
     def do_response(
         self, *, message: Message, submission: Submission, matches: list[Match]
     ):
@@ -161,7 +189,7 @@ class Interactive:
             row = self.bot.config["templates"]["row_mentioned"].format(
                 created_at.strftime("%a, %b %d, %Y at %H:%M:%S UTC"),
                 f"[URL]({post.url})" if post.url else "No URL",
-                post.title,
+                annotate_title(post.title, match, submission),
                 post.id,
                 cur_status,
                 match.similarity,
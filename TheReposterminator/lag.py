@@ -0,0 +1,257 @@
+"""
+TheReposterminator Reddit bot to detect reposts
+Copyright (C) 2023 sardonicism-04
+
+TheReposterminator is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TheReposterminator is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with TheReposterminator.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import logging
+import time
+from typing import TYPE_CHECKING, NamedTuple
+
+if TYPE_CHECKING:
+    import psycopg2
+
+    from TheReposterminator import BotClient
+    from TheReposterminator.types import LagConfig
+
+
+logger = logging.getLogger(__name__)
+
+PERCENTILES = (0.5, 0.95, 0.99)
+# The stages of detection, each measured from the post's creation
+STAGES = ("seen", "hashed", "reported")
+
+
+class LagPercentiles(NamedTuple):
+    subname: str
+    submissions: int
+    reported: int
+    # p50, p95 and p99 of each stage, or `None` if there is no data
+    seen: tuple[float, ...] | None
+    hashed: tuple[float, ...] | None
+    reports: tuple[float, ...] | None
+
+
+def format_duration(seconds: float | None) -> str:
+    """
+    Formats a duration compactly, i.e. `42s`, `3.5m` or `1.2h`
+
+    :param seconds: The duration in seconds, or `None`
+    :type seconds: ``float | None``
+
+    :return: The formatted duration, or `-` if there is none
+    :rtype: ``str``
+    """
+    if seconds is None:
+        return "-"
+    if seconds < 60:
+        return f"{seconds:.0f}s"
+    if seconds < 3600:
+        return f"{seconds / 60:.1f}m"
+    return f"{seconds / 3600:.1f}h"
+
+
+class LagTracker:
+    """
+    Records how long reposts take to be detected and reported
+
+    For each submission handled by a scan, the time it was first seen by the
+    bot and the time its hash was computed are stored in `detection_lag`
+    along with its creation time. If it is reported, the time the report was
+    actually made on Reddit is filled in by the `ActionQueue`.
+
+    Submissions handled while initially indexing a subreddit are not
+    recorded, as they are far older than the bot's presence.
+    """
+
+    def __init__(self, bot: BotClient):
+        self.bot = bot
+
+    @property
+    def config(self) -> LagConfig:
+        return self.bot.config.get("lag", {})
+
+    def record(
+        self,
+        cur: psycopg2.cursor,
+        *,
+        submission_id: str,
+        subname: str,
+        created_utc: int,
+        first_seen: float,
+        hashed_at: float,
+    ):
+        """
+        Records the detection of a submission
+
+        :param cur: The cursor of the transaction storing the submission
+        :type cur: ``psycopg2.cursor``
+
+        :param submission_id: The ID of the submission
+        :type submission_id: ``str``
+
+        :param subname: The subreddit the submission was posted to
+        :type subname: ``str``
+
+        :param created_utc: The creation timestamp of the submission
+        :type created_utc: ``int``
+
+        :param first_seen: When the bot first saw the submission
+        :type first_seen: ``float``
+
+        :param hashed_at: When the submission's hash was computed
+        :type hashed_at: ``float``
+        """
+        cur.execute(
+            """
+            INSERT INTO detection_lag
+                (submission_id, subname, created_utc, first_seen_at, hashed_at)
+            VALUES(%s, %s, %s, %s, %s)
+            ON CONFLICT DO NOTHING""",
+            (submission_id, subname, created_utc, first_seen, hashed_at),
+        )
+
+        metrics = self.bot.metrics
+        metrics.detection_lag_seconds.observe(
+            first_seen - created_utc, stage="seen"
+        )
+        metrics.detection_lag_seconds.observe(
+            hashed_at - created_utc, stage="hashed"
+        )
+
+    def record_report(self, submission_id: str):
+        """
+        Records that a submission's report was made on Reddit
+
+        :param submission_id: The ID of the reported submission
+        :type submission_id: ``str``
+        """
+        with self.bot.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                """
+                UPDATE detection_lag
+                SET reported_at=%s
+                WHERE submission_id=%s AND reported_at IS NULL
+                RETURNING reported_at - created_utc""",
+                (time.time(), submission_id),
+            )
+            if (row := cur.fetchone()) is not None:
+                self.bot.metrics.detection_lag_seconds.observe(
+                    row[0], stage="reported"
+                )
+
+    def percentiles(
+        self, *, days: int = 7, subname: str | None = None
+    ) -> list[LagPercentiles]:
+        """
+        Calculates detection lag percentiles per subreddit
+
+        :param days: How many days of submissions to include, defaults to `7`
+        :type days: ``int``
+
+        :param subname: A single subreddit to include, defaults to all
+        :type subname: ``str | None``
+
+        :return: The percentiles of each subreddit
+        :rtype: ``list[LagPercentiles]``
+        """
+        with self.bot.reads.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT
+                    subname,
+                    COUNT(*),
+                    COUNT(reported_at),
+                    percentile_cont(%(percentiles)s)
+                        WITHIN GROUP (ORDER BY first_seen_at - created_utc),
+                    percentile_cont(%(percentiles)s)
+                        WITHIN GROUP (ORDER BY hashed_at - created_utc),
+                    percentile_cont(%(percentiles)s)
+                        WITHIN GROUP (ORDER BY reported_at - created_utc)
+                        FILTER (WHERE reported_at IS NOT NULL)
+                FROM
+                    detection_lag
+                WHERE
+                    first_seen_at > %(since)s AND
+                    (%(subname)s IS NULL OR LOWER(subname)=LOWER(%(subname)s))
+                GROUP BY subname
+                ORDER BY subname
+                """,
+                {
+                    "percentiles": [*PERCENTILES],
+                    "since": time.time() - days * 86_400,
+                    "subname": subname,
+                },
+            )
+            return [
+                LagPercentiles(
+                    name,
+                    submissions,
+                    reported,
+                    *(None if p is None else tuple(p) for p in stages),
+                )
+                for name, submissions, reported, *stages in cur.fetchall()
+            ]
+
+    def report(self, *, days: int = 7, subname: str | None = None) -> str:
+        """
+        Formats detection lag percentiles as a table
+
+        :param days: How many days of submissions to include, defaults to `7`
+        :type days: ``int``
+
+        :param subname: A single subreddit to include, defaults to all
+        :type subname: ``str | None``
+
+        :return: The formatted table
+        :rtype: ``str``
+        """
+        header = ["subreddit", "posts", "reported"] + [
+            f"{stage} p{round(p * 100)}" for stage in STAGES for p in PERCENTILES
+        ]
+        rows = [header]
+        for lag in self.percentiles(days=days, subname=subname):
+            row = [f"r/{lag.subname}", str(lag.submissions), str(lag.reported)]
+            for stage in (lag.seen, lag.hashed, lag.reports):
+                row += [
+                    format_duration(None if stage is None else stage[i])
+                    for i in range(len(PERCENTILES))
+                ]
+            rows.append(row)
+
+        if len(rows) == 1:
+            return f"No submissions were handled in the last {days} days"
+
+        widths = [max(map(len, column)) for column in zip(*rows)]
+        return "\n".join(
+            "  ".join(cell.rjust(width) for cell, width in zip(row, widths))
+            for row in rows
+        )
+
+    def prune(self, days: int):
+        """
+        Deletes detection records older than a number of days
+
+        :param days: The number of days to keep records for
+        :type days: ``int``
+        """
+        with self.bot.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                "DELETE FROM detection_lag WHERE first_seen_at < %s",
+                (time.time() - days * 86_400,),
+            )
+            if cur.rowcount:
+                logger.info(f"✅ Pruned {cur.rowcount} detection lag records")
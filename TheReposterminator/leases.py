@@ -0,0 +1,220 @@
+"""
+TheReposterminator Reddit bot to detect reposts
+Copyright (C) 2023 sardonicism-04
+
+TheReposterminator is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TheReposterminator is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with TheReposterminator.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import logging
+import math
+import threading
+import time
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from TheReposterminator import BotClient
+
+
+logger = logging.getLogger(__name__)
+
+# The lease resource that elects the worker responsible for the inbox. The
+# asterisk keeps it from colliding with any subreddit name.
+INBOX_RESOURCE = "*inbox"
+
+
+class LeaseManager:
+    """
+    Distributes subreddits between several bot processes sharing a database
+
+    Each worker heartbeats into the `workers` table, and holds time-limited
+    leases in the `worker_leases` table for the subreddits it scans. Every
+    refresh, a worker renews its leases, releases any above its fair share of
+    the subreddits, and claims unleased or expired subreddits up to its fair
+    share, so subreddits are rebalanced automatically as workers join or die.
+    Newly claimed subreddits are loaded, along with their configs, if the
+    worker doesn't know of them yet.
+
+    The inbox is leased the same way, and is held by exactly one worker.
+    """
+
+    def __init__(self, bot: BotClient, worker_id: str, *, lease_ttl: int = 60):
+        self.bot = bot
+        self.worker_id = worker_id
+        self.lease_ttl = lease_ttl
+
+        self.owned: set[str] = set()
+        self.leader = False
+        self.last_refresh = 0.0
+        self.lock = threading.Lock()
+
+    def refresh_if_due(self):
+        """Refreshes the worker's leases if a third of their TTL has elapsed"""
+        if time.monotonic() - self.last_refresh < self.lease_ttl / 3:
+            return
+        # Scans renew leases from several threads, only one of which needs to
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            if time.monotonic() - self.last_refresh >= self.lease_ttl / 3:
+                self.refresh()
+        finally:
+            self.lock.release()
+
+    def holds(self, subname: str) -> bool:
+        """
+        Whether the worker still leases a subreddit
+
+        Leases are renewed first if they are due, so that a scan which checks
+        this as it goes keeps its subreddit for as long as it runs.
+
+        :param subname: The subreddit to check
+        :type subname: ``str``
+
+        :return: Whether the subreddit is leased to this worker
+        :rtype: ``bool``
+        """
+        self.refresh_if_due()
+        return subname in self.owned
+
+    def refresh(self):
+        """
+        Heartbeats, then renews, releases, and claims leases
+
+        All steps take place in a single transaction.
+        """
+        self.last_refresh = time.monotonic()
+        ttl = f"{self.lease_ttl} seconds"
+
+        with self.bot.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO workers (id, heartbeat)
+                VALUES(%s, NOW())
+                ON CONFLICT (id) DO UPDATE SET heartbeat=NOW()""",
+                (self.worker_id,),
+            )
+            cur.execute(
+                """
+                DELETE FROM workers WHERE heartbeat < NOW() - %s::interval""",
+                (ttl,),
+            )
+            cur.execute(
+                """
+                DELETE FROM worker_leases
+                WHERE
+                    resource<>%s AND
+                    resource NOT IN (SELECT name FROM subreddits)""",
+                (INBOX_RESOURCE,),
+            )
+
+            cur.execute("SELECT COUNT(*) FROM workers")
+            (workers,) = cur.fetchone() or (1,)
+            cur.execute("SELECT COUNT(*) FROM subreddits")
+            (subreddits,) = cur.fetchone() or (0,)
+            share = math.ceil(subreddits / max(workers, 1))
+
+            # Renew held leases
+            cur.execute(
+                """
+                UPDATE worker_leases
+                SET expires_at=NOW() + %s::interval
+                WHERE worker_id=%s AND resource<>%s
+                RETURNING resource""",
+                (ttl, self.worker_id, INBOX_RESOURCE),
+            )
+            owned = {row[0] for row in cur.fetchall()}
+
+            # Release any leases above the fair share
+            if len(owned) > share:
+                excess = sorted(owned)[share:]
+                cur.execute(
+                    """
+                    DELETE FROM worker_leases
+                    WHERE worker_id=%s AND resource=ANY(%s)""",
+                    (self.worker_id, excess),
+                )
+                owned -= set(excess)
+
+            # Claim unleased or expired subreddits up to the fair share
+            if len(owned) < share:
+                cur.execute(
+                    """
+                    INSERT INTO worker_leases (resource, worker_id, expires_at)
+                    SELECT name, %s, NOW() + %s::interval
+                    FROM subreddits
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM worker_leases
+                        WHERE resource=name AND expires_at > NOW()
+                    )
+                    ORDER BY random()
+                    LIMIT %s
+                    ON CONFLICT (resource) DO UPDATE
+                        SET worker_id=EXCLUDED.worker_id,
+                            expires_at=EXCLUDED.expires_at
+                        WHERE worker_leases.expires_at <= NOW()
+                    RETURNING resource""",
+                    (self.worker_id, ttl, share - len(owned)),
+                )
+                owned |= {row[0] for row in cur.fetchall()}
+
+            # Claim or renew the inbox
+            cur.execute(
+                """
+                INSERT INTO worker_leases (resource, worker_id, expires_at)
+                VALUES(%s, %s, NOW() + %s::interval)
+                ON CONFLICT (resource) DO UPDATE
+                    SET worker_id=EXCLUDED.worker_id,
+                        expires_at=EXCLUDED.expires_at
+                    WHERE
+                        worker_leases.worker_id=EXCLUDED.worker_id OR
+                        worker_leases.expires_at <= NOW()
+                RETURNING resource""",
+                (INBOX_RESOURCE, self.worker_id, ttl),
+            )
+            leader = cur.fetchone() is not None
+
+        if owned != self.owned:
+            logger.info(
+                f"✅ Worker {self.worker_id} now leases {len(owned)} of "
+                f"{subreddits} subreddits across {workers} workers"
+            )
+        if leader != self.leader:
+            logger.info(
+                f"✅ Worker {self.worker_id} "
+                f"{'is now' if leader else 'is no longer'} the inbox leader"
+            )
+
+        # Subreddits may have been claimed before this worker heard of them
+        claimed = owned - self.owned
+        if claimed - {sub.subname for sub in self.bot.subreddits}:
+            self.bot.update_subs()
+        for subname in claimed:
+            if subname not in self.bot.subreddit_configs:
+                self.bot.get_config(subname)
+
+        self.owned = owned
+        self.leader = leader
+
+    def release(self):
+        """Releases every lease held by the worker, and deregisters it"""
+        with self.bot.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                "DELETE FROM worker_leases WHERE worker_id=%s", (self.worker_id,)
+            )
+            cur.execute("DELETE FROM workers WHERE id=%s", (self.worker_id,))
+
+        self.owned.clear()
+        self.leader = False
+        logger.info(f"Released leases of worker {self.worker_id}")
@@ -0,0 +1,595 @@
+"""
+TheReposterminator Reddit bot to detect reposts
+Copyright (C) 2023 sardonicism-04
+
+TheReposterminator is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TheReposterminator is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with TheReposterminator.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import functools
+import json
+import logging
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import TYPE_CHECKING, Any
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+from .bench import max_rss_kib, png
+
+if TYPE_CHECKING:
+    from TheReposterminator import BotClient
+
+
+logger = logging.getLogger(__name__)
+
+SUBREDDIT_PREFIX = "loadgen_"
+AUTHOR = "loadgen_user"
+
+# Reddit API paths answered by the fake, matched against the request path
+ROUTES = (
+    ("POST", re.compile(r"^/api/v1/access_token$"), "access_token"),
+    ("GET", re.compile(r"^/r/(?P<subname>[^/]+)/new$"), "new"),
+    ("GET", re.compile(r"^/api/info$"), "info"),
+    ("GET", re.compile(r"^/comments/(?P<id>[^/]+)"), "comments"),
+    ("GET", re.compile(r"^/message/unread$"), "unread"),
+    ("GET", re.compile(r"^/r/[^/]+/wiki/[^/]+$"), "wiki"),
+    ("GET", re.compile(r"^/r/[^/]+/about/moderators$"), "moderators"),
+    ("GET", re.compile(r"^/r/[^/]+/about/log$"), "listing"),
+    ("POST", re.compile(r"^/api/comment$"), "comment"),
+    ("POST", re.compile(r"^/api/report$"), "report"),
+    ("POST", re.compile(r"^/api/"), "ok"),
+)
+
+
+def parse_size(value: str) -> tuple[int, int, float]:
+    """
+    Parses an image size, with an optional weight
+
+    :param value: The size, i.e. `1280x720` or `1280x720:3`
+    :type value: ``str``
+
+    :return: The width, height and weight of the size
+    :rtype: ``tuple[int, int, float]``
+    """
+    size, _, weight = value.partition(":")
+    width, _, height = size.lower().partition("x")
+    return int(width), int(height), float(weight or 1)
+
+
+@functools.lru_cache(maxsize=512)
+def render_image(seed: int, width: int, height: int) -> bytes:
+    """
+    Renders a synthetic image as a PNG
+
+    The image is an 8x8 grid of random colours, so images with different
+    seeds have unrelated difference hashes, and an image has the same hash
+    at every size.
+
+    :param seed: The seed of the colours
+    :type seed: ``int``
+
+    :param width: The width of the image
+    :type width: ``int``
+
+    :param height: The height of the image
+    :type height: ``int``
+
+    :return: The encoded image
+    :rtype: ``bytes``
+    """
+    rng = random.Random(seed)
+    grid = [[rng.randbytes(3) for _ in range(8)] for _ in range(8)]
+    # Every row within a band of the grid is identical
+    bands = [
+        b"".join(cells[x * 8 // width] for x in range(width)) for cells in grid
+    ]
+    return png(width, height, (bands[y * 8 // height] for y in range(height)))
+
+
+class Post:
+    def __init__(
+        self,
+        id: str,
+        subname: str,
+        created_utc: float,
+        image: tuple[int, int, int],
+        repost_of: str | None,
+    ):
+        self.id = id
+        self.subname = subname
+        self.created_utc = created_utc
+        self.image = image  # The seed, width and height of its image
+        self.repost_of = repost_of
+
+
+class FakeSubreddit:
+    """A subreddit whose posts arrive as a Poisson process"""
+
+    def __init__(self, name: str, rate: float, rng: random.Random):
+        self.name = name
+        self.rate = rate
+        self.rng = rng
+        self.posts: list[Post] = []
+        self.next_at = time.time() + rng.expovariate(rate)
+
+
+class LoadGenerator:
+    """
+    Simulates many busy subreddits for the bot to moderate
+
+    Mounted as the bot's `transport`, it answers the bot's Reddit API
+    requests from an in-memory fake. Each subreddit's posts arrive as a
+    Poisson process at the configured rate, and link to images served by a
+    local HTTP server, which the bot fetches through its usual media session.
+    A configurable fraction of posts reuse the image of an earlier post in
+    the same subreddit, and so should be reported as reposts. Username
+    mentions of the bot arrive in its inbox at their own rate.
+
+    The bot itself runs unmodified. While it runs, throughput, backlog (posts
+    that have been made but not yet handled) and resource usage are sampled.
+    """
+
+    def __init__(
+        self,
+        *,
+        subreddits: int,
+        rate: float,
+        repost_ratio: float,
+        sizes: list[tuple[int, int, float]],
+        mention_rate: float = 0,
+        seed: int = 0,
+    ):
+        self.rng = random.Random(seed)
+        self.repost_ratio = repost_ratio
+        self.sizes = sizes
+        self.mention_rate = mention_rate
+
+        names = [f"{SUBREDDIT_PREFIX}{i:03}" for i in range(subreddits)]
+        self.subreddits = {
+            name: FakeSubreddit(name, rate / 60, random.Random(f"{seed}:{name}"))
+            for name in names
+        }
+        self.posts: dict[str, Post] = {}
+        self.mentions: list[dict[str, Any]] = []
+        self.next_mention_at = time.time() + self._mention_delay()
+
+        self.lock = threading.Lock()
+        self.next_id = 0
+        self.next_seed = seed * 1_000_000
+
+        self.reported: set[str] = set()
+        self.replies = 0
+
+        self.bot: BotClient | None = None
+        self.server: ThreadingHTTPServer | None = None
+        self.sampler: threading.Thread | None = None
+        self.stopped = threading.Event()
+        self.started = time.monotonic()
+        self.samples: list[dict[str, Any]] = []
+
+    # Simulation
+
+    def _mention_delay(self) -> float:
+        if self.mention_rate <= 0:
+            return float("inf")
+        return self.rng.expovariate(self.mention_rate / 60)
+
+    def advance(self, subreddit: FakeSubreddit):
+        """Makes every post that has arrived in a subreddit by now"""
+        now = time.time()
+        while subreddit.next_at <= now:
+            self.next_id += 1
+            post_id = f"lg{self.next_id:x}"
+
+            if subreddit.posts and subreddit.rng.random() < self.repost_ratio:
+                original = subreddit.rng.choice(subreddit.posts)
+                post = Post(
+                    post_id,
+                    subreddit.name,
+                    subreddit.next_at,
+                    original.image,
+                    original.id,
+                )
+            else:
+                self.next_seed += 1
+                width, height, _ = subreddit.rng.choices(
+                    self.sizes, weights=[size[2] for size in self.sizes]
+                )[0]
+                post = Post(
+                    post_id,
+                    subreddit.name,
+                    subreddit.next_at,
+                    (self.next_seed, width, height),
+                    None,
+                )
+
+            subreddit.posts.append(post)
+            self.posts[post_id] = post
+            subreddit.next_at += subreddit.rng.expovariate(subreddit.rate)
+
+    def advance_mentions(self):
+        """Makes every username mention that has arrived by now"""
+        now = time.time()
+        while self.next_mention_at <= now:
+            self.next_mention_at += self._mention_delay()
+            if not self.posts or self.bot is None:
+                continue
+            post = self.rng.choice([*self.posts.values()])
+            self.next_id += 1
+            self.mentions.append(
+                {
+                    "kind": "t1",
+                    "data": {
+                        **self.comment_data(f"lg{self.next_id:x}", post),
+                        "body": f"u/{self.bot.config['reddit']['username']}",
+                        "subject": "username mention",
+                        "was_comment": True,
+                        "new": True,
+                    },
+                }
+            )
+
+    # Fake Reddit
+
+    def mount(self, session: requests.Session):
+        # Media is served over plain HTTP, by the real image server
+        session.mount("https://", FakeRedditAdapter(self))
+
+    def post_data(self, post: Post) -> dict[str, Any]:
+        seed, width, height = post.image
+        assert self.server is not None
+        host, port = self.server.server_address[:2]
+        return {
+            "id": post.id,
+            "name": f"t3_{post.id}",
+            "title": f"Post {post.id}",
+            "url": f"http://{host}:{port}/{seed}/{width}x{height}.png",
+            "domain": f"{host}:{port}",
+            "is_self": False,
+            "subreddit": post.subname,
+            "subreddit_name_prefixed": f"r/{post.subname}",
+            "author": AUTHOR,
+            "created_utc": post.created_utc,
+            "score": 1,
+            "removed": False,
+            "over_18": False,
+            "num_comments": 0,
+            "permalink": f"/r/{post.subname}/comments/{post.id}/_/",
+        }
+
+    def comment_data(self, comment_id: str, post: Post) -> dict[str, Any]:
+        return {
+            "id": comment_id,
+            "name": f"t1_{comment_id}",
+            "body": "",
+            "author": AUTHOR,
+            "subreddit": post.subname,
+            "link_id": f"t3_{post.id}",
+            "parent_id": f"t3_{post.id}",
+            "created_utc": time.time(),
+            "context": f"/r/{post.subname}/comments/{post.id}/_/{comment_id}/",
+        }
+
+    @staticmethod
+    def listing(children: list[dict[str, Any]]) -> dict[str, Any]:
+        return {
+            "kind": "Listing",
+            "data": {
+                "children": children,
+                "after": None,
+                "before": None,
+                "dist": len(children),
+            },
+        }
+
+    def respond(self, request: requests.PreparedRequest) -> tuple[int, Any]:
+        """
+        Answers a Reddit API request
+
+        :param request: The request to answer
+        :type request: ``requests.PreparedRequest``
+
+        :return: The status code and JSON body of the response
+        :rtype: ``tuple[int, Any]``
+        """
+        parts = urlsplit(request.url or "")
+        path = parts.path.rstrip("/")
+        query = {key: values[-1] for key, values in parse_qs(parts.query).items()}
+        body = request.body or ""
+        form = {
+            key: values[-1]
+            for key, values in parse_qs(
+                body.decode() if isinstance(body, bytes) else body
+            ).items()
+        }
+
+        for method, pattern, route in ROUTES:
+            if request.method == method and (found := pattern.match(path)):
+                break
+        else:
+            return 404, {"message": "Not Found", "error": 404}
+
+        with self.lock:
+            match route:
+                case "access_token":
+                    return 200, {
+                        "access_token": "loadgen",
+                        "token_type": "bearer",
+                        "expires_in": 86_400,
+                        "scope": "*",
+                    }
+
+                case "new":
+                    if (sub := self.subreddits.get(found["subname"])) is None:
+                        return 404, {"message": "Not Found", "error": 404}
+                    self.advance(sub)
+                    limit = int(query.get("limit", 100))
+                    return 200, self.listing(
+                        [
+                            {"kind": "t3", "data": self.post_data(post)}
+                            for post in reversed(sub.posts[-limit:])
+                        ]
+                    )
+
+                case "info":
+                    fullnames = query.get("id", "").split(",")
+                    return 200, self.listing(
+                        [
+                            {"kind": "t3", "data": self.post_data(post)}
+                            for name in fullnames
+                            if (post := self.posts.get(name[3:])) is not None
+                        ]
+                    )
+
+                case "comments":
+                    if (post := self.posts.get(found["id"])) is None:
+                        return 404, {"message": "Not Found", "error": 404}
+                    data = self.post_data(post)
+                    return 200, [
+                        self.listing([{"kind": "t3", "data": data}]),
+                        self.listing([]),
+                    ]
+
+                case "unread":
+                    self.advance_mentions()
+                    mentions, self.mentions = self.mentions, []
+                    return 200, self.listing(mentions)
+
+                case "wiki":
+                    assert self.bot is not None
+                    return 200, {
+                        "kind": "wikipage",
+                        "data": {
+                            "content_md": self.bot.default_sub_config,
+                            "revision_by": None,
+                            "revision_date": time.time(),
+                            "may_revise": True,
+                        },
+                    }
+
+                case "moderators":
+                    return 200, {"kind": "UserList", "data": {"children": []}}
+
+                case "listing":
+                    return 200, self.listing([])
+
+                case "comment":
+                    # Replies to mentions are made to comments, not posts
+                    parent = form.get("thing_id", "")[3:]
+                    post = self.posts.get(parent) or Post(
+                        parent, next(iter(self.subreddits)), 0, (0, 1, 1), None
+                    )
+                    self.replies += 1
+                    self.next_id += 1
+                    comment = self.comment_data(f"lg{self.next_id:x}", post)
+                    return 200, {
+                        "json": {
+                            "errors": [],
+                            "data": {
+                                "things": [{"kind": "t1", "data": comment}]
+                            },
+                        }
+                    }
+
+                case "report":
+                    self.reported.add(form.get("id", "")[3:])
+                    return 200, {"json": {"errors": []}}
+
+                case _:
+                    return 200, {"json": {"errors": []}}
+
+    # Image server
+
+    def serve_images(self):
+        """Starts the local HTTP server that serves post images"""
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                try:
+                    seed, size = self.path.strip("/").split("/")
+                    width, height = size.removesuffix(".png").split("x")
+                    body = render_image(int(seed), int(width), int(height))
+                except ValueError:
+                    self.send_error(404)
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", "image/png")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args: Any):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(
+            target=self.server.serve_forever, name="loadgen-images", daemon=True
+        ).start()
+
+    # Running
+
+    def attach(self, bot: BotClient, *, interval: float = 10):
+        """
+        Prepares a bot to moderate the simulated subreddits
+
+        The subreddits are added to the database as already indexed, so that
+        the bot starts scanning them straight away. Only use a scratch
+        database, as other subreddits are left in place.
+
+        :param bot: The bot, which must have been created with this generator
+            as its transport
+        :type bot: ``BotClient``
+
+        :param interval: How often to sample the bot's progress, in seconds
+        :type interval: ``float``
+        """
+        self.bot = bot
+        self.serve_images()
+
+        with bot.pool.connection() as conn, conn.cursor() as cur:
+            cur.executemany(
+                """
+                INSERT INTO subreddits
+                VALUES(%s, TRUE)
+                ON CONFLICT (name) DO UPDATE SET indexed=TRUE""",
+                [(name,) for name in self.subreddits],
+            )
+        bot.update_subs()
+
+        self.started = time.monotonic()
+        self.sampler = threading.Thread(
+            target=self._sample_loop,
+            args=(interval,),
+            name="loadgen",
+            daemon=True,
+        )
+        self.sampler.start()
+        logger.info(
+            f"✅ Simulating {len(self.subreddits)} subreddits, "
+            f"serving images at {self.server.server_address}"
+        )
+
+    def handled(self) -> int:
+        """The number of posts the bot has handled for the first time"""
+        assert self.bot is not None
+        return sum(
+            count
+            for labels, count in self.bot.metrics.submissions.values.items()
+            if dict(labels).get("outcome") != "skipped"
+        )
+
+    def sample(self) -> dict[str, Any]:
+        with self.lock:
+            for subreddit in self.subreddits.values():
+                self.advance(subreddit)
+            posted = len(self.posts)
+        handled = self.handled()
+        return {
+            "elapsed": time.monotonic() - self.started,
+            "posted": posted,
+            "handled": handled,
+            "backlog": posted - handled,
+            "reported": len(self.reported),
+            "cpu_seconds": time.process_time(),
+            "max_rss_kib": max_rss_kib(),
+            "threads": threading.active_count(),
+        }
+
+    def _sample_loop(self, interval: float):
+        while not self.stopped.wait(interval):
+            sample = self.sample()
+            self.samples.append(sample)
+            logger.info(
+                f"{sample['elapsed']:.0f}s: {sample['posted']} posted, "
+                f"{sample['handled']} handled, backlog {sample['backlog']}"
+            )
+
+    def close(self):
+        self.stopped.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def report(self) -> dict[str, Any]:
+        """
+        Summarizes how the bot kept up with the simulated load
+
+        :return: The summary, including every sample taken while it ran
+        :rtype: ``dict[str, Any]``
+        """
+        final = self.sample()
+        elapsed = max(final["elapsed"], 1e-9)
+        reposts = {post.id for post in self.posts.values() if post.repost_of}
+
+        # Backlog growth is the slope between the first and last samples
+        first = self.samples[0] if self.samples else final
+        span = final["elapsed"] - first["elapsed"]
+        growth = (final["backlog"] - first["backlog"]) / span * 60 if span else 0
+
+        return {
+            "elapsed": final["elapsed"],
+            "subreddits": len(self.subreddits),
+            "posted": final["posted"],
+            "handled": final["handled"],
+            "offered_per_second": final["posted"] / elapsed,
+            "handled_per_second": final["handled"] / elapsed,
+            "backlog": final["backlog"],
+            "backlog_growth_per_minute": growth,
+            "reposts": len(reposts),
+            "reposts_reported": len(reposts & self.reported),
+            "false_reports": len(self.reported - reposts),
+            "replies": self.replies,
+            "cpu_seconds": final["cpu_seconds"],
+            "max_rss_kib": final["max_rss_kib"],
+            "samples": [*self.samples, final],
+        }
+
+
+class FakeRedditAdapter(BaseAdapter):
+    def __init__(self, generator: LoadGenerator):
+        super().__init__()
+        self.generator = generator
+
+    def send(
+        self, request: requests.PreparedRequest, **kwargs: Any
+    ) -> requests.Response:
+        status, data = self.generator.respond(request)
+        body = json.dumps(data).encode()
+
+        response = requests.Response()
+        response.status_code = status
+        response.headers = CaseInsensitiveDict(
+            {
+                "Content-Type": "application/json; charset=UTF-8",
+                "Content-Length": str(len(body)),
+            }
+        )
+        response.encoding = "utf-8"
+        response._content = body
+        response._content_consumed = True
+        response.url = request.url or ""
+        response.request = request
+        return response
+
+    def close(self):
+        pass
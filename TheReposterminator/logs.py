@@ -0,0 +1,167 @@
+"""
+TheReposterminator Reddit bot to detect reposts
+Copyright (C) 2023 sardonicism-04
+
+TheReposterminator is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TheReposterminator is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with TheReposterminator.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import atexit
+import copy
+import logging
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Literal
+
+from .formatters import ColoredLoggingFormatter, JsonFormatter
+
+LOGGER_NAMES = ("TheReposterminator", "prawcore", "praw")
+TEXT_FORMAT = "[{asctime}] [{levelname} {name} {funcName}] {message}"
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Samples debug records from loggers that are logging at a high volume
+
+    Each logger may emit `limit` debug records per second. Beyond that, only
+    one in every `every` of its debug records is kept for the rest of the
+    second. Records above debug level are always kept.
+    """
+
+    def __init__(self, *, limit: int = 100, every: int = 100):
+        super().__init__()
+        self.limit = limit
+        self.every = every
+
+        # Maps logger names to the current second, and its number of records
+        self.windows: dict[str, tuple[int, int]] = {}
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG:
+            return True
+
+        second = int(record.created)
+        with self.lock:
+            window, count = self.windows.get(record.name, (second, 0))
+            count = count + 1 if window == second else 1
+            self.windows[record.name] = (second, count)
+
+            if count <= self.limit or (count - self.limit) % self.every == 0:
+                return True
+            self.dropped += 1
+            return False
+
+
+class LogQueueHandler(QueueHandler):
+    """
+    A `QueueHandler` that keeps exceptions apart from the message
+
+    Records are still resolved before being queued, as their arguments may
+    change once the call returns, but tracebacks are kept in `exc_text` so
+    that formatters on the other side of the queue can place them.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info
+            )
+            record.exc_info = None
+        return record
+
+
+def setup_logging(
+    *,
+    level: int = logging.INFO,
+    file: str | None = "rterm.log",
+    file_format: Literal["text", "json"] = "json",
+    max_bytes: int = 10 * 1024 * 1024,
+    backups: int = 5,
+    debug_limit: int = 100,
+    debug_every: int = 100,
+) -> QueueListener:
+    """
+    Sends the bot's logs through a queue to a background writer
+
+    Logging calls only resolve their record and put it on a queue; writing
+    to the console and log file is done by a `QueueListener` thread. The log
+    file is rotated once it reaches `max_bytes`, keeping `backups` old files.
+    High-volume debug logs are sampled with a `SamplingFilter`.
+
+    :param level: The level of the bot's loggers, defaults to `logging.INFO`
+    :type level: ``int``
+
+    :param file: The log file, or `None` to only log to the console
+    :type file: ``str | None``
+
+    :param file_format: Whether the log file is plain text or JSON lines
+    :type file_format: ``Literal["text", "json"]``
+
+    :param max_bytes: The size at which the log file is rotated
+    :type max_bytes: ``int``
+
+    :param backups: The number of rotated log files to keep
+    :type backups: ``int``
+
+    :param debug_limit: The debug records each logger may emit per second
+        before they're sampled
+    :type debug_limit: ``int``
+
+    :param debug_every: The fraction of debug records kept while sampling
+    :type debug_every: ``int``
+
+    :return: The started listener, which is stopped when the process exits
+    :rtype: ``QueueListener``
+    """
+    console = logging.StreamHandler()
+    console.setFormatter(ColoredLoggingFormatter(fmt=TEXT_FORMAT))
+    handlers: list[logging.Handler] = [console]
+
+    if file is not None:
+        file_handler = RotatingFileHandler(
+            file, maxBytes=max_bytes, backupCount=backups, encoding="utf-8"
+        )
+        file_handler.setFormatter(
+            JsonFormatter()
+            if file_format == "json"
+            else logging.Formatter(fmt=TEXT_FORMAT, style="{")
+        )
+        handlers.append(file_handler)
+
+    records: queue.SimpleQueue[logging.LogRecord] = queue.SimpleQueue()
+    handler = LogQueueHandler(records)
+    handler.addFilter(SamplingFilter(limit=debug_limit, every=debug_every))
+
+    for name in LOGGER_NAMES:
+        logger = logging.getLogger(name)
+        logger.setLevel(level)
+        logger.handlers.clear()
+        logger.addHandler(handler)
+
+    listener = QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+
+    def stop():
+        # The listener may have already been stopped
+        if listener._thread is not None:
+            listener.stop()
+
+    atexit.register(stop)
+    return listener
@@ -17,13 +17,18 @@ along with TheReposterminator.  If not, see <https://www.gnu.org/licenses/>.
 """
 from __future__ import annotations
 
+import json
 import logging
+import tracemalloc
 from typing import TYPE_CHECKING, cast
 
 import toml
 from praw import exceptions as praw_exceptions
 from prawcore import exceptions
 
+from . import whatif
+from .budget import Priority
+from .notifications import CONFIG_CHANNEL, publish
 from .types import Command, SubredditConfig
 
 if TYPE_CHECKING:
@@ -48,6 +53,12 @@ class MessageHandler:
         self.commands: dict[str, Command] = {
             "update": self.command_update,
             "defaults": self.command_defaults,
+            "whatif": self.command_whatif,
+        }
+        # Commands for the bot's operators, which aren't tied to a subreddit
+        self.admin_commands: dict[str, Command] = {
+            "profile": self.command_profile,
+            "memory": self.command_memory,
         }
 
     def handle(self):
@@ -60,10 +71,20 @@ class MessageHandler:
         | Subreddit Moderation Invite  | Delegates to `self.accept_invite`          |
         | Subreddit Moderation Removal | Delegates to `self.handle_mod_removal`     |
         | Command                      | Delegates to `self.run_command`            |
+        | Admin Command                | Delegates to `self.run_admin_command`      |
         | Anything else                | Ignored                                    |
 
-        All messages are then marked as read, regardless of action.
+        All messages are then marked as read, regardless of action. Mentions
+        are handled at a higher request priority than the rest of the inbox.
         """
+        with (
+            self.bot.budget.priority(Priority.INBOX),
+            self.bot.metrics.inbox_seconds.time(),
+        ):
+            self._handle_unread()
+
+    def _handle_unread(self):
+        """The body of `handle`, kept separate so it runs at inbox priority"""
         for message in self.bot.reddit.inbox.unread(mark_read=True):
             if TYPE_CHECKING:
                 message = cast(Message, message)
@@ -73,7 +94,8 @@ class MessageHandler:
                 if self.bot.subreddit_configs.get(
                     str(message.subreddit), {}
                 ).get("respond_to_mentions"):
-                    self.bot.interactive.receive_mention(message)
+                    with self.bot.budget.priority(Priority.MENTION):
+                        self.bot.interactive.receive_mention(message)
 
             # if the message was sent from a subreddit, it could be an invite
             if getattr(message, "subreddit", None):
@@ -88,7 +110,11 @@ class MessageHandler:
                     self.handle_mod_removal(message)
 
             # finally, check if message contains a command
-            if command := self.commands.get(message.body.lower()):
+            name, _, argument = message.body.strip().lower().partition(" ")
+            admin_command = self.admin_commands.get(name)
+            if admin_command and not message.was_comment:
+                self.run_admin_command(admin_command, argument.strip(), message)
+            elif command := self.commands.get(name):
                 subname = message.subject.split("r/")[-1]
                 if self.bot.get_sub(subname):
                     self.run_command(command, subname, message)
@@ -128,18 +154,24 @@ class MessageHandler:
             )
             return
 
-        self.bot.insert_cursor.execute(
-            """
-            INSERT INTO subreddits
-            VALUES(
-                %s,
-                FALSE
-            ) ON CONFLICT DO NOTHING""",
-            (str(message.subreddit),),
-        )
+        self.bot.moderators.invalidate(str(message.subreddit))
+
+        with self.bot.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO subreddits
+                VALUES(
+                    %s,
+                    FALSE
+                ) ON CONFLICT DO NOTHING""",
+                (str(message.subreddit),),
+            )
+            cur.execute(
+                "DELETE FROM departed_subreddits WHERE name=%s",
+                (str(message.subreddit),),
+            )
         self.bot.update_subs()
 
-        self.bot.db.commit()
         logger.info(f"✅ Accepted mod invite to r/{message.subreddit}")
 
         try:
@@ -158,25 +190,58 @@ class MessageHandler:
 
         finally:
             self.bot.get_config(str(message.subreddit))
+            self.publish_config(str(message.subreddit))
 
     def handle_mod_removal(self, message: Message):
         """
         Handles removal from a subreddit
 
-        Deletes the subreddit's associated entry in the `subreddits` table and
-        then calls `BotClient.update_subs`. Note that associated submission data
-        is **not** deleted, as it may be needed again if the bot is re-added.
+        Deletes the subreddit's associated entry in the `subreddits` table,
+        records the departure in the `departed_subreddits` table, and then
+        calls `BotClient.update_subs`. Note that associated submission data is
+        **not** deleted, as it may be needed again if the bot is re-added. It
+        is instead pruned by the retention policy once its grace period ends.
 
         :param message: The subreddit removal message
         :type message: ``Message``
         """
-        self.bot.insert_cursor.execute(
-            "DELETE FROM subreddits WHERE name=%s", (str(message.subreddit),)
-        )
+        with self.bot.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                "DELETE FROM subreddits WHERE name=%s", (str(message.subreddit),)
+            )
+            cur.execute(
+                """
+                INSERT INTO departed_subreddits (name)
+                VALUES(%s)
+                ON CONFLICT (name) DO UPDATE SET departed_at=NOW()""",
+                (str(message.subreddit),),
+            )
         self.bot.update_subs()
-        self.bot.db.commit()
+        self.bot.moderators.invalidate(str(message.subreddit))
         logger.info(f"✅ Handled removal from r/{message.subreddit}")
 
+    def publish_config(self, subname: str):
+        """
+        Notifies other processes that a subreddit's config has changed
+
+        The config is also recorded in the database, for processes that miss
+        the notification while disconnected.
+
+        :param subname: The subreddit whose config changed
+        :type subname: ``str``
+        """
+        config = self.bot.subreddit_configs[subname]
+        with self.bot.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO subreddit_config_changes (name, config)
+                VALUES(%s, %s)
+                ON CONFLICT (name) DO UPDATE
+                    SET config=EXCLUDED.config, changed_at=NOW()""",
+                (subname, json.dumps(config)),
+            )
+        publish(self.bot, CONFIG_CHANNEL, {"subname": subname, "config": config})
+
     # DM commands
 
     def run_command(self, command: Command, subname: str, message: Message):
@@ -185,7 +250,7 @@ class MessageHandler:
 
         If the user is not a moderator of the subreddit in the command's subject
         line, then they will receive an error message instead of the command
-        being executed.
+        being executed. Moderators are looked up in the bot's `ModeratorCache`.
 
         :param command: The command to execute
         :type command: ``Command``
@@ -197,7 +262,7 @@ class MessageHandler:
         :type message: ``Message``
         """
         # Check that the user actually mods the subreddit
-        if subname not in [*map(str, message.author.moderated())]:
+        if not self.bot.moderators.is_moderator(subname, str(message.author)):
             message.reply("❌ You don't mod this subreddit!")
             return
 
@@ -215,6 +280,7 @@ class MessageHandler:
         """
         try:
             self.bot.get_config(subname, ignore_errors=False)
+            self.publish_config(subname)
             message.reply("👍 Successfully updated your subreddit's config!")
             logger.info(f"✅ Config updated for r/{subname}")
 
@@ -261,6 +327,7 @@ class MessageHandler:
             self.bot.subreddit_configs[subname] = cast(
                 SubredditConfig, toml.loads(self.bot.default_sub_config)
             )
+            self.publish_config(subname)
             message.reply(
                 "👍 Successfully created/reset your subreddit's config!"
             )
@@ -275,3 +342,174 @@ class MessageHandler:
         except Exception as e:
             message.reply("❌ Something went wrong, it'll be investigated")
             logger.error(f"Error in command defaults: {e}")
+
+    def command_whatif(self, subname: str, message: Message):
+        """
+        Estimates the subreddit's reports and autoremovals at other thresholds
+
+        The message body is `whatif [sentry threshold] [autoremove threshold]`.
+        Omitted thresholds are taken from the subreddit's config. Estimates
+        come from the subreddit's last what-if analysis, and are shown as n/a
+        for current thresholds below those it covers.
+
+        :param subname: The subreddit to estimate for
+        :type subname: ``str``
+
+        :param message: The message from which the command was executed
+        :type message: ``Message``
+        """
+        if (analysis := self.bot.whatif.load(subname)) is None:
+            message.reply(
+                "❌ Your subreddit hasn't been analyzed yet, try again later"
+            )
+            return
+
+        sub_config = self.bot.subreddit_configs[subname]
+        current = (
+            sub_config["sentry_threshold"],
+            sub_config["autoremove_threshold"]
+            if sub_config["autoremove"]
+            else None,
+        )
+        arguments = message.body.split()[1:3]
+        if not all(argument.isdigit() for argument in arguments):
+            message.reply(
+                "❌ Usage: `whatif [sentry threshold] [autoremove threshold]`"
+            )
+            return
+        proposed = (*map(int, arguments), *current[len(arguments):])
+
+        table = (
+            "| | Sentry threshold | Autoremove threshold | Reports/day "
+            "| Autoremovals/day |\n|:-|:-|:-|:-|:-|\n"
+        )
+        for label, (sentry, autoremove) in (
+            ("Current", current),
+            ("Proposed", proposed),
+        ):
+            try:
+                estimate = whatif.estimate(
+                    analysis,
+                    sentry_threshold=sentry,
+                    autoremove_threshold=autoremove,
+                )
+            except ValueError as e:
+                # The current thresholds may be below those analyzed
+                if label == "Current":
+                    table += (
+                        f"| {label} | {sentry} | {autoremove or 'Off'} "
+                        f"| n/a | n/a |\n"
+                    )
+                    continue
+                message.reply(f"❌ {e}")
+                return
+            table += (
+                f"| {label} | {sentry} | {autoremove or 'Off'} "
+                f"| {estimate.reports_per_day:.2f} "
+                f"| {estimate.autoremovals_per_day:.2f} |\n"
+            )
+        message.reply(
+            f"{table}\nEstimated from {analysis.posts} posts over "
+            f"{analysis.span_days:.0f} days, analyzed "
+            f"{analysis.computed_at:%Y-%m-%d}."
+        )
+
+    # Admin DM commands
+
+    def run_admin_command(
+        self, command: Command, argument: str, message: Message
+    ):
+        """
+        Runs an admin command callback
+
+        If the user is not listed in the `[admin]` section of the bot's
+        config, they will receive an error message instead.
+
+        :param command: The command to execute
+        :type command: ``Command``
+
+        :param argument: The rest of the message after the command's name
+        :type argument: ``str``
+
+        :param message: The message from which the command was executed
+        :type message: ``Message``
+        """
+        users = self.bot.config.get("admin", {}).get("users", [])
+        admins = {user.lower() for user in users}
+        if str(message.author).lower() not in admins:
+            message.reply("❌ You aren't an admin of this bot!")
+            return
+
+        try:
+            command(argument, message)
+        except Exception as e:
+            message.reply("❌ Something went wrong, it'll be investigated")
+            logger.error(f"Error in admin command: {e}")
+
+    def command_profile(self, argument: str, message: Message):
+        """
+        Starts or stops CPU profiling, or replies with the current profile
+
+        :param argument: `start`, `stop`, or nothing for the current profile
+        :type argument: ``str``
+
+        :param message: The message from which the command was executed
+        :type message: ``Message``
+        """
+        profiler = self.bot.profiler
+        if argument == "start":
+            profiler.start()
+            message.reply("👍 Started CPU profiling")
+        elif argument == "stop":
+            if not profiler.sampling:
+                message.reply("❌ CPU profiling isn't running")
+                return
+            summary = profiler.cpu_summary()
+            profiler.stop()
+            message.reply(f"👍 Stopped CPU profiling\n\n{code_block(summary)}")
+        elif profiler.sampling:
+            message.reply(code_block(profiler.cpu_summary()))
+        else:
+            message.reply(
+                "❌ CPU profiling isn't running, send `profile start` first"
+            )
+
+    def command_memory(self, argument: str, message: Message):
+        """
+        Starts or stops memory profiling, or replies with a snapshot summary
+
+        :param argument: `start`, `stop`, or nothing for a snapshot summary
+        :type argument: ``str``
+
+        :param message: The message from which the command was executed
+        :type message: ``Message``
+        """
+        profiler = self.bot.profiler
+        if argument == "start":
+            profiler.start_memory()
+            message.reply("👍 Started memory profiling")
+        elif argument == "stop":
+            if not tracemalloc.is_tracing():
+                message.reply("❌ Memory profiling isn't running")
+                return
+            profiler.stop_memory()
+            message.reply("👍 Stopped memory profiling")
+        elif tracemalloc.is_tracing():
+            message.reply(code_block(profiler.memory_summary()))
+        else:
+            message.reply(
+                "❌ Memory profiling isn't running, send `memory start` first"
+            )
+
+
+def code_block(text: str) -> str:
+    """
+    Formats text as a Markdown code block, within Reddit's message length
+
+    :param text: The text to format
+    :type text: ``str``
+
+    :return: The indented text
+    :rtype: ``str``
+    """
+    return "\n".join(f"    {line}" for line in text.splitlines())[:9000]
@@ -0,0 +1,332 @@
+"""
+TheReposterminator Reddit bot to detect reposts
+Copyright (C) 2023 sardonicism-04
+
+TheReposterminator is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TheReposterminator is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with TheReposterminator.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import bisect
+import logging
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from TheReposterminator import BotClient
+
+
+logger = logging.getLogger(__name__)
+
+# Bucket bounds in seconds, spanning a local hash up to a slow Reddit request
+LATENCY_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+# Bucket bounds in seconds, spanning a quiet subreddit's pass up to indexing a
+# large subreddit for the first time
+PASS_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1_200, 1_800, 3_600)
+# Bucket bounds for the number of index rows scanned by a search
+ROWS_BUCKETS = (0, 10, 100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+# Bucket bounds in seconds for how long after being posted a repost is caught
+LAG_BUCKETS = (10, 30, 60, 120, 300, 600, 1_800, 3_600, 7_200, 21_600, 86_400)
+
+Labels = tuple[tuple[str, str], ...]
+
+
+def format_labels(labels: Labels, **extra: str) -> str:
+    pairs = [*labels, *extra.items()]
+    if not pairs:
+        return ""
+    escaped = (
+        (key, value.replace("\\", "\\\\").replace('"', '\\"'))
+        for key, value in pairs
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Counter:
+    """A monotonically increasing count, per set of labels"""
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values: dict[Labels, float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self.lock:
+            for labels, value in self.values.items():
+                labelled = f"{self.name}{format_labels(labels)}"
+                yield f"{labelled} {format_value(value)}"
+
+
+class Histogram:
+    """A distribution of observed values in cumulative buckets, per labels"""
+
+    def __init__(self, name: str, help: str, buckets: tuple[float, ...]):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # Maps labels to per-bucket counts (the last being +Inf), and a sum
+        self.values: dict[Labels, tuple[list[int], list[float]]] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            if (entry := self.values.get(key)) is None:
+                counts = [0] * (len(self.buckets) + 1)
+                entry = self.values[key] = (counts, [0.0])
+            counts, total = entry
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            total[0] += value
+
+    def totals(self) -> dict[Labels, tuple[int, float]]:
+        """The number and sum of the values observed, per set of labels"""
+        with self.lock:
+            return {
+                labels: (sum(counts), total[0])
+                for labels, (counts, total) in self.values.items()
+            }
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """
+        Observes the duration of a block, in seconds
+
+        :return: A context manager which times its block
+        :rtype: ``Iterator[None]``
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self.lock:
+            for labels, (counts, total) in self.values.items():
+                cumulative = 0
+                for bound, count in zip((*self.buckets, float("inf")), counts):
+                    cumulative += count
+                    le = format_labels(labels, le=format_value(bound))
+                    yield f"{self.name}_bucket{le} {cumulative}"
+                yield (
+                    f"{self.name}_sum{format_labels(labels)} "
+                    f"{format_value(total[0])}"
+                )
+                yield f"{self.name}_count{format_labels(labels)} {cumulative}"
+
+
+class Metrics:
+    """
+    The bot's metrics, rendered in the Prometheus text exposition format
+
+    Stages of the pipeline record into the counters and histograms defined
+    here. The statistics already kept by the bot's other components (the
+    connection pool, indexes, media hosts, request budget and so on) are
+    exported as gauges when the metrics are rendered.
+
+    When `serve` is called, the metrics are served over HTTP at `/metrics`.
+    """
+
+    def __init__(self, bot: BotClient):
+        self.bot = bot
+        self.server: ThreadingHTTPServer | None = None
+
+        self.submissions = Counter(
+            "rterm_submissions_total",
+            "Submissions handled by the sentry, by outcome",
+        )
+        self.stage_seconds = Histogram(
+            "rterm_submission_stage_seconds",
+            "Time spent in each stage of handling a submission",
+            LATENCY_BUCKETS,
+        )
+        self.rows_scanned = Histogram(
+            "rterm_match_rows_scanned",
+            "Index rows compared by each search for matches",
+            ROWS_BUCKETS,
+        )
+        self.pass_seconds = Histogram(
+            "rterm_subreddit_pass_seconds",
+            "Time spent scanning or indexing a subreddit, per pass",
+            PASS_BUCKETS,
+        )
+        self.inbox_seconds = Histogram(
+            "rterm_inbox_seconds",
+            "Time spent handling the inbox, per pass",
+            LATENCY_BUCKETS,
+        )
+        self.action_seconds = Histogram(
+            "rterm_action_seconds",
+            "Time spent performing moderation actions, by kind and outcome",
+            LATENCY_BUCKETS,
+        )
+        self.detection_lag_seconds = Histogram(
+            "rterm_detection_lag_seconds",
+            "Time from a submission being posted to each stage of detection",
+            LAG_BUCKETS,
+        )
+
+    def gauges(self) -> Iterator[tuple[str, Labels, float]]:
+        """
+        Collects the statistics of the bot's components as gauges
+
+        :return: An iterator of `(name, labels, value)` triples
+        :rtype: ``Iterator[tuple[str, Labels, float]]``
+        """
+        bot = self.bot
+        components: dict[str, dict[str, Any]] = {
+            "pool": bot.pool.stats,
+            "reads": bot.reads.stats,
+            "index": bot.index.stats,
+            "actions": bot.actions.stats,
+            "failures": bot.failures.stats,
+            "moderators": bot.moderators.stats,
+        }
+        for component, stats in components.items():
+            for key, value in stats.items():
+                if isinstance(value, (int, float)):
+                    yield f"rterm_{component}_{key}", (), value
+
+        for host, stats in bot.hosts.stats.items():
+            for key, value in stats.items():
+                if isinstance(value, (int, float)):
+                    yield f"rterm_media_host_{key}", (("host", host),), value
+            yield (
+                "rterm_media_host_open",
+                (("host", host),),
+                stats["state"] != "closed",
+            )
+
+        budget = bot.budget.stats
+        for key in ("remaining", "used", "reset_in"):
+            if budget[key] is not None:
+                yield f"rterm_reddit_ratelimit_{key}", (), budget[key]
+        for priority, count in budget["throttled"].items():
+            yield (
+                "rterm_reddit_throttled",
+                (("priority", priority),),
+                count,
+            )
+        for endpoint, stats in budget["endpoints"].items():
+            for key, value in stats.items():
+                yield f"rterm_reddit_{key}", (("endpoint", endpoint),), value
+
+    def render(self) -> str:
+        """
+        Renders every metric
+
+        :return: The metrics in the Prometheus text exposition format
+        :rtype: ``str``
+        """
+        lines: list[str] = []
+        for metric in (
+            self.submissions,
+            self.stage_seconds,
+            self.rows_scanned,
+            self.pass_seconds,
+            self.inbox_seconds,
+            self.action_seconds,
+            self.detection_lag_seconds,
+        ):
+            lines.extend(metric.render())
+
+        typed: set[str] = set()
+        for name, labels, value in self.gauges():
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int, host: str = "127.0.0.1"):
+        """
+        Serves the metrics over HTTP from a background thread
+
+        :param port: The port to listen on
+        :type port: ``int``
+
+        :param host: The address to listen on, defaults to `127.0.0.1`
+        :type host: ``str``
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                try:
+                    body = metrics.render().encode()
+                except Exception as e:
+                    logger.error(f"Failed to render metrics: {e}")
+                    self.send_error(500)
+                    return
+
+                self.send_response(200)
+                self.send_header(
+                    "Content-Type", "text/plain; version=0.0.4; charset=utf-8"
+                )
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args: Any):
+                logger.debug("Metrics request: " + format, *args)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(
+            target=self.server.serve_forever, name="metrics", daemon=True
+        ).start()
+        logger.info(f"✅ Serving metrics at http://{host}:{port}/metrics")
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
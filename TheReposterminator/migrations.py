@@ -0,0 +1,111 @@
+"""
+TheReposterminator Reddit bot to detect reposts
+Copyright (C) 2023 sardonicism-04
+
+TheReposterminator is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TheReposterminator is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with TheReposterminator.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import logging
+from typing import TYPE_CHECKING, cast
+
+from .budget import Priority
+from .index import SNAPSHOT_SUFFIX
+
+if TYPE_CHECKING:
+    from praw.models.reddit.submission import Submission
+
+    from TheReposterminator import BotClient
+
+
+logger = logging.getLogger(__name__)
+
+
+def backfill_created_utc(bot: BotClient, *, batch_size: int = 100):
+    """
+    Fills in `media_storage.created_utc` for rows stored before it existed
+
+    Rows are walked one subreddit at a time, in submission ID order, so that
+    every query only touches the subreddit's partition, and their posts are
+    requested from Reddit in bulk. Posts that Reddit no longer returns are
+    given a timestamp of `0`, marking their age as unknown so that they are
+    not retried.
+
+    Once the backfill is complete, all hash index snapshots are deleted so
+    that they are rebuilt with the new timestamps. The bot should not be
+    running while the backfill takes place.
+
+    :param bot: The bot client to perform method calls to
+    :type bot: ``BotClient``
+
+    :param batch_size: The number of posts to request at once, defaults to `100`
+    :type batch_size: ``int``
+    """
+    with bot.pool.connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            "SELECT DISTINCT subname FROM media_storage WHERE created_utc IS NULL"
+        )
+        subnames: list[str] = sorted(row[0] for row in cur.fetchall())
+
+    updated = 0
+    for subname in subnames:
+        last_id = ""
+
+        while True:
+            with bot.pool.connection() as conn, conn.cursor() as cur:
+                cur.execute(
+                    """
+                    SELECT DISTINCT submission_id FROM
+                        media_storage
+                    WHERE
+                        subname=%s AND
+                        created_utc IS NULL AND
+                        submission_id>%s
+                    ORDER BY submission_id
+                    LIMIT %s
+                    """,
+                    (subname, last_id, batch_size),
+                )
+                ids: list[str] = [row[0] for row in cur.fetchall()]
+
+            if not ids:
+                break
+
+            created = dict.fromkeys(ids, 0)
+            with bot.budget.priority(Priority.BACKFILL):
+                for post in bot.reddit.info(map(lambda id: f"t3_{id}", ids)):
+                    if TYPE_CHECKING:
+                        post = cast(Submission, post)
+                    created[post.id] = int(post.created_utc)
+
+            with bot.pool.connection() as conn, conn.cursor() as cur:
+                cur.executemany(
+                    """
+                    UPDATE media_storage SET created_utc=%s
+                    WHERE subname=%s AND submission_id=%s
+                    """,
+                    [
+                        (created_utc, subname, id)
+                        for id, created_utc in created.items()
+                    ],
+                )
+
+            updated += len(ids)
+            last_id = ids[-1]
+            logger.info(f"Backfilled created_utc for {updated} submissions")
+
+    for snapshot in bot.index.directory.glob(f"*{SNAPSHOT_SUFFIX}"):
+        snapshot.unlink()
+
+    logger.info("✅ Finished backfilling created_utc")
@@ -0,0 +1,170 @@
+"""
+TheReposterminator Reddit bot to detect reposts
+Copyright (C) 2023 sardonicism-04
+
+TheReposterminator is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TheReposterminator is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with TheReposterminator.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from typing import TYPE_CHECKING
+
+from prawcore import exceptions
+
+if TYPE_CHECKING:
+    from TheReposterminator import BotClient
+    from TheReposterminator.types import ModeratorsConfig
+
+
+logger = logging.getLogger(__name__)
+
+# Moderation log actions that change who moderates a subreddit
+MODERATOR_ACTIONS = {
+    "acceptmoderatorinvite",
+    "addmoderator",
+    "removemoderator",
+}
+
+
+class ModeratorCache:
+    """
+    Caches the moderator list of each subreddit, for authorizing commands
+
+    A subreddit's moderators are fetched with a single request the first time
+    they are needed, and are refetched once they are older than the
+    configured TTL. Before each lookup, the moderation log of every subreddit
+    the bot moderates is checked for moderator changes (at most once per
+    `modlog_interval`), and the lists of any changed subreddits are dropped.
+
+    A user who isn't in a list that is older than `min_refresh` causes the
+    list to be refetched once, in case they were added very recently.
+    """
+
+    def __init__(self, bot: BotClient):
+        self.bot = bot
+
+        # Maps lowercase subreddit names to their lowercase moderator names,
+        # and the monotonic time they were fetched at
+        self.moderators: dict[str, tuple[set[str], float]] = {}
+        self.lock = threading.Lock()
+
+        self.modlog_checked = 0.0
+        self.modlog_seen = time.time()
+
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def config(self) -> ModeratorsConfig:
+        return self.bot.config.get("moderators", {})
+
+    @property
+    def stats(self) -> dict[str, int]:
+        """Counters describing the effectiveness of the cache"""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "cached": len(self.moderators),
+        }
+
+    def is_moderator(self, subname: str, username: str) -> bool:
+        """
+        Checks whether a user moderates a subreddit
+
+        :param subname: The subreddit to check (case-insensitive)
+        :type subname: ``str``
+
+        :param username: The user to check (case-insensitive)
+        :type username: ``str``
+
+        :return: Whether the user is a moderator of the subreddit
+        :rtype: ``bool``
+        """
+        subname, username = subname.lower(), username.lower()
+        self.check_modlog()
+
+        with self.lock:
+            cached = self.moderators.get(subname)
+        ttl = self.config.get("ttl", 3600)
+        min_refresh = self.config.get("min_refresh", 60)
+
+        if cached is not None:
+            moderators, fetched_at = cached
+            age = time.monotonic() - fetched_at
+            if age < ttl and (username in moderators or age < min_refresh):
+                self.hits += 1
+                return username in moderators
+
+        self.misses += 1
+        return username in self.fetch(subname)
+
+    def fetch(self, subname: str) -> set[str]:
+        """
+        Fetches and caches the moderators of a subreddit
+
+        :param subname: The lowercase name of the subreddit
+        :type subname: ``str``
+
+        :return: The lowercase names of the subreddit's moderators
+        :rtype: ``set[str]``
+        """
+        moderators = {
+            str(moderator).lower()
+            for moderator in self.bot.reddit.subreddit(subname).moderator()
+        }
+        with self.lock:
+            self.moderators[subname] = (moderators, time.monotonic())
+
+        logger.debug(f"Cached {len(moderators)} moderators of r/{subname}")
+        return moderators
+
+    def check_modlog(self):
+        """
+        Drops the cached moderators of subreddits whose moderators changed
+
+        Reads the combined moderation log of every subreddit the bot
+        moderates, so a single request usually covers all of them. The log is
+        paged through back to the newest entry seen by the previous check, so
+        that no change is missed on a busy log.
+        """
+        now = time.monotonic()
+        if now - self.modlog_checked < self.config.get("modlog_interval", 60):
+            return
+        self.modlog_checked = now
+
+        try:
+            newest = self.modlog_seen
+            for entry in self.bot.reddit.subreddit("mod").mod.log(limit=None):
+                if entry.created_utc <= self.modlog_seen:
+                    break
+                newest = max(newest, entry.created_utc)
+                if entry.action in MODERATOR_ACTIONS:
+                    self.invalidate(str(entry.subreddit))
+            self.modlog_seen = newest
+
+        except exceptions.PrawcoreException as e:
+            logger.debug(f"Failed to check the moderation log: {e}")
+
+    def invalidate(self, subname: str):
+        """
+        Drops the cached moderators of a subreddit
+
+        :param subname: The subreddit to drop (case-insensitive)
+        :type subname: ``str``
+        """
+        with self.lock:
+            if self.moderators.pop(subname.lower(), None) is not None:
+                logger.debug(f"Invalidated cached moderators of r/{subname}")
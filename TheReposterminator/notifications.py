@@ -0,0 +1,221 @@
+"""
+TheReposterminator Reddit bot to detect reposts
+Copyright (C) 2023 sardonicism-04
+
+TheReposterminator is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TheReposterminator is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with TheReposterminator.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import json
+import logging
+from datetime import datetime
+from typing import TYPE_CHECKING, Any
+
+import psycopg2
+import psycopg2.extensions
+
+from .types import SubData
+
+if TYPE_CHECKING:
+    from TheReposterminator import BotClient
+
+
+logger = logging.getLogger(__name__)
+
+# Emitted by a trigger on changes to the subreddits table
+SUBREDDITS_CHANNEL = "rterm_subreddits"
+# Emitted by a trigger on inserts into the media_storage table
+MEDIA_CHANNEL = "rterm_media"
+# Emitted by the bot when a subreddit's config is changed by a command
+CONFIG_CHANNEL = "rterm_config"
+# Emitted by the bot when a subreddit's stored media data is pruned
+INVALIDATE_CHANNEL = "rterm_invalidate"
+# Emitted by the bot when rows are bulk-loaded without per-row notifications
+REFRESH_CHANNEL = "rterm_refresh"
+# Emitted by the bot when the media data of a subreddit's old posts is pruned
+EXPIRE_CHANNEL = "rterm_expire"
+
+CHANNELS = (
+    SUBREDDITS_CHANNEL,
+    MEDIA_CHANNEL,
+    CONFIG_CHANNEL,
+    INVALIDATE_CHANNEL,
+    REFRESH_CHANNEL,
+    EXPIRE_CHANNEL,
+)
+
+
+def publish(bot: BotClient, channel: str, payload: Any):
+    """
+    Sends a notification to every process listening on a channel
+
+    :param bot: The bot client to perform method calls to
+    :type bot: ``BotClient``
+
+    :param channel: The channel to notify
+    :type channel: ``str``
+
+    :param payload: The JSON-serializable payload of the notification
+    :type payload: ``Any``
+    """
+    with bot.pool.connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT pg_notify(%s, %s)", (channel, json.dumps(payload)))
+
+
+class NotificationListener:
+    """
+    Applies changes made by other processes to the bot's in-process state
+
+    Holds a dedicated connection outside of the pool which listens on every
+    channel, and is polled without blocking from the main loop. If the
+    connection is lost, notifications may have been missed, so all state is
+    resynchronized from the database once it has been re-established.
+    """
+
+    def __init__(self, bot: BotClient):
+        self.bot = bot
+
+        self.conn: psycopg2.connection | None = None
+        self.received = 0
+        # When the current and the previous connections started listening,
+        # according to the database's clock
+        self.listening_since: datetime | None = None
+        self.previously_listening_since: datetime | None = None
+
+    def connect(self):
+        """Opens the listening connection and subscribes to every channel"""
+        self.conn = psycopg2.connect(
+            **self.bot.pool.connect_kwargs, connect_timeout=5
+        )
+        self.conn.set_isolation_level(
+            psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT
+        )
+        with self.conn.cursor() as cur:
+            for channel in CHANNELS:
+                cur.execute(f"LISTEN {channel}")
+            cur.execute("SELECT NOW()")
+            (listening_since,) = cur.fetchone()
+
+        self.previously_listening_since = self.listening_since
+        self.listening_since = listening_since
+
+        logger.debug("Listening for notifications")
+
+    def poll(self):
+        """
+        Applies every notification received since the last poll
+
+        Reconnects and resynchronizes if the connection has been lost.
+        """
+        try:
+            if self.conn is None or self.conn.closed:
+                self.connect()
+                self.resync()
+
+            assert self.conn is not None
+            self.conn.poll()
+        except psycopg2.Error as e:
+            logger.warning(f"⚠️ Notification listener disconnected: {e}")
+            if self.conn is not None:
+                self.conn.close()
+            self.conn = None
+            return
+
+        while self.conn.notifies:
+            notify = self.conn.notifies.pop(0)
+            self.received += 1
+            try:
+                self.apply(notify.channel, json.loads(notify.payload))
+            except Exception as e:
+                logger.error(
+                    f"Failed to apply {notify.channel} notification: {e}"
+                )
+
+    def resync(self):
+        """
+        Reloads all state that notifications would otherwise have updated
+
+        Configs are downloaded for subreddits that weren't known before, and
+        configs changed by commands since the previous connection started
+        listening are applied.
+        """
+        self.bot.update_subs()
+        for subname, _ in self.bot.subreddits:
+            if subname not in self.bot.subreddit_configs:
+                self.bot.get_config(subname)
+
+        if self.previously_listening_since is not None:
+            with self.bot.pool.connection() as conn, conn.cursor() as cur:
+                cur.execute(
+                    """
+                    SELECT name, config FROM subreddit_config_changes
+                    WHERE changed_at >= %s""",
+                    (self.previously_listening_since,),
+                )
+                for subname, config in cur.fetchall():
+                    self.bot.subreddit_configs[subname] = config
+
+        self.bot.index.refresh_all()
+
+    def apply(self, channel: str, payload: Any):
+        """
+        Applies a single notification to the bot's in-process state
+
+        :param channel: The channel the notification was received on
+        :type channel: ``str``
+
+        :param payload: The decoded payload of the notification
+        :type payload: ``Any``
+        """
+        if channel == SUBREDDITS_CHANNEL:
+            subname = payload["name"]
+            subreddits = [
+                sub for sub in self.bot.subreddits if sub.subname != subname
+            ]
+            if payload["op"] != "DELETE":
+                subreddits.append(SubData(subname, payload["indexed"]))
+            self.bot.subreddits[:] = subreddits
+            # Subreddits may be added by another process, or outside the bot
+            if (
+                payload["op"] != "DELETE"
+                and subname not in self.bot.subreddit_configs
+            ):
+                self.bot.get_config(subname)
+
+        elif channel == MEDIA_CHANNEL:
+            self.bot.index.add(
+                payload["subname"],
+                int(payload["hash"]),
+                payload["submission_id"],
+                payload["created_utc"] or 0,
+                payload["row_id"],
+            )
+
+        elif channel == CONFIG_CHANNEL:
+            self.bot.subreddit_configs[payload["subname"]] = payload["config"]
+
+        elif channel == INVALIDATE_CHANNEL:
+            # The snapshot may predate the deletion
+            self.bot.index.invalidate(payload)
+
+        elif channel == REFRESH_CHANNEL:
+            self.bot.index.refresh(payload)
+
+        elif channel == EXPIRE_CHANNEL:
+            self.bot.index.expire(payload["subname"], payload["horizon"])
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
@@ -0,0 +1,393 @@
+"""
+TheReposterminator Reddit bot to detect reposts
+Copyright (C) 2023 sardonicism-04
+
+TheReposterminator is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TheReposterminator is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with TheReposterminator.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, deque
+from datetime import datetime
+from types import FrameType
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from TheReposterminator import BotClient
+    from TheReposterminator.types import ProfilingConfig
+
+
+logger = logging.getLogger(__name__)
+
+# A function, as its file, first line and name
+Function = tuple[str, int, str]
+
+# Allocations made by the profiler itself, or while importing modules
+MEMORY_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, __file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+)
+
+
+def describe(function: Function) -> str:
+    """
+    Formats a function for display, with the last two parts of its path
+
+    :param function: The function to format
+    :type function: ``Function``
+
+    :return: The formatted function, i.e. `scan (pkg/sentry.py:81)`
+    :rtype: ``str``
+    """
+    filename, line, name = function
+    path = "/".join(filename.replace(os.sep, "/").split("/")[-2:])
+    return f"{name} ({path}:{line})"
+
+
+def format_size(size: float) -> str:
+    for unit in ("B", "KiB", "MiB"):
+        if abs(size) < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GiB"
+
+
+class Profiler:
+    """
+    Profiles the running bot on demand, without restarting it
+
+    Two kinds of profiling can be switched on and off independently:
+    - CPU profiling samples the stack of every thread at a fixed interval.
+    Samples are taken regardless of whether a thread is running or waiting,
+    so they show where wall-clock time goes rather than CPU time alone.
+    - Memory profiling traces allocations with `tracemalloc`. Each summary
+    compares a snapshot against the previous one, so growth stands out.
+
+    Profiling is toggled with `SIGUSR1` (CPU) and `SIGUSR2` (memory) once
+    `install_signals` is called, with admin DM commands, or at startup with
+    the `--profile` flag. While either is active, a summary is written to the
+    configured directory every `dump_interval` seconds, along with the folded
+    stacks of the CPU profile (which flame graph tools accept) or the raw
+    memory snapshot. A final dump is written when profiling is stopped.
+    """
+
+    def __init__(self, bot: BotClient):
+        self.bot = bot
+
+        self.lock = threading.Lock()
+        self.thread: threading.Thread | None = None
+
+        self.sampling = False
+        self.started_at = 0.0
+        self.samples = 0
+        # Samples in which a function was running, or anywhere on the stack
+        self.own: Counter[Function] = Counter()
+        self.total: Counter[Function] = Counter()
+        self.stacks: Counter[tuple[Function, ...]] = Counter()
+
+        self.previous_snapshot: tracemalloc.Snapshot | None = None
+        self.last_dump = 0.0
+
+        # Signals received by `install_signals`' handlers, yet to be acted on
+        self.signals: deque[int] = deque()
+        self.signalled = threading.Event()
+
+    @property
+    def config(self) -> ProfilingConfig:
+        return self.bot.config.get("profiling", {})
+
+    @property
+    def active(self) -> bool:
+        return self.sampling or tracemalloc.is_tracing()
+
+    # Control
+
+    def start(self):
+        """Starts sampling, discarding any previous samples"""
+        with self.lock:
+            self.sampling = True
+            self.started_at = time.monotonic()
+            self.samples = 0
+            self.own.clear()
+            self.total.clear()
+            self.stacks.clear()
+        self.ensure_thread()
+        logger.info("✅ Started CPU profiling")
+
+    def stop(self):
+        """Stops sampling, and writes a final dump of the samples"""
+        if not self.sampling:
+            return
+        self.sampling = False
+        self.dump_cpu()
+        logger.info("✅ Stopped CPU profiling")
+
+    def start_memory(self):
+        """Starts tracing allocations"""
+        if tracemalloc.is_tracing():
+            return
+        tracemalloc.start(self.config.get("memory_frames", 10))
+        self.previous_snapshot = None
+        self.ensure_thread()
+        logger.info("✅ Started memory profiling")
+
+    def stop_memory(self):
+        """Writes a final dump of allocations, and stops tracing them"""
+        if not tracemalloc.is_tracing():
+            return
+        self.dump_memory()
+        tracemalloc.stop()
+        self.previous_snapshot = None
+        logger.info("✅ Stopped memory profiling")
+
+    def close(self):
+        """Stops all profiling, writing final dumps"""
+        self.stop()
+        self.stop_memory()
+
+    def install_signals(self):
+        """
+        Toggles CPU profiling on `SIGUSR1`, and memory profiling on `SIGUSR2`
+
+        The handlers only queue the signal, which is acted on by a background
+        thread. Starting and stopping take locks and write files, which would
+        deadlock if the interrupted thread was holding the same locks.
+
+        Does nothing on platforms without these signals. Must be called from
+        the main thread.
+        """
+        if not hasattr(signal, "SIGUSR1"):
+            return
+
+        def queue_signal(signum: int, frame: FrameType | None):
+            self.signals.append(signum)
+            self.signalled.set()
+
+        threading.Thread(
+            target=self._handle_signals, name="profiler-signals", daemon=True
+        ).start()
+        signal.signal(signal.SIGUSR1, queue_signal)
+        signal.signal(signal.SIGUSR2, queue_signal)
+        logger.debug(
+            f"Profiling can be toggled with SIGUSR1 and SIGUSR2 "
+            f"(pid {os.getpid()})"
+        )
+
+    def _handle_signals(self):
+        while True:
+            self.signalled.wait()
+            self.signalled.clear()
+            while self.signals:
+                signum = self.signals.popleft()
+                try:
+                    if signum == signal.SIGUSR1:
+                        self.toggle()
+                    else:
+                        self.toggle_memory()
+                except Exception as e:
+                    logger.error(f"Failed to toggle profiling: {e}")
+
+    def toggle(self):
+        """Starts sampling if it is stopped, and stops it otherwise"""
+        if self.sampling:
+            self.stop()
+        else:
+            self.start()
+
+    def toggle_memory(self):
+        """Starts tracing allocations if it is stopped, and stops it otherwise"""
+        if tracemalloc.is_tracing():
+            self.stop_memory()
+        else:
+            self.start_memory()
+
+    def ensure_thread(self):
+        """Starts the background thread that samples and dumps, if needed"""
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.last_dump = time.monotonic()
+            self.thread = threading.Thread(
+                target=self._run, name="profiler", daemon=True
+            )
+            self.thread.start()
+
+    def _run(self):
+        interval = self.config.get("interval", 0.01)
+        dump_interval = self.config.get("dump_interval", 300)
+
+        while self.active:
+            if self.sampling:
+                self.sample()
+            if time.monotonic() - self.last_dump >= dump_interval:
+                self.last_dump = time.monotonic()
+                try:
+                    if self.sampling:
+                        self.dump_cpu()
+                    if tracemalloc.is_tracing():
+                        self.dump_memory()
+                except Exception as e:
+                    logger.error(f"Failed to write profile: {e}")
+            time.sleep(interval if self.sampling else 1)
+
+    # CPU
+
+    def sample(self):
+        """Records the current stack of every thread but this one"""
+        own_thread = threading.get_ident()
+        frames = sys._current_frames()
+
+        with self.lock:
+            for thread_id, frame in frames.items():
+                if thread_id == own_thread:
+                    continue
+
+                stack: list[Function] = []
+                current: FrameType | None = frame
+                while current is not None:
+                    code = current.f_code
+                    stack.append(
+                        (code.co_filename, code.co_firstlineno, code.co_name)
+                    )
+                    current = current.f_back
+
+                self.samples += 1
+                self.own[stack[0]] += 1
+                self.total.update(set(stack))
+                self.stacks[tuple(reversed(stack))] += 1
+
+    def cpu_summary(self, top: int | None = None) -> str:
+        """
+        Summarizes the functions that samples were most often taken in
+
+        :param top: How many functions to include, defaults to the config
+        :type top: ``int | None``
+
+        :return: A table of functions, by their share of samples
+        :rtype: ``str``
+        """
+        top = top or self.config.get("top", 20)
+        with self.lock:
+            samples = self.samples
+            hottest = self.own.most_common(top)
+            total = dict(self.total)
+            duration = time.monotonic() - self.started_at
+
+        lines = [
+            f"CPU profile: {samples} samples over {duration:.0f}s",
+            "",
+            f"{'own%':>6} {'total%':>7}  function",
+        ]
+        for function, count in hottest:
+            lines.append(
+                f"{count / samples * 100:>6.1f} "
+                f"{total[function] / samples * 100:>7.1f}  {describe(function)}"
+            )
+        return "\n".join(lines)
+
+    def dump_cpu(self) -> str:
+        """
+        Writes the CPU profile summary and folded stacks to disk
+
+        :return: The path of the summary
+        :rtype: ``str``
+        """
+        path = self.path("cpu")
+        with open(f"{path}.txt", "w", encoding="utf-8") as file:
+            file.write(self.cpu_summary() + "\n")
+
+        with self.lock:
+            stacks = self.stacks.copy()
+        with open(f"{path}.folded", "w", encoding="utf-8") as file:
+            for stack, count in stacks.items():
+                frames = ";".join(f"{name} ({line})" for _, line, name in stack)
+                file.write(f"{frames} {count}\n")
+
+        logger.info(f"Wrote CPU profile to {path}.txt")
+        return f"{path}.txt"
+
+    # Memory
+
+    def memory_summary(self, top: int | None = None) -> str:
+        """
+        Summarizes the largest allocation sites, and their growth
+
+        Takes a new snapshot, which the next summary is compared against.
+
+        :param top: How many allocation sites to include, defaults to the config
+        :type top: ``int | None``
+
+        :return: A table of allocation sites, by their size
+        :rtype: ``str``
+        """
+        top = top or self.config.get("top", 20)
+        snapshot = tracemalloc.take_snapshot().filter_traces(MEMORY_FILTERS)
+        current, peak = tracemalloc.get_traced_memory()
+
+        lines = [
+            f"Memory: {format_size(current)} traced "
+            f"(peak {format_size(peak)})",
+            "",
+            f"{'size':>11} {'growth':>11} {'blocks':>8}  allocation site",
+        ]
+        if self.previous_snapshot is not None:
+            stats: list[Any] = snapshot.compare_to(
+                self.previous_snapshot, "lineno"
+            )
+        else:
+            stats = snapshot.statistics("lineno")
+
+        for stat in stats[:top]:
+            frame = stat.traceback[0]
+            growth = getattr(stat, "size_diff", 0)
+            lines.append(
+                f"{format_size(stat.size):>11} {format_size(growth):>11} "
+                f"{stat.count:>8}  {frame.filename}:{frame.lineno}"
+            )
+
+        self.previous_snapshot = snapshot
+        return "\n".join(lines)
+
+    def dump_memory(self) -> str:
+        """
+        Writes the memory profile summary and raw snapshot to disk
+
+        The raw snapshot can be loaded with `tracemalloc.Snapshot.load`.
+
+        :return: The path of the summary
+        :rtype: ``str``
+        """
+        path = self.path("memory")
+        summary = self.memory_summary()
+        with open(f"{path}.txt", "w", encoding="utf-8") as file:
+            file.write(summary + "\n")
+        if self.previous_snapshot is not None:
+            self.previous_snapshot.dump(f"{path}.snapshot")
+
+        logger.info(f"Wrote memory profile to {path}.txt")
+        return f"{path}.txt"
+
+    def path(self, kind: str) -> str:
+        directory = self.config.get("directory", "profiles")
+        os.makedirs(directory, exist_ok=True)
+        timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        return os.path.join(directory, f"{kind}-{timestamp}")
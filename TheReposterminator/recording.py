@@ -0,0 +1,387 @@
+"""
+TheReposterminator Reddit bot to detect reposts
+Copyright (C) 2023 sardonicism-04
+
+TheReposterminator is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TheReposterminator is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with TheReposterminator.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import bisect
+import hashlib
+import io
+import json
+import logging
+import threading
+import time
+from datetime import timedelta
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, NamedTuple, Protocol
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from .hosts import MAX_IMAGE_SIZE
+
+if TYPE_CHECKING:
+    from TheReposterminator import BotClient
+
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_VERSION = 1
+# Seconds without a new response after which a replay is considered over
+IDLE_TIMEOUT = 30
+# Headers that describe the original transfer rather than the stored body
+DROPPED_HEADERS = {
+    "connection",
+    "content-encoding",
+    "content-length",
+    "set-cookie",
+    "transfer-encoding",
+}
+
+
+class Transport(Protocol):
+    """Something that takes over the HTTP requests made by a session"""
+
+    def mount(self, session: requests.Session):
+        ...
+
+
+def request_key(method: str, url: str) -> str:
+    """
+    Identifies a request independently of the order of its query parameters
+
+    :param method: The HTTP method of the request
+    :type method: ``str``
+
+    :param url: The URL of the request
+    :type url: ``str``
+
+    :return: The method, host, path and sorted query of the request
+    :rtype: ``str``
+    """
+    parts = urlsplit(url)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return f"{method.upper()} {parts.netloc}{parts.path}?{query}"
+
+
+class Entry(NamedTuple):
+    offset: float
+    status: int
+    reason: str
+    headers: dict[str, str]
+    body: str | None  # The SHA-256 digest of the stored body
+    elapsed: float
+
+
+class Recorder:
+    """
+    Records every response received by the bot into a local archive
+
+    The archive is a directory containing `requests.ndjson`, with a line per
+    response, and a `bodies` directory in which response bodies are stored by
+    their SHA-256 digest, so that media seen more than once is stored once.
+    Bodies of media that the bot would reject for its size aren't stored.
+
+    Mounted over the sessions used for Reddit and for media by passing it as
+    the bot's `transport`. Requests are still sent through the adapters that
+    were previously mounted.
+
+    Note that archives contain the bot's (short-lived) OAuth access token.
+    """
+
+    def __init__(self, directory: str | Path):
+        self.directory = Path(directory)
+        (self.directory / "bodies").mkdir(parents=True, exist_ok=True)
+        (self.directory / "archive.json").write_text(
+            json.dumps({"version": ARCHIVE_VERSION, "recorded_at": time.time()})
+        )
+
+        self.file = open(
+            self.directory / "requests.ndjson", "w", encoding="utf-8"
+        )
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.recorded = 0
+
+    def mount(self, session: requests.Session):
+        for prefix in ("https://", "http://"):
+            session.mount(
+                prefix, RecordingAdapter(self, session.get_adapter(prefix))
+            )
+
+    def record(
+        self,
+        request: requests.PreparedRequest,
+        response: requests.Response,
+        elapsed: float,
+    ):
+        """
+        Appends a response to the archive
+
+        :param request: The request that was sent
+        :type request: ``requests.PreparedRequest``
+
+        :param response: The response that was received
+        :type response: ``requests.Response``
+
+        :param elapsed: How long the request took, in seconds
+        :type elapsed: ``float``
+        """
+        headers = {
+            key: value
+            for key, value in response.headers.items()
+            if key.lower() not in DROPPED_HEADERS
+        }
+        length = response.headers.get("Content-Length", "")
+
+        digest = None
+        if length.isdigit() and int(length) >= MAX_IMAGE_SIZE:
+            headers["Content-Length"] = length  # Replayed without a body
+        else:
+            body = response.content
+            digest = hashlib.sha256(body).hexdigest()
+            path = self.directory / "bodies" / digest
+            if not path.exists():
+                path.write_bytes(body)
+
+        entry = {
+            "key": request_key(request.method or "GET", request.url or ""),
+            **Entry(
+                time.monotonic() - self.started,
+                response.status_code,
+                response.reason or "",
+                headers,
+                digest,
+                elapsed,
+            )._asdict(),
+        }
+        with self.lock:
+            self.file.write(json.dumps(entry) + "\n")
+            self.recorded += 1
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+        logger.info(
+            f"✅ Recorded {self.recorded} responses to {self.directory}"
+        )
+
+
+class RecordingAdapter(BaseAdapter):
+    def __init__(self, recorder: Recorder, inner: BaseAdapter):
+        super().__init__()
+        self.recorder = recorder
+        self.inner = inner
+
+    def send(
+        self, request: requests.PreparedRequest, **kwargs: Any
+    ) -> requests.Response:
+        started = time.perf_counter()
+        response = self.inner.send(request, **kwargs)
+        self.recorder.record(request, response, time.perf_counter() - started)
+        return response
+
+    def close(self):
+        self.inner.close()
+
+
+class Replayer:
+    """
+    Answers the bot's requests from an archive written by a `Recorder`
+
+    Requests are matched to recorded responses by their method, URL, and
+    query parameters. Requests that weren't recorded are answered with a 404.
+
+    At a `speed` of 0, the responses recorded for each request are replayed
+    in order as quickly as they're requested, and the last one is repeated
+    once they run out. Otherwise, time passes `speed` times faster than it
+    did while recording: each request is answered with the latest response
+    that had been recorded for it by that point, after its recorded latency.
+    Replay time starts with the first request.
+    """
+
+    def __init__(self, directory: str | Path, *, speed: float = 0):
+        self.directory = Path(directory)
+        self.speed = speed
+
+        manifest = json.loads((self.directory / "archive.json").read_text())
+        if manifest.get("version") != ARCHIVE_VERSION:
+            raise ValueError(
+                f"Archive {directory} is version {manifest.get('version')}, "
+                f"expected {ARCHIVE_VERSION}"
+            )
+
+        self.entries: dict[str, list[Entry]] = {}
+        path = self.directory / "requests.ndjson"
+        with open(path, encoding="utf-8") as file:
+            for line in file:
+                data = json.loads(line)
+                key = data.pop("key")
+                self.entries.setdefault(key, []).append(Entry(**data))
+        self.offsets = {
+            key: [entry.offset for entry in entries]
+            for key, entries in self.entries.items()
+        }
+        self.duration = max(
+            (offsets[-1] for offsets in self.offsets.values()), default=0
+        )
+
+        self.lock = threading.Lock()
+        self.positions = dict.fromkeys(self.entries, 0)
+        self.started: float | None = None
+        self.last_fresh = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def elapsed(self) -> float:
+        """The time that has passed in the recording"""
+        if self.started is None:
+            return 0
+        return (time.monotonic() - self.started) * self.speed
+
+    @property
+    def exhausted(self) -> bool:
+        """
+        Whether the recording is over
+
+        At a speed of 0, this is once every recorded response has been
+        replayed, or once none have been replayed for the first time in
+        `IDLE_TIMEOUT` seconds (as some may never be requested again).
+        """
+        if self.speed > 0:
+            return self.elapsed > self.duration
+        if self.started is None:
+            return False
+        return time.monotonic() - self.last_fresh > IDLE_TIMEOUT or all(
+            self.positions[key] >= len(entries)
+            for key, entries in self.entries.items()
+        )
+
+    def mount(self, session: requests.Session):
+        adapter = ReplayAdapter(self)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+    def respond(self, request: requests.PreparedRequest) -> requests.Response:
+        """
+        Builds the recorded response to a request
+
+        :param request: The request to answer
+        :type request: ``requests.PreparedRequest``
+
+        :return: The recorded response, or a 404 if there isn't one
+        :rtype: ``requests.Response``
+        """
+        key = request_key(request.method or "GET", request.url or "")
+        with self.lock:
+            if self.started is None:
+                self.started = self.last_fresh = time.monotonic()
+
+            if (entries := self.entries.get(key)) is None:
+                self.misses += 1
+                logger.debug("No recorded response to %s", key)
+                missing = Entry(0, 404, "Not Found", {}, None, 0)
+                return self.build(request, missing)
+            self.hits += 1
+
+            if self.speed == 0:
+                position = min(self.positions[key], len(entries) - 1)
+                if self.positions[key] < len(entries):
+                    self.last_fresh = time.monotonic()
+                self.positions[key] += 1
+            else:
+                # The latest response recorded by now, or the first if none were
+                recorded = bisect.bisect_right(self.offsets[key], self.elapsed)
+                position = max(recorded - 1, 0)
+            entry = entries[position]
+
+        if self.speed > 0:
+            time.sleep(entry.elapsed / self.speed)
+        return self.build(request, entry)
+
+    def build(
+        self, request: requests.PreparedRequest, entry: Entry
+    ) -> requests.Response:
+        body = b""
+        if entry.body is not None:
+            body = (self.directory / "bodies" / entry.body).read_bytes()
+
+        response = requests.Response()
+        response.status_code = entry.status
+        response.reason = entry.reason
+        response.headers = CaseInsensitiveDict(entry.headers)
+        if entry.body is not None:
+            response.headers["Content-Length"] = str(len(body))
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.raw = io.BytesIO(body)
+        # The body is already available, so it's served as if it was read
+        response._content = body
+        response._content_consumed = True
+        response.url = request.url or ""
+        response.request = request
+        response.elapsed = timedelta(seconds=entry.elapsed)
+        return response
+
+
+class ReplayAdapter(BaseAdapter):
+    def __init__(self, replayer: Replayer):
+        super().__init__()
+        self.replayer = replayer
+
+    def send(
+        self, request: requests.PreparedRequest, **kwargs: Any
+    ) -> requests.Response:
+        return self.replayer.respond(request)
+
+    def close(self):
+        pass
+
+
+def summarize(bot: BotClient, elapsed: float) -> str:
+    """
+    Summarizes the throughput and stage latencies of a run of the bot
+
+    :param bot: The bot that ran
+    :type bot: ``BotClient``
+
+    :param elapsed: How long the bot ran for, in seconds
+    :type elapsed: ``float``
+
+    :return: The summary
+    :rtype: ``str``
+    """
+    metrics = bot.metrics
+    outcomes = {
+        dict(labels).get("outcome", ""): count
+        for labels, count in metrics.submissions.values.items()
+    }
+    handled = sum(outcomes.values())
+    lines = [
+        f"Ran for {elapsed:.1f}s, handling {handled} submissions "
+        f"({handled / max(elapsed, 1e-9):.1f}/s)",
+        *(f"  {outcome}: {count:.0f}" for outcome, count in outcomes.items()),
+        "Mean stage latency:",
+    ]
+    for labels, (count, total) in metrics.stage_seconds.totals().items():
+        lines.append(
+            f"  {dict(labels).get('stage', '')}: "
+            f"{total / max(count, 1) * 1000:.2f}ms over {count}"
+        )
+    return "\n".join(lines)
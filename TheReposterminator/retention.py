@@ -0,0 +1,252 @@
+"""
+TheReposterminator Reddit bot to detect reposts
+Copyright (C) 2023 sardonicism-04
+
+TheReposterminator is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TheReposterminator is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with TheReposterminator.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import gzip
+import logging
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from .notifications import EXPIRE_CHANNEL, INVALIDATE_CHANNEL, publish
+
+if TYPE_CHECKING:
+    import psycopg2
+
+    from TheReposterminator import BotClient
+    from TheReposterminator.types import RetentionConfig
+
+
+logger = logging.getLogger(__name__)
+
+
+class RetentionPolicy:
+    """
+    Prunes stored media data that is no longer needed
+
+    Two kinds of rows are pruned from `media_storage`:
+    - Rows of subreddits that the bot was removed from longer ago than the
+    configured grace period
+    - Rows of posts that are older than the configured horizon
+
+    Finished moderation actions are also pruned from `moderation_actions`,
+    old permanent failures from `submission_failures`, and old detection
+    records from `detection_lag`.
+
+    If an archive directory is configured, pruned rows are first written to
+    compressed CSV files within it, from the same snapshot of the database
+    that they are then deleted from.
+    """
+
+    def __init__(self, bot: BotClient):
+        self.bot = bot
+
+        self.last_run = time.monotonic()
+
+    @property
+    def config(self) -> RetentionConfig:
+        return self.bot.config.get("retention", {})
+
+    @property
+    def horizon(self) -> int:
+        """The creation timestamp of the oldest posts kept, or `0` if all are"""
+        if (max_age_days := self.config.get("max_age_days", 0)) <= 0:
+            return 0
+        return int(time.time()) - max_age_days * 86_400
+
+    def run_if_due(self):
+        """Applies the policy if the configured interval has elapsed"""
+        interval = self.config.get("interval", 86_400)
+        if time.monotonic() - self.last_run >= interval:
+            self.apply()
+
+    def apply(self):
+        """
+        Applies the retention policy
+
+        Each pruning step is committed on its own, so that a failure part way
+        through does not roll back the work that has already been done.
+        """
+        self.last_run = time.monotonic()
+
+        if (grace_days := self.config.get("departed_grace_days", 0)) > 0:
+            self.prune_departed(grace_days)
+
+        if (max_age_days := self.config.get("max_age_days", 0)) > 0:
+            self.prune_old(max_age_days)
+
+        self.bot.actions.prune(
+            self.bot.actions.config.get("keep_days", 30)
+        )
+        self.bot.failures.prune(
+            self.bot.failures.config.get("keep_days", 30)
+        )
+        self.bot.lag.prune(self.bot.lag.config.get("keep_days", 30))
+
+    @contextmanager
+    def archiving(
+        self, name: str, query: str, params: tuple
+    ) -> Iterator[psycopg2.cursor]:
+        """
+        Writes the result of a query to a compressed CSV file, if configured,
+        and yields a cursor to delete the archived rows with
+
+        The archive is written and the rows are deleted in a single
+        `REPEATABLE READ` transaction, so exactly the archived rows can be
+        deleted. If the transaction fails, the archive is discarded.
+
+        :param name: The name to give the archive file
+        :type name: ``str``
+
+        :param query: The query selecting the rows to archive
+        :type query: ``str``
+
+        :param params: The parameters of the query
+        :type params: ``tuple``
+
+        :return: A context manager yielding the transaction's cursor
+        :rtype: ``Iterator[psycopg2.cursor]``
+        """
+        path = None
+        try:
+            with self.bot.pool.connection() as conn, conn.cursor() as cur:
+                cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+
+                if directory := self.config.get("archive_directory"):
+                    Path(directory).mkdir(parents=True, exist_ok=True)
+                    stamp = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S")
+                    path = Path(directory) / f"{name}-{stamp}.csv.gz"
+                    with gzip.open(path, "wb") as file:
+                        copy_query = cur.mogrify(query, params).decode()
+                        cur.copy_expert(
+                            f"COPY ({copy_query}) TO STDOUT WITH CSV HEADER",
+                            file,
+                        )
+
+                yield cur
+
+        except BaseException:
+            if path is not None:
+                path.unlink(missing_ok=True)
+            raise
+
+        if path is not None:
+            logger.info(f"Archived {name} media data to {path}")
+
+    def prune_departed(self, grace_days: int):
+        """
+        Deletes the media data of subreddits that the bot has left
+
+        The deleted submissions are also removed from `indexed_submissions`,
+        so that they are indexed again if the bot is ever re-added.
+
+        :param grace_days: The number of days to keep data after departure
+        :type grace_days: ``int``
+        """
+        with self.bot.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT name FROM
+                    departed_subreddits
+                WHERE
+                    departed_at < NOW() - make_interval(days => %s)
+                """,
+                (grace_days,),
+            )
+            departed: list[str] = [row[0] for row in cur.fetchall()]
+
+        for subname in departed:
+            with self.archiving(
+                subname.lower(),
+                """
+                SELECT hash, submission_id, subname, created_utc FROM
+                    media_storage
+                WHERE
+                    subname=%s
+                """,
+                (subname,),
+            ) as cur:
+                cur.execute(
+                    """
+                    WITH deleted AS (
+                        DELETE FROM media_storage
+                        WHERE subname=%s
+                        RETURNING submission_id
+                    )
+                    DELETE FROM indexed_submissions
+                    WHERE id IN (SELECT submission_id FROM deleted)
+                    """,
+                    (subname,),
+                )
+                cur.execute(
+                    "DELETE FROM departed_subreddits WHERE name=%s", (subname,)
+                )
+                cur.execute(
+                    "DELETE FROM subreddit_config_changes WHERE name=%s",
+                    (subname,),
+                )
+
+            self.bot.index.invalidate(subname)
+            publish(self.bot, INVALIDATE_CHANNEL, subname)
+            logger.info(f"✅ Pruned media data of departed r/{subname}")
+
+    def prune_old(self, max_age_days: int):
+        """
+        Deletes the media data of posts older than the configured horizon
+
+        Posts of an unknown age are never deleted. The deleted rows are removed
+        from the indexes and snapshots of every process, without rebuilding
+        them from the database.
+
+        :param max_age_days: The maximum age of a post to keep, in days
+        :type max_age_days: ``int``
+        """
+        horizon = int(time.time()) - max_age_days * 86_400
+
+        with self.archiving(
+            "expired",
+            """
+            SELECT hash, submission_id, subname, created_utc FROM
+                media_storage
+            WHERE
+                created_utc BETWEEN 1 AND %s
+            """,
+            (horizon,),
+        ) as cur:
+            cur.execute(
+                """
+                WITH deleted AS (
+                    DELETE FROM media_storage
+                    WHERE created_utc BETWEEN 1 AND %s
+                    RETURNING subname
+                )
+                SELECT subname, COUNT(*) FROM deleted GROUP BY subname
+                """,
+                (horizon,),
+            )
+            pruned: list[tuple[str, int]] = cur.fetchall()
+
+        for subname, count in pruned:
+            self.bot.index.expire(subname, horizon)
+            publish(
+                self.bot, EXPIRE_CHANNEL, {"subname": subname, "horizon": horizon}
+            )
+            logger.info(f"✅ Pruned {count} expired posts from r/{subname}")
@@ -0,0 +1,250 @@
+"""
+TheReposterminator Reddit bot to detect reposts
+Copyright (C) 2023 sardonicism-04
+
+TheReposterminator is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TheReposterminator is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with TheReposterminator.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import traceback
+from collections.abc import Callable, Coroutine
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any
+
+import psycopg2
+from prawcore import exceptions
+
+if TYPE_CHECKING:
+    from TheReposterminator import BotClient
+
+    from .types import SubData
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncRuntime:
+    """
+    Runs the bot's components concurrently on an asyncio event loop
+
+    The inbox, the subreddit scans, the moderation action queue, and periodic
+    maintenance each run as a separate task, so that a slow scan no longer
+    delays handling messages, and several subreddits can be scanned at once.
+
+    The bot's Reddit, HTTP and database clients are blocking, so each unit of
+    work is run on a worker thread with `asyncio.to_thread`. Each worker
+    thread has its own Reddit connection, and the connection pools are sized
+    to give every worker thread a connection. Concurrency is bounded per
+    resource:
+    - At most `max_concurrent_scans` subreddits are scanned at once, and each
+    subreddit is scanned by at most one task
+    - The inbox is handled by a single task, every `inbox_interval` seconds
+    - Moderation actions are performed by a single task, unless they are
+    performed by a dedicated process
+    - Index lookups and updates, including loading and replaying indexes,
+    are serialized by the `IndexStore` lock, so scans overlap in their Reddit
+    and media requests rather than in matching
+
+    Errors are handled the same way as in the blocking loop: Reddit server
+    errors terminate the runtime, while any other error is logged, and the
+    failed unit of work is retried on its next pass.
+    """
+
+    def __init__(
+        self,
+        bot: BotClient,
+        *,
+        max_concurrent_scans: int = 4,
+        inbox_interval: float = 5,
+    ):
+        self.bot = bot
+        self.max_concurrent_scans = max_concurrent_scans
+        self.inbox_interval = inbox_interval
+
+        self.scan_slots = asyncio.Semaphore(max_concurrent_scans)
+
+    async def run(self):
+        """Runs every task until one fails with a Reddit server error"""
+        # Leave room for the inbox, action and maintenance tasks beside the
+        # scans
+        workers = self.max_concurrent_scans + 3
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=workers, thread_name_prefix="rterm")
+        )
+        for pool in (self.bot.pool, self.bot.reads.replica):
+            if pool is not None and pool.max_connections < workers:
+                logger.info(
+                    f"Raising the {pool.name} pool's connection limit from "
+                    f"{pool.max_connections} to {workers} for the worker threads"
+                )
+                pool.max_connections = workers
+
+        tasks = [
+            asyncio.create_task(coro)
+            for coro in (
+                self.inbox_loop(),
+                self.scan_loop(),
+                self.maintenance_loop(),
+            )
+        ]
+        if self.bot.actions.inline:
+            tasks.append(asyncio.create_task(self.action_loop()))
+        try:
+            await asyncio.gather(*tasks)
+        except exceptions.ServerError as e:
+            logger.critical(
+                f"Encountered server error, terminating runtime"
+                f" [code {e.response.status_code}]: {e}"
+            )
+        finally:
+            await self.cancel(tasks)
+
+    @staticmethod
+    async def cancel(tasks: list[asyncio.Task[Any]]):
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def guarded(
+        self, description: str, func: Callable[..., Any], *args: Any
+    ):
+        """
+        Runs a blocking unit of work on a worker thread, logging its errors
+
+        :param description: What the work does, used in log messages
+        :type description: ``str``
+
+        :param func: The blocking function to call
+        :type func: ``Callable[..., Any]``
+
+        :raises prawcore.exceptions.ServerError: If Reddit has a server error
+        """
+        try:
+            await asyncio.to_thread(func, *args)
+
+        except exceptions.ServerError:
+            raise
+
+        except psycopg2.Error as e:
+            logger.error(
+                f"Encountered SQL error while {description}, retrying [{e}]"
+            )
+            logger.debug(f"Connection pool stats: {self.bot.pool.stats}")
+
+        except Exception as e:
+            exc_info = (type(e), e, e.__traceback__)
+            formatted = "".join(traceback.format_exception(*exc_info)).rstrip()
+            logger.error(
+                f"Suppressed unhandled exception while {description}\n"
+                f"{formatted}"
+            )
+
+    async def forever(
+        self, make_pass: Callable[[], Coroutine[Any, Any, None]], delay: float
+    ):
+        while True:
+            await make_pass()
+            await asyncio.sleep(delay)
+
+    async def inbox_loop(self):
+        """Handles messages every `inbox_interval` seconds"""
+
+        async def make_pass():
+            await self.guarded("handling messages", self.bot.handle_messages)
+
+        await self.forever(make_pass, self.inbox_interval)
+
+    async def action_loop(self):
+        """Performs queued moderation actions as they become due"""
+        poll_interval = self.bot.actions.config.get("poll_interval", 5)
+
+        async def make_pass():
+            await self.guarded(
+                "performing moderation actions", self.bot.actions.drain
+            )
+
+        await self.forever(make_pass, poll_interval)
+
+    async def scan_loop(self):
+        """
+        Repeatedly scans every active subreddit
+
+        Each pass starts a scan for every active subreddit, and waits for all
+        of them to finish before starting the next pass.
+        """
+
+        async def make_pass():
+            if not (subreddits := [*self.bot.active_subreddits()]):
+                await asyncio.sleep(5)  # Nothing to do until subs are added
+                return
+
+            scans = [asyncio.create_task(self.scan(sub)) for sub in subreddits]
+            try:
+                await asyncio.gather(*scans)
+            finally:
+                await self.cancel(scans)
+
+        await self.forever(make_pass, 0)
+
+    async def scan(self, sub: SubData):
+        """
+        Scans a single subreddit once a scan slot is available
+
+        :param sub: The subreddit to scan
+        :type sub: ``SubData``
+        """
+        async with self.scan_slots:
+            # Leases may have changed while waiting for a slot
+            leases = self.bot.leases
+            if leases is not None and sub.subname not in leases.owned:
+                return
+
+            if not sub.indexed:
+                # Needs to be full-scanned first
+                await self.guarded(
+                    f"indexing r/{sub.subname}",
+                    self.bot.sentry.scan_new_sub,
+                    sub,
+                )
+            else:
+                await self.guarded(
+                    f"scanning r/{sub.subname}",
+                    self.bot.sentry.scan_submissions,
+                    sub,
+                )
+
+    async def maintenance_loop(self):
+        """
+        Renews leases, rewrites snapshots, and applies the retention policy
+
+        Each is only done once its own configured interval has elapsed.
+        """
+
+        async def make_pass():
+            if self.bot.leases is not None:
+                await self.guarded(
+                    "refreshing leases", self.bot.leases.refresh_if_due
+                )
+            await self.guarded(
+                "saving index snapshots", self.bot.index.save_if_due
+            )
+            if self.bot.owns_inbox():
+                await self.guarded(
+                    "applying the retention policy",
+                    self.bot.retention.run_if_due,
+                )
+
+        await self.forever(make_pass, 1)
@@ -20,19 +20,18 @@ from __future__ import annotations
 import logging
 import math
 import operator
-from contextlib import suppress
+import time
 from datetime import datetime
 from typing import TYPE_CHECKING, Optional, cast
 
-import requests
-from praw.models.reddit.comment import CommentModeration
-from praw.models.reddit.submission import SubmissionModeration
 from prawcore import exceptions
 
 from image_hash import generate_hash
 
-from .common import get_matches
-from .types import Match, MediaData, SubData
+from .budget import Priority
+from .common import annotate_title, get_matches
+from .failures import PermanentFailure
+from .types import Action, Match, MediaData, SubData
 
 if TYPE_CHECKING:
     from praw.models.reddit.submission import Submission
@@ -54,42 +53,31 @@ class Sentry:
     def __init__(self, bot: BotClient):
         self.bot = bot
 
-        # Store problematic IDs in a cache to prevent recurring errors
-        self.ignored_id_cache: set[str] = set()
-
-    @staticmethod
-    def fetch_media(img_url: str) -> Optional[bytes]:
+    def fetch_media(self, img_url: str) -> Optional[bytes]:
         """
         Fetches submission media and returns the image bytes
 
         First verifies that the image extension is one of "jpg", "png", or "jpeg",
         returning `None` if not.
 
-        Then performs a GET request to the URL. If the response code is 404,
-        returns `None`. If the image size is less than ~90 million bytes, the
-        image bytes are returned. Otherwise, `None` is returned.
+        Then fetches the URL through the bot's `HostGuard`, which isolates the
+        bot from slow or failing media hosts.
 
         :param img_url: The image URL to fetch
         :type img_url: ``str``
 
-        :return: The bytes if the response is valid, otherwise `None`
+        :return: The bytes if the URL is an image, otherwise `None`
         :rtype: ``Optional[bytes]``
+
+        :raises DeferredFailure: If the media host can't accept the request
+        :raises PermanentFailure: If the image is gone, or excessively large
+        :raises TransientFailure: If the request times out, fails to connect,
+            or is met with a server error or ratelimit
         """
         if not any(ext in img_url for ext in (".jpg", ".png", ".jpeg")):
             return None
 
-        with requests.get(img_url) as resp:
-            if resp.status_code == 404:
-                logger.debug("Ignoring 404 on fetch_media")
-                return None
-
-            image_bytes = resp.content
-
-            if len(image_bytes) < 89_478_485:
-                return image_bytes
-            else:
-                logger.debug("Ignoring excessively large image")
-                return None
+        return self.bot.hosts.fetch(img_url)
 
     def handle_submission(self, submission: Submission, *, report: bool):
         """
@@ -97,13 +85,12 @@ class Sentry:
 
         First checks if the submission ID has already been indexed, and returns
         if so (submissions only need to be indexed once). Also exits if the
-        submission is a self post, or if the submission ID is already being
-        ignored due to errors.
+        submission is a self post, or if a previous attempt to process it
+        failed and it is waiting to be retried.
 
         Then, fetches the media from the submission URL, and generates a hash
-        of the image, returning if hash generation fails. Calls `get_matches` to
-        find indexed posts for which the compared similarity is greater than the
-        configured threshold.
+        of the image. Calls `get_matches` to find indexed posts for which the
+        compared similarity is greater than the configured threshold.
 
         If matches are found, `self.do_report` is called, reporting and commenting
         under the parent submission.
@@ -112,7 +99,9 @@ class Sentry:
         reported (used when initially indexing a subreddit).
 
         Regardless of whether a match is found, the submission is added
-        to the `indexed_submissions` and `media_storage` tables.
+        to the `indexed_submissions` and `media_storage` tables. If processing
+        fails, the failure is recorded with the bot's `FailureCache` instead,
+        which decides if and when the submission is retried.
 
         :param submission: The parent submission to handle
         :type submission: ``Submission``
@@ -120,62 +109,170 @@ class Sentry:
         :param report: Whether the submission is allowed to be reported
         :type report: ``bool``
         """
-        if submission.is_self or submission.id in self.ignored_id_cache:
+        first_seen = time.time()
+        failures = self.bot.failures
+        metrics = self.bot.metrics
+        if submission.is_self or failures.waiting(submission.id):
+            metrics.submissions.inc(outcome="skipped")
             return
 
-        # Checks that the submission has not already been indexed
-        cur = self.bot.db.cursor()
-        cur.execute(
-            "SELECT COUNT(*) FROM indexed_submissions WHERE id=%s",
-            (submission.id,),
-        )
-        if (cur.fetchone() or [])[-1] >= 1:
-            self.bot.db.commit()  # Avoids "idle in transaction"
+        # Checks that the submission has not already been indexed, and that it
+        # isn't waiting to be retried
+        with (
+            metrics.stage_seconds.time(stage="check"),
+            self.bot.pool.connection() as conn,
+            conn.cursor() as cur,
+        ):
+            cur.execute(
+                """
+                SELECT
+                    EXISTS(SELECT 1 FROM indexed_submissions WHERE id=%(id)s),
+                    failures.retry_in,
+                    failures.first_seen_at
+                FROM (SELECT 1) AS placeholder
+                LEFT JOIN (
+                    SELECT
+                        EXTRACT(EPOCH FROM next_attempt_at - NOW()) AS retry_in,
+                        first_seen_at
+                    FROM submission_failures
+                    WHERE submission_id=%(id)s
+                ) AS failures ON TRUE
+                """,
+                {"id": submission.id},
+            )
+            indexed, retry_in, seen_before = cur.fetchone() or (
+                False,
+                None,
+                None,
+            )
+
+        if indexed or (retry_in is not None and retry_in > 0):
+            if not indexed:
+                failures.remember(submission.id, float(retry_in))
+            metrics.submissions.inc(outcome="skipped")
             return
 
+        # Retried submissions were first seen by an earlier attempt
+        first_seen = failures.first_seen(submission.id, first_seen, seen_before)
         img_url: str = submission.url.replace("m.imgur.com", "i.imgur.com")
 
         try:
-            if (media := self.fetch_media(img_url)) is None:
-                return
+            with metrics.stage_seconds.time(stage="fetch_media"):
+                media = self.fetch_media(img_url)
+            if media is not None:
+                self.store_media(
+                    submission, media, report=report, first_seen=first_seen
+                )
 
-            image_hash = generate_hash(media)
-            if image_hash == 0:
-                return  # This image couldn't be opened
+        except Exception as e:
+            logger.warning(f"Error processing submission {submission.id}: {e}")
+            failures.record(submission.id, e, first_seen=first_seen)
+            metrics.submissions.inc(outcome=type(e).__name__)
+            return
 
-            parent = MediaData(
-                str(image_hash), submission.id, str(submission.subreddit)
+        metrics.submissions.inc(
+            outcome="not_image" if media is None else "indexed"
+        )
+
+        with self.bot.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                "INSERT INTO indexed_submissions (id) VALUES (%s)",
+                (submission.id,),
             )
-            if report and (
-                matches := [
+        logger.debug("Added %s to indexed_submissions", submission.id)
+
+        if retry_in is not None:
+            failures.clear(submission.id)
+
+    def store_media(
+        self,
+        submission: Submission,
+        media: bytes,
+        *,
+        report: bool,
+        first_seen: float,
+    ):
+        """
+        Hashes a submission's media, reports it if needed, and stores the hash
+
+        When reporting is allowed, the detection lag of the submission is also
+        recorded with the bot's `LagTracker`.
+
+        :param submission: The submission the media belongs to
+        :type submission: ``Submission``
+
+        :param media: The image bytes of the submission
+        :type media: ``bytes``
+
+        :param report: Whether the submission is allowed to be reported
+        :type report: ``bool``
+
+        :param first_seen: When the submission was first seen by the bot
+        :type first_seen: ``float``
+
+        :raises PermanentFailure: If the image couldn't be opened
+        """
+        metrics = self.bot.metrics
+        with metrics.stage_seconds.time(stage="generate_hash"):
+            image_hash = generate_hash(media)
+        hashed_at = time.time()
+        if image_hash == 0:
+            raise PermanentFailure("Undecodable image")
+
+        parent = MediaData(
+            str(image_hash),
+            submission.id,
+            str(submission.subreddit),
+            int(submission.created_utc),
+        )
+        if report:
+            with metrics.stage_seconds.time(stage="get_matches"):
+                matches = [
                     *get_matches(self.bot, parent, submission, mode="sentry")
                 ]
-            ):
+            if matches:
                 matches = sorted(
                     matches, key=operator.attrgetter("similarity"), reverse=True
                 )[:25]
-                self.do_report(submission, matches)
-
-            self.bot.insert_cursor.execute(
-                "INSERT INTO media_storage VALUES(%s, %s, %s)", (*parent,)
+                with metrics.stage_seconds.time(stage="report"):
+                    self.do_report(submission, matches)
+
+        # A previous attempt may have stored the row before failing
+        with (
+            metrics.stage_seconds.time(stage="store"),
+            self.bot.pool.connection() as conn,
+            conn.cursor() as cur,
+        ):
+            cur.execute(
+                """
+                INSERT INTO media_storage
+                    (hash, submission_id, subname, created_utc)
+                VALUES(%s, %s, %s, %s)
+                ON CONFLICT DO NOTHING
+                RETURNING row_id, pg_current_wal_lsn()::text""",
+                (*parent,),
             )
-            logger.debug(f"{submission.id} processed, added to media_storage")
-
-        except Exception as e:
-
-            logger.warn(f"Error processing submission {submission.id}: {e}")
-            self.ignored_id_cache.add(submission.id)
-            self.bot.db.commit()
-            return
+            row = cur.fetchone()
+            if report:
+                self.bot.lag.record(
+                    cur,
+                    submission_id=submission.id,
+                    subname=parent.subname,
+                    created_utc=parent.created_utc,
+                    first_seen=first_seen,
+                    hashed_at=hashed_at,
+                )
 
-        finally:
-            self.bot.insert_cursor.execute(
-                "INSERT INTO indexed_submissions (id) VALUES (%s)",
-                (submission.id,),
+        if row is not None:
+            self.bot.reads.note_write(row[1])
+            self.bot.index.add(
+                parent.subname,
+                image_hash,
+                submission.id,
+                parent.created_utc,
+                row[0],
             )
-            logger.debug(f"Added {submission.id} to indexed_submissions")
-            cur.close()
-            self.bot.db.commit()
+        logger.debug("%s processed, added to media_storage", submission.id)
 
     def do_report(self, submission: Submission, matches: list[Match]):
         """
@@ -185,11 +282,10 @@ class Sentry:
         that range, then the function returns immediately.
 
         Generates a formatted table of data based on the parent submission and
-        the matches found. Reports the submission and replies to it with the
-        table.
-
-        Suppressing exceptions (for in case a server-side error occurs), the
-        comment is then removed based on the subreddit's configuration.
+        the matches found. Queues a report of the submission, and a reply to it
+        with the table, which is removed based on the subreddit's
+        configuration. The actions are performed by the bot's `ActionQueue`,
+        so that scanning doesn't wait on them.
 
         :param submission: The parent submission to reply to and report
         :type submission: ``Submission``
@@ -242,7 +338,7 @@ class Sentry:
                 getattr(post.author, "name", "[deleted]"),
                 created_at.strftime("%a, %b %d, %Y at %H:%M:%S UTC"),
                 f"[URL]({post.url})" if post.url else "No URL",
-                post.title,
+                annotate_title(post.title, match, submission),
                 post.id,
                 cur_score,
                 cur_status,
@@ -252,22 +348,32 @@ class Sentry:
             if len(rows + row) < 5000:
                 rows += row
 
-        submission.report(
-            f"Possible repost ( {len(matches)} matches |"
-            f" {len(matches) - active} removed/deleted )"
+        self.bot.actions.enqueue(
+            Action(
+                f"report:{submission.id}",
+                "report",
+                submission.id,
+                {
+                    "reason": f"Possible repost ( {len(matches)} matches |"
+                    f" {len(matches) - active} removed/deleted )"
+                },
+            ),
+            Action(
+                f"reply:{submission.id}",
+                "reply",
+                submission.id,
+                {
+                    "body": self.bot.config["templates"]["info_auto"].format(
+                        rows
+                    ),
+                    "remove": sub_config["remove_sentry_comments"],
+                },
+            ),
         )
-        reply = self.bot.reply(
-            self.bot.config["templates"]["info_auto"].format(rows),
-            target=submission,
-        )
-
-        with suppress(Exception):
-            if sub_config["remove_sentry_comments"]:
-                CommentModeration(reply).remove(spam=False)
 
-            # if auto removal enabled, call `self.auto_remove`
-            if sub_config["autoremove"]:
-                self.auto_remove(submission, matches_posts)
+        # if auto removal enabled, call `self.auto_remove`
+        if sub_config["autoremove"]:
+            self.auto_remove(submission, matches_posts)
 
         logger.info(
             f"✅ https://redd.it/{submission.id} | "
@@ -286,7 +392,8 @@ class Sentry:
         - The lowest match similarity is greater than the configured minimum
         similarity
 
-        If any condition is not met, no removal is performed.
+        If any condition is not met, no removal is performed. Otherwise, the
+        removal and its reply are queued with the bot's `ActionQueue`.
 
         :param submission: The parent submission to remove
         :type submission: ``Submission``
@@ -300,46 +407,63 @@ class Sentry:
         if lowest_similarity[0].similarity < sub_config["autoremove_threshold"]:
             return
 
+        actions: list[Action] = []
         if sub_config["autoremove_reply"] is True:
-            with suppress(Exception):
-                reply = self.bot.reply(
-                    self.bot.config["templates"]["autoremove_message"],
-                    target=submission,
+            actions.append(
+                Action(
+                    f"autoremove_reply:{submission.id}",
+                    "reply",
+                    submission.id,
+                    {
+                        "body": self.bot.config["templates"][
+                            "autoremove_message"
+                        ],
+                        "sticky": True,
+                    },
                 )
-                CommentModeration(reply).distinguish(how="yes", sticky=True)
-
-        try:
-            SubmissionModeration(submission).remove(
-                mod_note="Repost auto-removal (lowest similarity > configured minimum)",
-                spam=False,
-            )
-            logger.info(
-                f"✅ Successfully auto-removed https://redd.it/{submission.id}"
             )
-        except Exception as e:
-            logger.info(
-                f"❌ Failed to auto-remove https://redd.it/{submission.id}: {e}"
+        actions.append(
+            Action(
+                f"remove:{submission.id}",
+                "remove",
+                submission.id,
+                {
+                    "mod_note": "Repost auto-removal "
+                    "(lowest similarity > configured minimum)"
+                },
             )
+        )
+        self.bot.actions.enqueue(*actions)
 
     def scan_submissions(self, sub: SubData):
         """
         Scans /new/ for an already indexed subreddit
 
         Iterates the posts in a subreddit's /new/ listing, and calls
-        `self.handle_submission` for each, with `report` set to `True`.
+        `self.handle_submission` for each, with `report` set to `True`. The
+        scan stops early if this worker loses the subreddit's lease.
 
         :param sub: The subreddit to scan
         :type sub: ``SubData``
         """
         try:
             subreddit: Subreddit = self.bot.reddit.subreddit(sub.subname)
-            for submission in subreddit.new():  # TODO: Maximize the limit?
-                self.handle_submission(submission, report=True)
+            with (
+                self.bot.budget.priority(Priority.SCAN),
+                self.bot.metrics.pass_seconds.time(
+                    subreddit=sub.subname, kind="scan"
+                ),
+            ):
+                for submission in subreddit.new():  # TODO: Maximize the limit?
+                    if not self.bot.owns(sub.subname):
+                        logger.info(f"Lost the lease on r/{sub.subname}")
+                        return
+                    self.handle_submission(submission, report=True)
 
-            logger.debug(f"Scanned r/{sub.subname} for new posts")
+            logger.debug("Scanned r/%s for new posts", sub.subname)
 
         except exceptions.PrawcoreException as e:
-            logger.debug(f"Failed to scan r/{sub.subname}: {e}")
+            logger.debug("Failed to scan r/%s: %s", sub.subname, e)
 
     def scan_new_sub(self, sub: SubData):
         """
@@ -347,31 +471,46 @@ class Sentry:
 
         Iterates the posts in a subreddit's /top/ of all time, the last year,
         and the last month, and calls `self.handle_submission` for each, with
-        `report` set to `False`.
+        `report` set to `False`. Requests are made at backfill priority. The
+        scan stops early, without marking the subreddit as indexed, if this
+        worker loses the subreddit's lease.
 
         :param sub: The subreddit to index
         :type sub: ``SubData``
         """
         try:
-            for time in ("all", "year", "month"):
-                subreddit: Subreddit = self.bot.reddit.subreddit(sub.subname)
-                for submission in subreddit.top(
-                    time_filter=time
-                ):  # TODO: Maximize the limit?
-                    logger.debug(
-                        f"Indexing {submission.fullname} from r/{sub.subname}"
+            with (
+                self.bot.budget.priority(Priority.BACKFILL),
+                self.bot.metrics.pass_seconds.time(
+                    subreddit=sub.subname, kind="index"
+                ),
+            ):
+                for time_filter in ("all", "year", "month"):
+                    subreddit: Subreddit = self.bot.reddit.subreddit(
+                        sub.subname
                     )
-                    self.handle_submission(submission, report=False)
+                    for submission in subreddit.top(
+                        time_filter=time_filter
+                    ):  # TODO: Maximize the limit?
+                        if not self.bot.owns(sub.subname):
+                            # Left for the worker now leasing it to index
+                            logger.info(f"Lost the lease on r/{sub.subname}")
+                            return
+                        logger.debug(
+                            "Indexing %s from r/%s",
+                            submission.fullname,
+                            sub.subname,
+                        )
+                        self.handle_submission(submission, report=False)
 
         except exceptions.PrawcoreException as e:
             logger.error(f"Failed to initially index r/{sub.subname}: {e}")
 
-        with self.bot.db.cursor() as cur:
+        with self.bot.pool.connection() as conn, conn.cursor() as cur:
             cur.execute(
                 "UPDATE subreddits SET indexed=TRUE WHERE name=%s",
                 (sub.subname,),
             )
 
-        self.bot.db.commit()
         logger.info(f"✅ Fully indexed r/{sub.subname}")
         self.bot.update_subs()
@@ -0,0 +1,371 @@
+"""
+TheReposterminator Reddit bot to detect reposts
+Copyright (C) 2023 sardonicism-04
+
+TheReposterminator is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TheReposterminator is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with TheReposterminator.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import gzip
+import io
+import logging
+import struct
+import sys
+import time
+import zlib
+from array import array
+from collections.abc import Iterator
+from typing import IO, TYPE_CHECKING, NamedTuple
+
+from .index import CREATED_WIDTH, HASH_WIDTH, ID_WIDTH
+
+if TYPE_CHECKING:
+    from TheReposterminator import BotClient
+
+
+logger = logging.getLogger(__name__)
+
+# Exports are gzip-compressed streams, laid out as a header followed by a
+# section per subreddit, and terminated by a section without a name and the
+# total number of rows. Each section is a run of blocks, terminated by an
+# empty block. Blocks hold up to BLOCK_ROWS rows as a column of unsigned
+# 64-bit hashes, a column of signed 64-bit creation timestamps, and a column
+# of fixed-width, NUL-padded submission IDs, followed by the CRC32 of those
+# columns. All integers are little-endian. Unknown creation timestamps are
+# exported as 0, and imported as NULL again.
+EXPORT_MAGIC = b"RTEXPORT"
+EXPORT_VERSION = 1
+EXPORT_HEADER = struct.Struct("<8sH6xd")  # magic, version, exported at
+SECTION_HEADER = struct.Struct("<21s")  # subreddit name
+BLOCK_HEADER = struct.Struct("<I")  # rows
+BLOCK_TRAILER = struct.Struct("<I")  # CRC32 of the block's columns
+EXPORT_TRAILER = struct.Struct("<Q")  # total rows
+ROW_WIDTH = HASH_WIDTH + CREATED_WIDTH + ID_WIDTH
+BLOCK_ROWS = 65_536
+
+# Secondary indexes on media_storage, which are rebuilt after an import
+# rather than being updated for every imported row
+DEFERRED_INDEXES = {
+    "media_storage_subname_row_id_idx": "(subname, row_id)",
+    "media_storage_subname_created_utc_idx": "(subname, created_utc)",
+}
+
+
+class ExportError(Exception):
+    """Raised when an export is malformed, truncated, or corrupted"""
+
+
+class Block(NamedTuple):
+    hashes: array
+    created: array
+    ids: list[str]
+
+
+def encode_block(block: Block) -> bytes:
+    hashes, created = array("Q", block.hashes), array("q", block.created)
+    if sys.byteorder == "big":
+        hashes.byteswap()
+        created.byteswap()
+    columns = b"".join(
+        (
+            hashes.tobytes(),
+            created.tobytes(),
+            b"".join(id.encode().ljust(ID_WIDTH, b"\x00") for id in block.ids),
+        )
+    )
+    return (
+        BLOCK_HEADER.pack(len(block.ids))
+        + columns
+        + BLOCK_TRAILER.pack(zlib.crc32(columns))
+    )
+
+
+def read_exactly(file: IO[bytes], size: int) -> bytes:
+    data = file.read(size)
+    if len(data) != size:
+        raise ExportError("Export is truncated")
+    return data
+
+
+def read_block(file: IO[bytes]) -> Block | None:
+    """
+    Reads the next block of a section
+
+    :param file: The decompressed export stream
+    :type file: ``IO[bytes]``
+
+    :return: The block, or `None` at the end of the section
+    :rtype: ``Block | None``
+
+    :raises ExportError: If the block is truncated or corrupted
+    """
+    (rows,) = BLOCK_HEADER.unpack(read_exactly(file, BLOCK_HEADER.size))
+    if rows == 0:
+        return None
+    if rows > BLOCK_ROWS:
+        raise ExportError(f"Block of {rows} rows exceeds {BLOCK_ROWS}")
+
+    columns = read_exactly(file, rows * ROW_WIDTH)
+    (crc,) = BLOCK_TRAILER.unpack(read_exactly(file, BLOCK_TRAILER.size))
+    if zlib.crc32(columns) != crc:
+        raise ExportError("Block checksum mismatch")
+
+    hashes_end = rows * HASH_WIDTH
+    created_end = hashes_end + rows * CREATED_WIDTH
+    hashes = array("Q", columns[:hashes_end])
+    created = array("q", columns[hashes_end:created_end])
+    if sys.byteorder == "big":
+        hashes.byteswap()
+        created.byteswap()
+    ids = [
+        columns[start:start + ID_WIDTH].rstrip(b"\x00").decode()
+        for start in range(created_end, len(columns), ID_WIDTH)
+    ]
+    return Block(hashes, created, ids)
+
+
+def read_export(file: IO[bytes]) -> Iterator[tuple[str, Block]]:
+    """
+    Reads every block of an export, with the subreddit it belongs to
+
+    :param file: The compressed export stream
+    :type file: ``IO[bytes]``
+
+    :return: The subreddit name and contents of each block
+    :rtype: ``Iterator[tuple[str, Block]]``
+
+    :raises ExportError: If the export is malformed, truncated, or corrupted
+    """
+    with gzip.GzipFile(fileobj=file, mode="rb") as stream:
+        magic, version, _ = EXPORT_HEADER.unpack(
+            read_exactly(stream, EXPORT_HEADER.size)
+        )
+        if magic != EXPORT_MAGIC:
+            raise ExportError("Not an export")
+        if version != EXPORT_VERSION:
+            raise ExportError(
+                f"Export is version {version}, expected {EXPORT_VERSION}"
+            )
+
+        total = 0
+        while True:
+            (name,) = SECTION_HEADER.unpack(
+                read_exactly(stream, SECTION_HEADER.size)
+            )
+            if not (subname := name.rstrip(b"\x00").decode()):
+                break
+            while (block := read_block(stream)) is not None:
+                total += len(block.ids)
+                yield subname, block
+
+        (expected,) = EXPORT_TRAILER.unpack(
+            read_exactly(stream, EXPORT_TRAILER.size)
+        )
+        if total != expected:
+            raise ExportError(f"Export has {total} rows, expected {expected}")
+
+
+def read_hashes(file: IO[bytes], *, subname: str | None = None) -> array:
+    """
+    Reads the hashes of an export, such as to benchmark matching against them
+
+    :param file: The compressed export stream
+    :type file: ``IO[bytes]``
+
+    :param subname: Only reads the hashes of this subreddit, if given
+    :type subname: ``str | None``
+
+    :return: The hashes, in the order they were exported
+    :rtype: ``array``
+    """
+    hashes = array("Q")
+    for name, block in read_export(file):
+        if subname is None or name.lower() == subname.lower():
+            hashes.extend(block.hashes)
+    return hashes
+
+
+def export(
+    bot: BotClient, file: IO[bytes], *, subreddits: list[str] | None = None
+) -> int:
+    """
+    Streams stored media data to an export
+
+    Every subreddit is read from a single consistent snapshot of the
+    database, through a server-side cursor, so memory use doesn't grow with
+    the size of the export.
+
+    :param bot: The bot client to perform method calls to
+    :type bot: ``BotClient``
+
+    :param file: The stream to write the export to
+    :type file: ``IO[bytes]``
+
+    :param subreddits: The subreddits to export, defaults to all of them
+    :type subreddits: ``list[str] | None``
+
+    :return: The number of exported rows
+    :rtype: ``int``
+    """
+    total = 0
+    with (
+        bot.reads.connection() as conn,
+        gzip.GzipFile(fileobj=file, mode="wb", compresslevel=6) as stream,
+    ):
+        with conn.cursor() as cur:
+            cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            if subreddits:
+                subnames = subreddits
+            else:
+                cur.execute("SELECT DISTINCT subname FROM media_storage")
+                subnames = sorted(row[0] for row in cur.fetchall())
+
+        stream.write(EXPORT_HEADER.pack(EXPORT_MAGIC, EXPORT_VERSION, time.time()))
+        for subname in subnames:
+            started = time.perf_counter()
+            stream.write(SECTION_HEADER.pack(subname.encode()))
+
+            cursor = conn.cursor("export_media")
+            cursor.itersize = BLOCK_ROWS
+            cursor.execute(
+                """
+                SELECT hash, COALESCE(created_utc, 0), submission_id FROM
+                    media_storage
+                WHERE subname=%s
+                ORDER BY row_id
+                """,
+                (subname,),
+            )
+            rows = 0
+            while batch := cursor.fetchmany(BLOCK_ROWS):
+                stream.write(
+                    encode_block(
+                        Block(
+                            array("Q", (int(row[0]) for row in batch)),
+                            array("q", (row[1] for row in batch)),
+                            [row[2] for row in batch],
+                        )
+                    )
+                )
+                rows += len(batch)
+            cursor.close()
+
+            stream.write(BLOCK_HEADER.pack(0))
+            total += rows
+            logger.info(
+                f"Exported {rows} rows of r/{subname} in "
+                f"{time.perf_counter() - started:.2f}s"
+            )
+
+        stream.write(SECTION_HEADER.pack(b""))
+        stream.write(EXPORT_TRAILER.pack(total))
+
+    return total
+
+
+def import_(
+    bot: BotClient, file: IO[bytes], *, defer_indexes: bool = True
+) -> dict[str, int]:
+    """
+    Loads an export into the database
+
+    Rows are copied into a temporary table with `COPY`, and then inserted
+    into `media_storage` in one statement, skipping rows that are already
+    stored. Their submissions are marked as indexed. Imported rows are given
+    new row IDs, and aren't notified to other processes one by one.
+
+    When `defer_indexes` is set, the secondary indexes of `media_storage`
+    are dropped for the import and rebuilt once all rows are loaded, which
+    is much faster for large imports but locks the table meanwhile. The bot
+    should not be running while an import takes place.
+
+    The import is a single transaction, so nothing is imported from an
+    export that turns out to be corrupted.
+
+    :param bot: The bot client to perform method calls to
+    :type bot: ``BotClient``
+
+    :param file: The stream to read the export from
+    :type file: ``IO[bytes]``
+
+    :param defer_indexes: Whether to rebuild the secondary indexes after the
+        import, defaults to `True`
+    :type defer_indexes: ``bool``
+
+    :return: The number of rows read for each subreddit
+    :rtype: ``dict[str, int]``
+    """
+    counts: dict[str, int] = {}
+    started = time.perf_counter()
+
+    with bot.pool.connection() as conn, conn.cursor() as cur:
+        cur.execute("SET LOCAL rterm.bulk_load = 'on'")
+        cur.execute(
+            """
+            CREATE TEMPORARY TABLE import_media (
+                hash          VARCHAR(32),
+                submission_id VARCHAR(10),
+                subname       VARCHAR(21),
+                created_utc   BIGINT
+            ) ON COMMIT DROP
+            """
+        )
+        if defer_indexes:
+            for name in DEFERRED_INDEXES:
+                cur.execute(f"DROP INDEX IF EXISTS {name}")
+
+        for subname, block in read_export(file):
+            buffer = io.StringIO(
+                "".join(
+                    f"{image_hash}\t{submission_id}\t{subname}\t{created_utc}\n"
+                    for image_hash, created_utc, submission_id in zip(
+                        block.hashes, block.created, block.ids
+                    )
+                )
+            )
+            cur.copy_from(buffer, "import_media")
+            counts[subname] = counts.get(subname, 0) + len(block.ids)
+
+        cur.execute(
+            """
+            INSERT INTO media_storage
+                (hash, submission_id, subname, created_utc)
+            SELECT hash, submission_id, subname, NULLIF(created_utc, 0) FROM
+                import_media
+            ON CONFLICT DO NOTHING
+            """
+        )
+        logger.info(
+            f"Inserted {cur.rowcount} of {sum(counts.values())} rows in "
+            f"{time.perf_counter() - started:.2f}s"
+        )
+        cur.execute(
+            """
+            INSERT INTO indexed_submissions (id)
+            SELECT DISTINCT submission_id FROM import_media
+            ON CONFLICT DO NOTHING
+            """
+        )
+
+        if defer_indexes:
+            for name, columns in DEFERRED_INDEXES.items():
+                cur.execute(
+                    f"CREATE INDEX IF NOT EXISTS {name} "
+                    f"ON media_storage {columns}"
+                )
+            logger.info(
+                f"Rebuilt indexes after {time.perf_counter() - started:.2f}s"
+            )
+
+    return counts
@@ -18,7 +18,7 @@ along with TheReposterminator.  If not, see <https://www.gnu.org/licenses/>.
 from __future__ import annotations
 
 from collections.abc import Callable
-from typing import NamedTuple, TypedDict
+from typing import Any, NamedTuple, TypedDict
 
 from praw.models.reddit.message import Message
 
@@ -31,11 +31,23 @@ class RedditConfig(TypedDict):
     username: str
 
 
-class DatabaseConfig(TypedDict):
+class ReplicaConfig(TypedDict, total=False):
     dbname: str
     user: str
     host: str
     password: str
+    max_staleness: float
+
+
+class _RequiredDatabaseConfig(TypedDict):
+    dbname: str
+    user: str
+    host: str
+    password: str
+
+
+class DatabaseConfig(_RequiredDatabaseConfig, total=False):
+    replica: ReplicaConfig
 
 
 class TemplatesConfig(TypedDict):
@@ -54,13 +66,137 @@ class LimitsConfig(TypedDict):
     minimum_autoremove_threshold: int
 
 
-class BotConfig(TypedDict):
+class SnapshotsConfig(TypedDict, total=False):
+    directory: str
+    interval: int
+
+
+class PoolConfig(TypedDict, total=False):
+    min_connections: int
+    max_connections: int
+    acquire_timeout: float
+    health_check_interval: float
+    max_retries: int
+    max_backoff: float
+
+
+class IndexConfig(TypedDict, total=False):
+    memory_budget: int
+
+
+class RetentionConfig(TypedDict, total=False):
+    departed_grace_days: int
+    max_age_days: int
+    archive_directory: str
+    interval: int
+
+
+class WorkersConfig(TypedDict, total=False):
+    enabled: bool
+    id: str
+    lease_ttl: int
+
+
+class NotificationsConfig(TypedDict, total=False):
+    enabled: bool
+
+
+class RuntimeConfig(TypedDict, total=False):
+    max_concurrent_scans: int
+    inbox_interval: float
+
+
+class ActionsConfig(TypedDict, total=False):
+    inline: bool
+    batch_size: int
+    claim_timeout: int
+    max_attempts: int
+    base_delay: int
+    max_delay: int
+    poll_interval: float
+    keep_days: int
+
+
+class FailuresConfig(TypedDict, total=False):
+    max_attempts: int
+    base_delay: int
+    max_delay: int
+    max_cached: int
+    keep_days: int
+
+
+class HostConfig(TypedDict, total=False):
+    max_concurrent: int
+    rate: float
+    burst: int
+    failure_threshold: int
+    cooldown: float
+
+
+class MediaConfig(HostConfig, total=False):
+    timeout: float
+    max_wait: float
+    hosts: dict[str, HostConfig]
+
+
+class BudgetConfig(TypedDict, total=False):
+    reserves: dict[str, float]
+
+
+class ModeratorsConfig(TypedDict, total=False):
+    ttl: int
+    min_refresh: int
+    modlog_interval: int
+
+
+class AdminConfig(TypedDict, total=False):
+    users: list[str]
+
+
+class ProfilingConfig(TypedDict, total=False):
+    directory: str
+    interval: float
+    dump_interval: int
+    top: int
+    memory_frames: int
+
+
+class LagConfig(TypedDict, total=False):
+    keep_days: int
+    window_days: int
+
+
+class WhatIfConfig(TypedDict, total=False):
+    min_threshold: int
+    jobs: int
+
+
+class _RequiredBotConfig(TypedDict):
     reddit: RedditConfig
     database: DatabaseConfig
     templates: TemplatesConfig
     limits: LimitsConfig
 
 
+class BotConfig(_RequiredBotConfig, total=False):
+    pool: PoolConfig
+    snapshots: SnapshotsConfig
+    index: IndexConfig
+    retention: RetentionConfig
+    workers: WorkersConfig
+    notifications: NotificationsConfig
+    runtime: RuntimeConfig
+    actions: ActionsConfig
+    failures: FailuresConfig
+    media: MediaConfig
+    budget: BudgetConfig
+    moderators: ModeratorsConfig
+    lag: LagConfig
+    admin: AdminConfig
+    profiling: ProfilingConfig
+    whatif: WhatIfConfig
+
+
 class SubredditConfig(TypedDict):
     respond_to_mentioned: bool
     mentioned_threshold: int
@@ -73,11 +209,15 @@ class SubredditConfig(TypedDict):
     autoremove_threshold: int
     autoremove_reply: bool
 
+    # cross-subreddit matching
+    global_matching: bool
+
 
 class MediaData(NamedTuple):
     hash: str
     id: str
     subname: str
+    created_utc: int
 
 
 class Match(NamedTuple):
@@ -93,3 +233,10 @@ class SubData(NamedTuple):
 
 
 Command = Callable[[str, Message], None]
+
+
+class Action(NamedTuple):
+    key: str
+    kind: str
+    target: str
+    payload: dict[str, Any]
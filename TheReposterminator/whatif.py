@@ -0,0 +1,435 @@
+"""
+TheReposterminator Reddit bot to detect reposts
+Copyright (C) 2023 sardonicism-04
+
+TheReposterminator is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TheReposterminator is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with TheReposterminator.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import logging
+from array import array
+from collections import Counter
+from collections.abc import Iterable
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    as_completed,
+    wait,
+)
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING, NamedTuple
+
+from .common import max_distance
+from .index import GlobalIndex
+from .types import WhatIfConfig
+
+if TYPE_CHECKING:
+    from TheReposterminator import BotClient
+
+
+logger = logging.getLogger(__name__)
+
+SEGMENTS = GlobalIndex.SEGMENTS
+SEGMENT_BITS = GlobalIndex.SEGMENT_BITS
+SEGMENT_MASK = GlobalIndex.SEGMENT_MASK
+
+
+class Analysis(NamedTuple):
+    subname: str
+    posts: int
+    span_days: float
+    max_distance: int
+    max_post_age: int
+    # Maps each set of distances (as a bit mask) at which a post had earlier
+    # near-duplicates to the number of posts that had exactly that set
+    histogram: dict[int, int]
+    computed_at: datetime
+
+
+class Estimate(NamedTuple):
+    reports_per_day: float
+    autoremovals_per_day: float
+
+
+def similarity(distance: int) -> int:
+    """Returns the similarity the bot displays for a Hamming distance"""
+    return (64 - distance) * 100 // 64
+
+
+def flip_masks(radius: int) -> list[int]:
+    """Returns every segment-wide bit mask with at most `radius` bits set"""
+    return [
+        mask for mask in range(1 << SEGMENT_BITS) if mask.bit_count() <= radius
+    ]
+
+
+def neighbour_distances(
+    hashes: array, created: array, *, max_distance: int, max_age: int = 0
+) -> Counter[int]:
+    """
+    Finds the distances at which each row has near-duplicates among the rows
+    before it
+
+    Rows are joined against every earlier row with multi-index hashing, as
+    in `GlobalIndex`. The radius that each segment must be within is split
+    between the keys that rows are filed under, and the keys that they are
+    looked up with, so that neither costs as many shard lookups as a
+    `GlobalIndex.search` of the same distance.
+
+    Like the bot's matching, rows more than `max_age` seconds older than a
+    row aren't counted as its near-duplicates, unless either age is unknown.
+
+    :param hashes: The hashes of the rows, in the order they were stored
+    :type hashes: ``array``
+
+    :param created: The creation timestamps of the rows
+    :type created: ``array``
+
+    :param max_distance: The largest Hamming distance to find
+    :type max_distance: ``int``
+
+    :param max_age: The largest age difference to count, or `0` for any
+    :type max_age: ``int``
+
+    :return: The number of rows with each set of distances, as a bit mask
+    :rtype: ``Counter[int]``
+    """
+    radius = max_distance // SEGMENTS
+    filed_masks = flip_masks(radius // 2)
+    lookup_masks = flip_masks(radius - radius // 2)
+    shards: list[dict[int, array]] = [{} for _ in range(SEGMENTS)]
+    histogram: Counter[int] = Counter()
+
+    for position, image_hash in enumerate(hashes):
+        values = [
+            image_hash >> (segment * SEGMENT_BITS) & SEGMENT_MASK
+            for segment in range(SEGMENTS)
+        ]
+
+        candidates: set[int] = set()
+        for shard, value in zip(shards, values):
+            for mask in lookup_masks:
+                if (positions := shard.get(value ^ mask)) is not None:
+                    candidates.update(positions)
+
+        min_created = created[position] - max_age if max_age else 0
+        distances = 0
+        for candidate in candidates:
+            if 0 < created[candidate] < min_created:
+                continue
+            distance = (hashes[candidate] ^ image_hash).bit_count()
+            if distance <= max_distance:
+                distances |= 1 << distance
+        histogram[distances] += 1
+
+        for shard, value in zip(shards, values):
+            for mask in filed_masks:
+                if (positions := shard.get(value ^ mask)) is None:
+                    positions = shard[value ^ mask] = array("L")
+                positions.append(position)
+
+    return histogram
+
+
+def below(distance: int) -> int:
+    """Returns a mask of every distance up to and including `distance`"""
+    return (1 << (distance + 1)) - 1
+
+
+def estimate(
+    analysis: Analysis,
+    *,
+    sentry_threshold: int,
+    autoremove_threshold: int | None = None,
+) -> Estimate:
+    """
+    Estimates the daily reports and autoremovals at a pair of thresholds
+
+    A post is reported when it has an earlier near-duplicate at the sentry
+    threshold, and is removed when every one of those near-duplicates is also
+    at the autoremove threshold, as in `Sentry.auto_remove`.
+
+    :param analysis: The analysis of the subreddit
+    :type analysis: ``Analysis``
+
+    :param sentry_threshold: The sentry threshold to estimate with
+    :type sentry_threshold: ``int``
+
+    :param autoremove_threshold: The autoremove threshold to estimate with,
+        or `None` if autoremoval is disabled
+    :type autoremove_threshold: ``int | None``
+
+    :return: The estimated reports and autoremovals per day
+    :rtype: ``Estimate``
+
+    :raises ValueError: If a threshold is lower than the analysis covers
+    """
+    thresholds = [sentry_threshold]
+    if autoremove_threshold is not None:
+        thresholds.append(autoremove_threshold)
+    for threshold in thresholds:
+        if not 0 <= threshold <= 100:
+            raise ValueError(f"{threshold} isn't a percentage")
+        if max_distance(threshold) > analysis.max_distance:
+            raise ValueError(
+                f"Thresholds below {similarity(analysis.max_distance)} "
+                "weren't analyzed"
+            )
+
+    reported = below(max_distance(sentry_threshold))
+    removed = (
+        below(max_distance(autoremove_threshold))
+        if autoremove_threshold is not None
+        else 0
+    )
+    reports = autoremovals = 0
+    for distances, posts in analysis.histogram.items():
+        if not (matched := distances & reported):
+            continue
+        reports += posts
+        if matched & ~removed == 0:
+            autoremovals += posts
+
+    return Estimate(
+        reports / analysis.span_days, autoremovals / analysis.span_days
+    )
+
+
+class WhatIf:
+    """
+    Estimates how often the bot would act on a subreddit at other thresholds
+
+    An offline analysis finds, for every stored post of a subreddit, the
+    similarities at which it had near-duplicates among the posts stored
+    before it. Only a histogram of those is stored, in `whatif_histograms`,
+    from which reports and autoremovals per day can be estimated for any
+    pair of thresholds down to the analysis's minimum threshold.
+
+    Estimates are of the stored history, and so don't account for posts that
+    were deleted before the bot saw them, or for global matching.
+    """
+
+    def __init__(self, bot: BotClient):
+        self.bot = bot
+
+    @property
+    def config(self) -> WhatIfConfig:
+        return self.bot.config.get("whatif", {})
+
+    def load_rows(self, subname: str) -> tuple[array, array]:
+        """Loads the hashes and creation timestamps of a subreddit's rows"""
+        hashes, created = array("Q"), array("q")
+        with self.bot.reads.connection() as conn:
+            cursor = conn.cursor("whatif_media")
+            cursor.execute(
+                """
+                SELECT hash, COALESCE(created_utc, 0) FROM
+                    media_storage
+                WHERE subname=%s
+                ORDER BY row_id
+                """,
+                (subname,),
+            )
+            for image_hash, created_utc in cursor:
+                hashes.append(int(image_hash))
+                created.append(created_utc)
+            cursor.close()
+        return hashes, created
+
+    def analyze(self, subnames: list[str], *, jobs: int = 1) -> list[Analysis]:
+        """
+        Analyzes the stored posts of several subreddits, and stores the results
+
+        Subreddits are joined in `jobs` processes at once. Each subreddit's
+        `max_post_age` is applied as it is currently configured.
+
+        :param subnames: The subreddits to analyze
+        :type subnames: ``list[str]``
+
+        :param jobs: The number of processes to analyze with, defaults to `1`
+        :type jobs: ``int``
+
+        :return: The analysis of each subreddit
+        :rtype: ``list[Analysis]``
+        """
+        distance = max_distance(self.config.get("min_threshold", 85))
+        analyses: list[Analysis] = []
+        # The subreddit, posts, span in days and max post age of each job
+        pending: dict[Future[Counter[int]], tuple[str, int, float, int]] = {}
+
+        def collect(futures: Iterable[Future[Counter[int]]]):
+            for future in futures:
+                subname, posts, span_days, max_age = pending.pop(future)
+                analysis = Analysis(
+                    subname,
+                    posts,
+                    span_days,
+                    distance,
+                    max_age,
+                    dict(future.result()),
+                    datetime.now(timezone.utc),
+                )
+                self.store(analysis)
+                analyses.append(analysis)
+                logger.info(f"✅ Analyzed {posts} posts of r/{subname}")
+
+        # Rows are only loaded once a process is free to join them
+        with ProcessPoolExecutor(jobs) as executor:
+            for subname in subnames:
+                if len(pending) >= jobs:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+
+                hashes, created = self.load_rows(subname)
+                known = [created_utc for created_utc in created if created_utc]
+                span_days = max(
+                    (max(known) - min(known)) / 86_400 if known else 0, 1
+                )
+                max_age = self.bot.subreddit_configs.get(subname, {}).get(
+                    "max_post_age", 0
+                )
+                future = executor.submit(
+                    neighbour_distances,
+                    hashes,
+                    created,
+                    max_distance=distance,
+                    max_age=max_age * 86_400,
+                )
+                pending[future] = (subname, len(hashes), span_days, max_age)
+
+            collect(as_completed([*pending]))
+
+        return analyses
+
+    def store(self, analysis: Analysis):
+        """Replaces the stored analysis of a subreddit"""
+        with self.bot.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                "DELETE FROM whatif_histograms WHERE subname=%s",
+                (analysis.subname,),
+            )
+            cur.execute(
+                """
+                INSERT INTO whatif_summaries
+                    (subname, posts, span_days, max_distance, max_post_age,
+                    computed_at)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                ON CONFLICT (subname) DO UPDATE SET
+                    posts=EXCLUDED.posts,
+                    span_days=EXCLUDED.span_days,
+                    max_distance=EXCLUDED.max_distance,
+                    max_post_age=EXCLUDED.max_post_age,
+                    computed_at=EXCLUDED.computed_at
+                """,
+                (*analysis[:5], analysis.computed_at),
+            )
+            cur.executemany(
+                """
+                INSERT INTO whatif_histograms (subname, distances, posts)
+                VALUES (%s, %s, %s)
+                """,
+                [
+                    (analysis.subname, distances, posts)
+                    for distances, posts in analysis.histogram.items()
+                ],
+            )
+
+    def load(self, subname: str) -> Analysis | None:
+        """
+        Loads the stored analysis of a subreddit
+
+        :param subname: The subreddit to load the analysis of
+        :type subname: ``str``
+
+        :return: The analysis, or `None` if the subreddit wasn't analyzed
+        :rtype: ``Analysis | None``
+        """
+        with self.bot.reads.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT
+                    subname, posts, span_days, max_distance, max_post_age,
+                    computed_at
+                FROM whatif_summaries
+                WHERE LOWER(subname)=LOWER(%s)
+                """,
+                (subname,),
+            )
+            if (summary := cur.fetchone()) is None:
+                return None
+
+            cur.execute(
+                "SELECT distances, posts FROM whatif_histograms "
+                "WHERE subname=%s",
+                (summary[0],),
+            )
+            histogram = dict(cur.fetchall())
+
+        name, posts, span_days, distance, max_age, computed_at = summary
+        return Analysis(
+            name, posts, span_days, distance, max_age, histogram, computed_at
+        )
+
+    def report(
+        self,
+        analysis: Analysis,
+        *,
+        sentry_threshold: int,
+        autoremove_threshold: int | None = None,
+    ) -> str:
+        """
+        Describes an analysis, and the estimate at a pair of thresholds
+
+        :param analysis: The analysis to describe
+        :type analysis: ``Analysis``
+
+        :param sentry_threshold: The sentry threshold to estimate with
+        :type sentry_threshold: ``int``
+
+        :param autoremove_threshold: The autoremove threshold to estimate
+            with, or `None` if autoremoval is disabled
+        :type autoremove_threshold: ``int | None``
+
+        :return: The description
+        :rtype: ``str``
+
+        :raises ValueError: If a threshold is lower than the analysis covers
+        """
+        result = estimate(
+            analysis,
+            sentry_threshold=sentry_threshold,
+            autoremove_threshold=autoremove_threshold,
+        )
+        lines = [
+            f"r/{analysis.subname}: {analysis.posts} posts over "
+            f"{analysis.span_days:.0f} days, analyzed "
+            f"{analysis.computed_at:%Y-%m-%d %H:%M} UTC",
+            f"At sentry {sentry_threshold}, autoremove "
+            f"{autoremove_threshold or 'off'}: "
+            f"{result.reports_per_day:.2f} reports/day, "
+            f"{result.autoremovals_per_day:.2f} autoremovals/day",
+            "Posts by similarity to their nearest earlier post:",
+        ]
+
+        nearest: Counter[int] = Counter()
+        for distances, posts in analysis.histogram.items():
+            if distances:
+                nearest[(distances & -distances).bit_length() - 1] += posts
+        for distance in range(analysis.max_distance + 1):
+            if nearest[distance]:
+                lines.append(
+                    f"  {similarity(distance):>3}%: {nearest[distance]}"
+                )
+        return "\n".join(lines)
@@ -0,0 +1,37 @@
+-- Converts a media_storage table created before partitioning was introduced
+-- into the partitioned layout defined in schema.sql.
+--
+-- Run this once with the bot stopped, after running schema.sql so that the
+-- row_id and created_utc columns exist. Like schema.sql, it should be run
+-- with `\i` from the repository root. Existing row_id values are kept, so
+-- hash index snapshots remain valid.
+
+BEGIN;
+
+-- Copied rows are already in every index, so they aren't notified one by one
+SET LOCAL rterm.bulk_load = 'on';
+
+ALTER TABLE media_storage RENAME TO media_storage_unpartitioned;
+ALTER INDEX media_storage_pkey RENAME TO media_storage_unpartitioned_pkey;
+ALTER INDEX IF EXISTS media_storage_subname_row_id_idx
+    RENAME TO media_storage_unpartitioned_subname_row_id_idx;
+ALTER INDEX IF EXISTS media_storage_subname_created_utc_idx
+    RENAME TO media_storage_unpartitioned_subname_created_utc_idx;
+
+\i schema.sql
+
+INSERT INTO media_storage (hash, submission_id, subname, row_id, created_utc)
+    SELECT hash, submission_id, subname, row_id, created_utc
+    FROM media_storage_unpartitioned
+    ON CONFLICT DO NOTHING;
+
+SELECT setval(
+    pg_get_serial_sequence('media_storage', 'row_id'),
+    GREATEST((SELECT MAX(row_id) FROM media_storage), 1)
+);
+
+DROP TABLE media_storage_unpartitioned;
+
+COMMIT;
+
+VACUUM ANALYZE media_storage;
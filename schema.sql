@@ -3,13 +3,192 @@ CREATE TABLE IF NOT EXISTS subreddits (
     indexed BOOLEAN
 );
 
+CREATE TABLE IF NOT EXISTS departed_subreddits (
+    name        VARCHAR(21) PRIMARY KEY,
+    departed_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
 CREATE TABLE IF NOT EXISTS indexed_submissions (
     id VARCHAR(10) PRIMARY KEY
 );
 
+-- Partitioned by subreddit so that scans, pruning and vacuuming only ever
+-- touch a fraction of the stored history. Databases created before
+-- partitioning can be converted with migrations/partition_media_storage.sql
 CREATE TABLE IF NOT EXISTS media_storage (
     hash          VARCHAR(32),
     submission_id VARCHAR(10),
     subname       VARCHAR(21),
-    PRIMARY KEY (submission_id, hash)
+    row_id        BIGSERIAL,
+    created_utc   BIGINT,
+    PRIMARY KEY (subname, submission_id, hash)
+) PARTITION BY HASH (subname);
+
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM pg_partitioned_table
+        WHERE partrelid = 'media_storage'::regclass
+    ) THEN
+        FOR remainder IN 0..15 LOOP
+            EXECUTE format(
+                'CREATE TABLE IF NOT EXISTS media_storage_p%s '
+                'PARTITION OF media_storage '
+                'FOR VALUES WITH (MODULUS 16, REMAINDER %s)',
+                remainder, remainder
+            );
+        END LOOP;
+    END IF;
+END $$;
+
+-- Upgrades for databases created from an older version of this file
+
+ALTER TABLE media_storage ADD COLUMN IF NOT EXISTS row_id BIGSERIAL;
+-- Populate with `python -m TheReposterminator --backfill-created-utc`
+ALTER TABLE media_storage ADD COLUMN IF NOT EXISTS created_utc BIGINT;
+
+-- Used to replay rows inserted after a hash index snapshot was written
+CREATE INDEX IF NOT EXISTS media_storage_subname_row_id_idx
+    ON media_storage (subname, row_id);
+
+-- Used to restrict matching and pruning by post age
+CREATE INDEX IF NOT EXISTS media_storage_subname_created_utc_idx
+    ON media_storage (subname, created_utc);
+
+-- Multi-worker mode: live workers and the subreddits (and inbox) they lease
+CREATE TABLE IF NOT EXISTS workers (
+    id        TEXT PRIMARY KEY,
+    heartbeat TIMESTAMPTZ NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS worker_leases (
+    resource   VARCHAR(21) PRIMARY KEY,
+    worker_id  TEXT NOT NULL,
+    expires_at TIMESTAMPTZ NOT NULL
+);
+
+-- Submissions that failed to be processed. Transient failures are retried
+-- from next_attempt_at, and permanent failures are never retried
+CREATE TABLE IF NOT EXISTS submission_failures (
+    submission_id   VARCHAR(10) PRIMARY KEY,
+    error_class     TEXT NOT NULL,
+    permanent       BOOLEAN NOT NULL,
+    attempts        INTEGER NOT NULL DEFAULT 1,
+    next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    last_error      TEXT,
+    failed_at       TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    -- When the first attempt saw the submission, as a Unix timestamp
+    first_seen_at   DOUBLE PRECISION
+);
+
+ALTER TABLE submission_failures
+    ADD COLUMN IF NOT EXISTS first_seen_at DOUBLE PRECISION;
+
+-- Moderation actions waiting to be performed on Reddit, or already performed
+CREATE TABLE IF NOT EXISTS moderation_actions (
+    id              BIGSERIAL PRIMARY KEY,
+    idempotency_key TEXT UNIQUE NOT NULL,
+    kind            TEXT NOT NULL,
+    target          VARCHAR(10) NOT NULL,
+    payload         JSONB NOT NULL DEFAULT '{}',
+    status          TEXT NOT NULL DEFAULT 'pending',
+    attempts        INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    last_error      TEXT,
+    created_at      TIMESTAMPTZ NOT NULL DEFAULT NOW()
 );
+
+CREATE INDEX IF NOT EXISTS moderation_actions_due_idx
+    ON moderation_actions (next_attempt_at) WHERE status='pending';
+
+-- The config each subreddit was last given by a command, so that processes
+-- which missed its notification can catch up once they reconnect
+CREATE TABLE IF NOT EXISTS subreddit_config_changes (
+    name       VARCHAR(21) PRIMARY KEY,
+    config     JSONB NOT NULL,
+    changed_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+-- When each scanned submission was posted, first seen, hashed and reported,
+-- as Unix timestamps
+CREATE TABLE IF NOT EXISTS detection_lag (
+    submission_id   VARCHAR(10) PRIMARY KEY,
+    subname         TEXT NOT NULL,
+    created_utc     BIGINT NOT NULL,
+    first_seen_at   DOUBLE PRECISION NOT NULL,
+    hashed_at       DOUBLE PRECISION NOT NULL,
+    reported_at     DOUBLE PRECISION
+);
+
+CREATE INDEX IF NOT EXISTS detection_lag_first_seen_idx
+    ON detection_lag (first_seen_at);
+
+-- What-if analyses of each subreddit's stored posts. Each histogram row
+-- counts the posts whose earlier near-duplicates were at exactly the set of
+-- Hamming distances in the bit mask `distances`
+CREATE TABLE IF NOT EXISTS whatif_summaries (
+    subname      VARCHAR(21) PRIMARY KEY,
+    posts        BIGINT NOT NULL,
+    span_days    DOUBLE PRECISION NOT NULL,
+    max_distance INTEGER NOT NULL,
+    max_post_age INTEGER NOT NULL,
+    computed_at  TIMESTAMPTZ NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS whatif_histograms (
+    subname   VARCHAR(21) NOT NULL,
+    distances BIGINT NOT NULL,
+    posts     BIGINT NOT NULL,
+    PRIMARY KEY (subname, distances)
+);
+
+-- Notifications that keep the in-process state of other bot processes in sync
+
+CREATE OR REPLACE FUNCTION notify_subreddits() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify(
+            'rterm_subreddits',
+            json_build_object('op', TG_OP, 'name', OLD.name)::text
+        );
+    ELSE
+        PERFORM pg_notify(
+            'rterm_subreddits',
+            json_build_object(
+                'op', TG_OP, 'name', NEW.name, 'indexed', NEW.indexed
+            )::text
+        );
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS subreddits_notify ON subreddits;
+CREATE TRIGGER subreddits_notify
+    AFTER INSERT OR UPDATE OR DELETE ON subreddits
+    FOR EACH ROW EXECUTE FUNCTION notify_subreddits();
+
+-- Bulk loads set rterm.bulk_load, and notify once per subreddit instead
+CREATE OR REPLACE FUNCTION notify_media_storage() RETURNS trigger AS $$
+BEGIN
+    IF current_setting('rterm.bulk_load', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+    PERFORM pg_notify(
+        'rterm_media',
+        json_build_object(
+            'hash', NEW.hash,
+            'submission_id', NEW.submission_id,
+            'subname', NEW.subname,
+            'created_utc', NEW.created_utc,
+            'row_id', NEW.row_id
+        )::text
+    );
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS media_storage_notify ON media_storage;
+CREATE TRIGGER media_storage_notify
+    AFTER INSERT ON media_storage
+    FOR EACH ROW EXECUTE FUNCTION notify_media_storage();
@@ -0,0 +1,133 @@
+"""
+TheReposterminator Reddit bot to detect reposts
+Copyright (C) 2023 sardonicism-04
+
+TheReposterminator is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TheReposterminator is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with TheReposterminator.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+from collections.abc import Iterator
+from contextlib import contextmanager
+from typing import IO
+
+import psycopg2
+
+
+class FakeClock:
+    """Stands in for `time.monotonic` and `time.sleep`, without waiting"""
+
+    def __init__(self):
+        self.now = 1_000.0
+        self.sleeps: list[float] = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class FakeCursor:
+    """A cursor whose results are provided by its connection's `respond`"""
+
+    def __init__(self, conn: FakeConnection):
+        self.conn = conn
+        self.rows: list[tuple] = []
+
+    def __enter__(self) -> FakeCursor:
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def execute(self, query: str, params: tuple | None = None):
+        if self.conn.broken:
+            raise psycopg2.OperationalError("server closed the connection")
+        query = " ".join(query.split())
+        self.conn.executed.append((query, params))
+        self.rows = list(self.conn.respond(query, params) or ())
+
+    def executemany(self, query: str, params: list[tuple]):
+        for row in params:
+            self.execute(query, row)
+
+    def mogrify(self, query: str, params: tuple | None = None) -> bytes:
+        return (query % tuple(map(repr, params or ()))).encode()
+
+    def copy_expert(self, query: str, file: IO[bytes]):
+        self.execute(query)
+        file.writelines(
+            ",".join(map(str, row)).encode() + b"\n" for row in self.rows
+        )
+        self.rows = []
+
+    def copy_from(self, file: IO[str], table: str):
+        self.conn.copied.append((table, file.read()))
+
+    def fetchone(self) -> tuple | None:
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchall(self) -> list[tuple]:
+        rows, self.rows = self.rows, []
+        return rows
+
+
+class FakeConnection:
+    """
+    Stands in for a `psycopg2` connection
+
+    Every executed query is recorded with its parameters, with whitespace
+    collapsed, and answered with the rows returned by `respond`.
+    """
+
+    def __init__(self, respond=None):
+        self.respond = respond or (lambda query, params: ())
+        self.executed: list[tuple[str, tuple | None]] = []
+        self.copied: list[tuple[str, str]] = []
+        self.closed = 0
+        self.broken = False
+        self.commits = 0
+        self.rollbacks = 0
+
+    def cursor(self, name: str | None = None) -> FakeCursor:
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        if self.broken:
+            raise psycopg2.InterfaceError("connection already closed")
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = 1
+
+
+class FakePool:
+    """Stands in for a `ConnectionPool`, handing out a single connection"""
+
+    def __init__(self, respond=None):
+        self.conn = FakeConnection(respond)
+
+    @contextmanager
+    def connection(self) -> Iterator[FakeConnection]:
+        try:
+            yield self.conn
+        except BaseException:
+            self.conn.rollback()
+            raise
+        else:
+            self.conn.commit()
@@ -0,0 +1,189 @@
+"""
+TheReposterminator Reddit bot to detect reposts
+Copyright (C) 2023 sardonicism-04
+
+TheReposterminator is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TheReposterminator is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with TheReposterminator.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import html
+from types import SimpleNamespace
+
+import psycopg2
+import pytest
+from prawcore import exceptions
+
+from TheReposterminator.actions import ActionQueue
+from TheReposterminator.types import Action
+
+from .fakes import FakePool
+
+
+class Comments(list):
+    def replace_more(self, limit: int):
+        pass
+
+
+class Reddit:
+    def __init__(self):
+        self.reports: list[tuple[str, str]] = []
+        self.comments: dict[str, Comments] = {}
+        self.error: Exception | None = None
+
+    def submission(self, id: str) -> SimpleNamespace:
+        return SimpleNamespace(
+            id=id,
+            report=lambda reason: self.report(id, reason),
+            comments=self.comments.setdefault(id, Comments()),
+        )
+
+    def report(self, id: str, reason: str):
+        if self.error is not None:
+            raise self.error
+        self.reports.append((id, reason))
+
+
+def make_queue(**config) -> ActionQueue:
+    reddit = Reddit()
+    bot = SimpleNamespace(
+        config={
+            "actions": config,
+            "reddit": {"username": "RepostBot"},
+            "templates": {"bot_notice": "\n\n*beep boop*"},
+        },
+        pool=FakePool(),
+        reddit=reddit,
+        replies=[],
+        reported=[],
+        metrics=SimpleNamespace(
+            action_seconds=SimpleNamespace(observe=lambda *args, **kwargs: None)
+        ),
+    )
+
+    def reply(body: str, *, target) -> SimpleNamespace:
+        comment = SimpleNamespace(
+            id=f"c{len(bot.replies)}",
+            author=SimpleNamespace(name="RepostBot"),
+            # Reddit escapes HTML entities in comment bodies
+            body=html.escape(body + "\n\n*beep boop*"),
+        )
+        bot.replies.append(comment)
+        reddit.comments.setdefault(target.id, Comments()).append(comment)
+        return comment
+
+    bot.reply = reply
+    bot.lag = SimpleNamespace(record_report=bot.reported.append)
+    return ActionQueue(bot)
+
+
+def updates(queue: ActionQueue) -> list[tuple]:
+    return [
+        params
+        for query, params in queue.bot.pool.conn.executed
+        if query.startswith("UPDATE moderation_actions")
+    ]
+
+
+def test_enqueue_ignores_queued_keys():
+    queue = make_queue()
+    queue.enqueue(Action("report:abc", "report", "abc", {"reason": "Repost"}))
+
+    ((query, params),) = queue.bot.pool.conn.executed
+    assert query.endswith("ON CONFLICT (idempotency_key) DO NOTHING")
+    assert params[:3] == ("report:abc", "report", "abc")
+
+
+def test_report_completes_and_records_lag():
+    queue = make_queue()
+    queue.attempt(1, "report", "abc", {"reason": "Repost"}, 1)
+
+    assert queue.bot.reddit.reports == [("abc", "Repost")]
+    assert updates(queue) == [(1,)]
+    assert queue.bot.reported == ["abc"]
+    assert queue.stats["completed"] == 1
+
+
+def test_failing_to_record_lag_keeps_the_report_done():
+    queue = make_queue()
+
+    def record_report(target: str):
+        raise psycopg2.OperationalError("server closed the connection")
+
+    queue.bot.lag.record_report = record_report
+    queue.attempt(1, "report", "abc", {"reason": "Repost"}, 1)
+    assert updates(queue) == [(1,)]
+    assert queue.stats["completed"] == 1
+
+
+def test_retried_reply_reuses_an_earlier_reply():
+    queue = make_queue()
+    payload = {"body": "Possible repost & more", "remove": True}
+
+    queue.attempt(1, "reply", "abc", payload, 1)
+    # A retry, as if the first attempt replied but failed to record it
+    queue.attempt(1, "reply", "abc", payload, 2)
+
+    assert len(queue.bot.replies) == 1
+    follow_ups = [
+        params
+        for query, params in queue.bot.pool.conn.executed
+        if query.startswith("INSERT INTO moderation_actions")
+    ]
+    # Both attempts queue the same removal, which is only queued once
+    assert [params[0] for params in follow_ups] == ["remove_comment:c0"] * 2
+
+
+def test_retried_reply_ignores_other_replies():
+    queue = make_queue()
+    queue.attempt(1, "reply", "abc", {"body": "Report table"}, 1)
+    queue.attempt(2, "reply", "abc", {"body": "Removed as a repost"}, 2)
+    assert len(queue.bot.replies) == 2
+
+
+def test_transient_failures_back_off():
+    queue = make_queue(base_delay=30, max_delay=100, max_attempts=5)
+    queue.bot.reddit.error = exceptions.ServerError(
+        SimpleNamespace(status_code=503)
+    )
+
+    for attempts in range(1, 5):
+        queue.attempt(1, "report", "abc", {"reason": "Repost"}, attempts)
+    queue.attempt(1, "report", "abc", {"reason": "Repost"}, 5)
+
+    assert [(status, delay) for status, _, delay, _ in updates(queue)] == [
+        ("pending", 30),
+        ("pending", 60),
+        ("pending", 100),
+        ("pending", 100),
+        ("failed", 0),
+    ]
+    assert queue.stats == {"completed": 0, "retried": 4, "failed": 1}
+    assert queue.bot.reported == []
+
+
+def test_permanent_failures_are_not_retried():
+    queue = make_queue()
+    queue.bot.reddit.error = exceptions.Forbidden(
+        SimpleNamespace(status_code=403)
+    )
+    queue.attempt(1, "report", "abc", {"reason": "Repost"}, 1)
+    ((status, error, delay, id),) = updates(queue)
+    assert (status, delay, id) == ("failed", 0, 1)
+    assert error.startswith("Forbidden")
+
+
+def test_unknown_kinds_fail():
+    queue = make_queue()
+    with pytest.raises(ValueError):
+        queue.perform("ban", "abc", {}, retry=False)
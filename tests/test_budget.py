@@ -0,0 +1,104 @@
+"""
+TheReposterminator Reddit bot to detect reposts
+Copyright (C) 2023 sardonicism-04
+
+TheReposterminator is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TheReposterminator is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with TheReposterminator.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from TheReposterminator.budget import Priority, RequestBudget
+
+
+class Response(SimpleNamespace):
+    status_code = 200
+
+
+def make_budget(remaining: float, used: int, reset: float, **config):
+    budget = RequestBudget(SimpleNamespace(config={"budget": config}))
+    budget.record(
+        "GET",
+        "https://oauth.reddit.com/r/pics/new",
+        0.1,
+        Response(
+            headers={
+                "x-ratelimit-remaining": str(remaining),
+                "x-ratelimit-used": str(used),
+                "x-ratelimit-reset": str(reset),
+            }
+        ),
+    )
+    return budget
+
+
+def test_acquires_without_ratelimit_state(clock):
+    budget = RequestBudget(SimpleNamespace(config={}))
+    budget.acquire()
+    assert clock.sleeps == []
+
+
+def test_acquires_above_reserve(clock):
+    budget = make_budget(remaining=50, used=50, reset=300)
+    for priority in Priority:
+        with budget.priority(priority):
+            budget.acquire()
+    assert clock.sleeps == []
+
+
+def test_lower_priorities_wait_for_reset(clock):
+    # 20% of the window remains, below the backfill reserve only
+    budget = make_budget(remaining=20, used=80, reset=12)
+    with budget.priority(Priority.SCAN):
+        budget.acquire()
+    assert clock.sleeps == []
+
+    with budget.priority(Priority.BACKFILL):
+        budget.acquire()
+    assert clock.sleeps == [5, 5, 2]
+    assert budget.throttled[Priority.BACKFILL] == 1
+    assert budget.throttled[Priority.SCAN] == 0
+
+
+def test_writes_spend_the_whole_window(clock):
+    budget = make_budget(remaining=1, used=99, reset=300)
+    with budget.priority(Priority.WRITE):
+        budget.acquire()
+    assert clock.sleeps == []
+
+    budget.acquire()  # Scans by default
+    assert sum(clock.sleeps) == pytest.approx(300)
+
+
+def test_configured_reserves(clock):
+    budget = make_budget(
+        remaining=40, used=60, reset=3, reserves={"scan": 0.5}
+    )
+    budget.acquire()
+    assert clock.sleeps == [3]
+
+
+def test_priority_is_per_thread():
+    budget = RequestBudget(SimpleNamespace(config={}))
+    seen = []
+    with budget.priority(Priority.WRITE):
+        thread = threading.Thread(target=lambda: seen.append(budget.current))
+        thread.start()
+        thread.join()
+        assert budget.current is Priority.WRITE
+    assert seen == [Priority.SCAN]
+    assert budget.current is Priority.SCAN
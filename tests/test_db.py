@@ -0,0 +1,201 @@
+"""
+TheReposterminator Reddit bot to detect reposts
+Copyright (C) 2023 sardonicism-04
+
+TheReposterminator is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TheReposterminator is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with TheReposterminator.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import psycopg2
+import pytest
+
+from TheReposterminator.db import (
+    REPLAY_CHECK_INTERVAL,
+    ConnectionPool,
+    PoolExhausted,
+    ReadRouter,
+    parse_lsn,
+)
+
+from .fakes import FakeConnection, FakePool
+
+
+@pytest.fixture
+def connections(monkeypatch) -> list[FakeConnection]:
+    """Every connection opened by a pool, most recent last"""
+    opened: list[FakeConnection] = []
+
+    def connect(**kwargs) -> FakeConnection:
+        opened.append(conn := FakeConnection())
+        return conn
+
+    monkeypatch.setattr("psycopg2.connect", connect)
+    return opened
+
+
+def test_commits_and_reuses_connections(connections):
+    pool = ConnectionPool({}, max_connections=2)
+    with pool.connection() as conn:
+        pass
+    with pool.connection() as again:
+        pass
+
+    assert conn is again
+    assert conn.commits == 2
+    assert len(connections) == 1
+
+
+def test_rolls_back_on_error(connections):
+    pool = ConnectionPool({})
+    with pytest.raises(ValueError), pool.connection() as conn:
+        raise ValueError
+
+    assert conn.rollbacks == 1
+    assert pool.stats["idle"] == 1
+
+
+def test_discards_broken_connections(connections):
+    pool = ConnectionPool({})
+    with pytest.raises(psycopg2.OperationalError), pool.connection() as conn:
+        conn.broken = True
+        conn.cursor().execute("SELECT 1")
+
+    assert pool.stats["size"] == 0
+    with pool.connection() as replacement:
+        assert replacement is not conn
+    assert pool.stats["discarded"] == 1
+
+
+def test_replaces_unhealthy_connections_within_max(connections, monkeypatch):
+    pool = ConnectionPool({}, max_connections=1, health_check_interval=0)
+    connections[0].broken = True
+
+    sizes = []
+    connect = psycopg2.connect
+
+    def replace(**kwargs) -> FakeConnection:
+        # The broken connection's slot must still be held
+        sizes.append(pool.stats["size"])
+        return connect(**kwargs)
+
+    monkeypatch.setattr("psycopg2.connect", replace)
+    with pool.connection() as conn:
+        assert conn is connections[1]
+
+    assert sizes == [1]
+    assert connections[0].closed
+    assert pool.stats["size"] == 1
+    assert pool.stats["reconnects"] == 1
+
+
+def test_failed_replacement_releases_its_slot(connections, monkeypatch):
+    pool = ConnectionPool(
+        {}, max_connections=1, health_check_interval=0, max_retries=0
+    )
+    connections[0].broken = True
+
+    def refuse(**kwargs):
+        raise psycopg2.OperationalError("connection refused")
+
+    monkeypatch.setattr("psycopg2.connect", refuse)
+    with pytest.raises(psycopg2.OperationalError), pool.connection():
+        pass
+    assert pool.stats["size"] == 0
+
+
+def test_retries_with_backoff(connections, monkeypatch, clock):
+    failures = 2
+    connect = psycopg2.connect
+
+    def flaky(**kwargs) -> FakeConnection:
+        nonlocal failures
+        if failures:
+            failures -= 1
+            raise psycopg2.OperationalError("connection refused")
+        return connect(**kwargs)
+
+    monkeypatch.setattr("psycopg2.connect", flaky)
+    ConnectionPool({})
+    assert clock.sleeps == [1, 2]
+    assert len(connections) == 1
+
+
+def test_raises_when_exhausted(connections):
+    pool = ConnectionPool({}, max_connections=1, acquire_timeout=0.05)
+    with pool.connection(), pytest.raises(PoolExhausted):
+        with pool.connection():
+            pass
+
+
+class Replica(FakePool):
+    """A replica reporting a configurable lag and replay position"""
+
+    def __init__(self, lag: float | None = 0, replay_lsn: str = "0/100"):
+        self.lag = lag
+        self.replay_lsn = replay_lsn
+        super().__init__(lambda query, params: [(self.lag, self.replay_lsn)])
+
+
+def test_parse_lsn():
+    assert parse_lsn("0/0") == 0
+    assert parse_lsn("16/B374D848") == 0x16 << 32 | 0xB374D848
+
+
+def test_reads_go_to_primary_without_replica():
+    router = ReadRouter(FakePool())
+    with router.connection() as conn:
+        assert conn is router.primary.conn
+    assert router.stats["primary_reads"] == 1
+
+
+def test_reads_go_to_fresh_replica(clock):
+    router = ReadRouter(FakePool(), Replica(lag=1), max_staleness=5)
+    with router.connection() as conn:
+        assert conn is router.replica.conn
+    with router.connection(primary=True) as conn:
+        assert conn is router.primary.conn
+
+
+def test_reads_avoid_stale_replica(clock):
+    replica = Replica(lag=10)
+    router = ReadRouter(FakePool(), replica, max_staleness=5)
+    assert not router.use_replica()
+
+    # The lag is only measured again after the check interval
+    replica.lag = None
+    clock.now += router.lag_check_interval
+    assert not router.use_replica()
+    assert router.replica_lag() == float("inf")
+
+
+def test_reads_wait_for_replica_to_replay_writes(clock):
+    replica = Replica(replay_lsn="0/100")
+    router = ReadRouter(FakePool(), replica)
+    assert router.use_replica()
+
+    router.note_write("0/100")
+    assert not router.use_replica()
+    assert router.stats["replica_behind_write"] == 1
+
+    # Replayed beyond the write, but not yet rechecked
+    replica.replay_lsn = "0/180"
+    assert not router.use_replica()
+
+    clock.now += REPLAY_CHECK_INTERVAL
+    assert router.use_replica()
+    assert router.stats["replica_behind_write"] == 0
+
+    # Earlier writes don't move the position back
+    router.note_write("0/50")
+    assert router.use_replica()
@@ -0,0 +1,139 @@
+"""
+TheReposterminator Reddit bot to detect reposts
+Copyright (C) 2023 sardonicism-04
+
+TheReposterminator is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TheReposterminator is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with TheReposterminator.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+from types import SimpleNamespace
+
+from TheReposterminator.failures import (
+    DeferredFailure,
+    FailureCache,
+    PermanentFailure,
+    TransientFailure,
+)
+
+from .fakes import FakePool
+
+
+def make_failures(permanent=False, attempts=1, **config) -> FailureCache:
+    def respond(query: str, params) -> list[tuple]:
+        if query.startswith("INSERT INTO submission_failures"):
+            return [(permanent or params["permanent"], attempts)]
+        return []
+
+    bot = SimpleNamespace(config={"failures": config}, pool=FakePool(respond))
+    return FailureCache(bot)
+
+
+def queries(failures: FailureCache, prefix: str) -> list[tuple]:
+    return [
+        params
+        for query, params in failures.bot.pool.conn.executed
+        if query.startswith(prefix)
+    ]
+
+
+def test_transient_failures_back_off(clock):
+    failures = make_failures(attempts=3, base_delay=60, max_delay=3_600)
+    failures.record("abc", TransientFailure("timed out"), first_seen=clock.now)
+
+    assert queries(failures, "UPDATE submission_failures") == [(240, "abc")]
+    assert queries(failures, "INSERT INTO indexed_submissions") == []
+    assert failures.stats == {"permanent": 0, "transient": 1, "cached": 1}
+
+    assert failures.waiting("abc")
+    clock.now += 239
+    assert failures.waiting("abc")
+    clock.now += 1
+    assert not failures.waiting("abc")
+    assert failures.stats["cached"] == 0
+
+
+def test_backoff_is_capped():
+    failures = make_failures(attempts=10, base_delay=60, max_delay=3_600)
+    failures.record("abc", TransientFailure("timed out"), first_seen=0)
+    assert queries(failures, "UPDATE submission_failures") == [(3_600, "abc")]
+
+
+def test_permanent_failures_are_marked_indexed():
+    failures = make_failures()
+    failures.remember("abc", 60)
+    failures.record("abc", PermanentFailure("not an image"), first_seen=0)
+
+    assert queries(failures, "INSERT INTO submission_failures") == [
+        {
+            "id": "abc",
+            "error_class": "PermanentFailure",
+            "permanent": True,
+            "error": "not an image",
+            "max_attempts": 4,
+            "first_seen": 0,
+        }
+    ]
+    assert queries(failures, "INSERT INTO indexed_submissions") == [("abc",)]
+    assert queries(failures, "UPDATE submission_failures") == []
+    assert not failures.waiting("abc")
+    assert failures.stats["permanent"] == 1
+
+
+def test_transient_failures_become_permanent_after_too_many_attempts():
+    # The database decides from the stored attempts
+    failures = make_failures(permanent=True, attempts=4)
+    failures.record("abc", TransientFailure("timed out"), first_seen=0)
+    assert queries(failures, "INSERT INTO indexed_submissions") == [("abc",)]
+    assert failures.stats == {"permanent": 1, "transient": 0, "cached": 0}
+
+
+def test_deferrals_are_not_persisted(clock):
+    failures = make_failures()
+    failures.record(
+        "abc", DeferredFailure("rate limited", retry_in=30), first_seen=clock.now
+    )
+    assert failures.bot.pool.conn.executed == []
+    assert failures.waiting("abc")
+    clock.now += 30
+    assert not failures.waiting("abc")
+
+
+def test_first_seen_survives_deferrals():
+    failures = make_failures()
+    failures.record("abc", DeferredFailure("rate limited", retry_in=30), first_seen=5)
+
+    assert failures.first_seen("abc", 100) == 5
+    # It's taken, to be kept again if deferred once more
+    assert failures.first_seen("abc", 100) == 100
+    assert failures.first_seen("abc", 100, stored=50) == 50
+
+
+def test_cache_is_bounded():
+    failures = make_failures(max_cached=2)
+    for submission_id in ("a", "b", "c"):
+        failures.remember(submission_id, 60)
+    assert list(failures.cache) == ["b", "c"]
+
+    # Waiting submissions are kept as recently used
+    assert failures.waiting("b")
+    failures.remember("d", 60)
+    assert list(failures.cache) == ["b", "d"]
+
+
+def test_clear_forgets_the_failure():
+    failures = make_failures()
+    failures.remember("abc", 60)
+    failures.clear("abc")
+    assert not failures.waiting("abc")
+    assert queries(failures, "DELETE FROM submission_failures") == [("abc",)]
@@ -0,0 +1,127 @@
+"""
+TheReposterminator Reddit bot to detect reposts
+Copyright (C) 2023 sardonicism-04
+
+TheReposterminator is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TheReposterminator is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with TheReposterminator.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import math
+
+import pytest
+
+from TheReposterminator.hosts import HostState
+
+
+def make_state(**config) -> HostState:
+    return HostState(
+        "i.example.com",
+        {"rate": 1.0, "burst": 2, "failure_threshold": 3, "cooldown": 60.0}
+        | config,
+    )
+
+
+def test_token_bucket(clock):
+    state = make_state()
+    assert state.admit() == 0
+    assert state.admit() == 0
+    assert state.admit() == pytest.approx(1.0)
+
+    clock.now += 0.5
+    assert state.admit() == pytest.approx(0.5)
+
+    clock.now += 0.5
+    assert state.admit() == 0
+
+    # The bucket never refills beyond its burst
+    clock.now += 100
+    assert state.admit() == 0
+    assert state.admit() == 0
+    assert state.admit() > 0
+
+
+def test_opens_after_consecutive_failures(clock):
+    state = make_state(burst=100)
+    for _ in range(2):
+        state.record(0.1, failed=True)
+    state.record(0.1, failed=False)  # Resets the consecutive failures
+    for _ in range(2):
+        state.record(0.1, failed=True)
+    assert state.state == "closed"
+
+    state.record(0.1, failed=True)
+    assert state.state == "open"
+    assert state.admit() == pytest.approx(60.0)
+
+    clock.now += 45
+    assert state.admit() == pytest.approx(15.0)
+    assert state.stats["errors"] == 5
+
+
+def test_half_open_lets_a_single_probe_through(clock):
+    state = make_state(burst=100, failure_threshold=1)
+    state.record(0.1, failed=True)
+
+    clock.now += 60
+    assert state.state == "half-open"
+    assert state.admit() == 0
+    assert state.admit() == math.inf
+
+    # A successful probe closes the breaker
+    state.record(0.1, failed=False)
+    assert state.state == "closed"
+    assert state.admit() == 0
+    assert state.admit() == 0
+
+
+def test_failed_probe_reopens(clock):
+    state = make_state(burst=100, failure_threshold=1)
+    state.record(0.1, failed=True)
+
+    clock.now += 60
+    assert state.admit() == 0
+    state.record(0.1, failed=True)
+    assert state.state == "open"
+    assert state.admit() == pytest.approx(60.0)
+
+    clock.now += 60
+    assert state.admit() == 0
+
+
+def test_abandoned_probe_is_replaced(clock):
+    state = make_state(burst=100, failure_threshold=1)
+    state.record(0.1, failed=True)
+
+    clock.now += 60
+    assert state.admit() == 0
+    assert state.admit() == math.inf
+    state.abandon()
+    assert state.admit() == 0
+
+
+def test_probe_waits_for_tokens(clock):
+    state = make_state(burst=1, failure_threshold=1)
+    assert state.admit() == 0
+    state.record(0.1, failed=True)
+
+    # With the bucket still empty after the cooldown, the probe isn't held
+    clock.now += 60
+    state.tokens = 0
+    state.refilled_at = clock.now
+    assert state.admit() == pytest.approx(1.0)
+    assert not state.probing
+
+    clock.now += 1
+    assert state.admit() == 0
+    assert state.probing
@@ -0,0 +1,238 @@
+"""
+TheReposterminator Reddit bot to detect reposts
+Copyright (C) 2023 sardonicism-04
+
+TheReposterminator is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TheReposterminator is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with TheReposterminator.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import random
+from types import SimpleNamespace
+
+import pytest
+
+from TheReposterminator.index import (
+    GlobalIndex,
+    IndexStore,
+    SubredditIndex,
+    Watermark,
+)
+
+
+def make_rows(count: int, seed: int) -> list[tuple[int, str, int, int]]:
+    """Generates rows, with clusters of near-duplicates of a few hashes"""
+    rng = random.Random(seed)
+    originals = [rng.getrandbits(64) for _ in range(8)]
+    rows = []
+    for row_id in range(1, count + 1):
+        image_hash = rng.getrandbits(64)
+        if rng.random() < 0.5:
+            image_hash = rng.choice(originals)
+            for bit in rng.sample(range(64), rng.randrange(12)):
+                image_hash ^= 1 << bit
+        created = rng.choice([0, rng.randrange(1_000, 2_000)])
+        rows.append((image_hash, f"id{row_id}", created, row_id))
+    return rows
+
+
+def brute_force(
+    rows, image_hash: int, max_distance: int, *, exclude: str, min_created=0
+) -> set[tuple[int, str]]:
+    return {
+        (candidate, submission_id)
+        for candidate, submission_id, created, _ in rows
+        if not 0 < created < min_created
+        and (candidate ^ image_hash).bit_count() <= max_distance
+        and submission_id != exclude
+    }
+
+
+@pytest.mark.parametrize("max_distance", [0, 3, 7, 12])
+def test_subreddit_search_matches_brute_force(max_distance):
+    rows = make_rows(500, seed=max_distance)
+    index = SubredditIndex("test")
+    for image_hash, submission_id, created, row_id in rows:
+        index.add(image_hash, submission_id, created, row_id)
+
+    for image_hash, submission_id, created, _ in rows[::25]:
+        found = {
+            (candidate, found_id)
+            for candidate, found_id, _ in index.search(
+                image_hash, max_distance, exclude=submission_id, min_created=1500
+            )
+        }
+        assert found == brute_force(
+            rows, image_hash, max_distance, exclude=submission_id, min_created=1500
+        )
+    assert index.scanned == len(rows)
+
+
+def test_snapshot_round_trip(tmp_path):
+    rows = make_rows(300, seed=1)
+    index = SubredditIndex("test")
+    for image_hash, submission_id, created, row_id in rows[:200]:
+        index.add(image_hash, submission_id, created, row_id)
+    index.watermark.settled = 150
+    index.write_snapshot(tmp_path / "test.snap")
+
+    loaded = SubredditIndex("test")
+    assert loaded.load_snapshot(tmp_path / "test.snap")
+    assert len(loaded) == 200
+    assert not loaded.dirty
+    assert loaded.watermark.settled == 150
+    assert loaded.watermark.highest == 200
+    assert all(loaded.contains(row_id) for row_id in range(1, 201))
+    assert not loaded.contains(201)
+
+    # Rows added on top of the snapshot are searched along with it
+    for image_hash, submission_id, created, row_id in rows[200:]:
+        loaded.add(image_hash, submission_id, created, row_id)
+    assert loaded.dirty
+    for image_hash, submission_id, _, _ in rows[::30]:
+        found = {
+            (candidate, found_id)
+            for candidate, found_id, _ in loaded.search(
+                image_hash, 8, exclude=submission_id
+            )
+        }
+        assert found == brute_force(rows, image_hash, 8, exclude=submission_id)
+    loaded.close()
+
+
+def test_snapshot_rejects_invalid_files(tmp_path):
+    index = SubredditIndex("test")
+    index.add(1, "a", 0, 1)
+    index.write_snapshot(tmp_path / "test.snap")
+    data = (tmp_path / "test.snap").read_bytes()
+
+    (tmp_path / "truncated.snap").write_bytes(data[:-1])
+    (tmp_path / "garbage.snap").write_bytes(b"\x00" * len(data))
+    for name in ("truncated.snap", "garbage.snap", "missing.snap"):
+        assert not SubredditIndex("test").load_snapshot(tmp_path / name)
+
+
+def test_contains_rows_committed_out_of_order():
+    index = SubredditIndex("test")
+    index.watermark = Watermark(settled=10, highest=10)
+    index.add(1, "a", 0, 12)
+
+    # Row 11 committed after row 12, and is still above the settled watermark
+    assert index.contains(10)
+    assert index.contains(12)
+    assert not index.contains(11)
+
+
+def test_watermark_settles_after_replay_window(clock):
+    watermark = Watermark()
+    watermark.advance(50)
+    watermark.mark(clock.now)
+    assert watermark.settled == 0
+
+    clock.now += 299
+    watermark.advance(80)
+    watermark.mark(clock.now)
+    assert watermark.settled == 0
+
+    clock.now += 1
+    watermark.mark(clock.now)
+    assert watermark.settled == 50
+
+    clock.now += 300
+    watermark.mark(clock.now)
+    assert watermark.settled == 80
+
+
+@pytest.mark.parametrize("max_distance", [0, 4, 7, 11])
+def test_global_search_matches_brute_force(max_distance):
+    rows = make_rows(600, seed=100 + max_distance)
+    index = GlobalIndex()
+    index.subnames = {"a", "b"}
+    subnames = {}
+    for position, (image_hash, submission_id, created, row_id) in enumerate(rows):
+        subnames[submission_id] = "abc"[position % 3]
+        index.add(image_hash, submission_id, subnames[submission_id], created, row_id)
+
+    participating = [row for row in rows if subnames[row[1]] in index.subnames]
+    for image_hash, submission_id, _, _ in rows[::20]:
+        found = {
+            (candidate, found_id)
+            for candidate, found_id, subname in index.search(
+                image_hash, max_distance, exclude=submission_id, min_created=1500
+            )
+            if subname == subnames[found_id]
+        }
+        assert found == brute_force(
+            participating,
+            image_hash,
+            max_distance,
+            exclude=submission_id,
+            min_created=1500,
+        )
+
+
+def test_global_add_skips_duplicate_rows():
+    index = GlobalIndex()
+    index.add(1, "a", "sub", 0, 5)
+    index.add(1, "a", "sub", 0, 5)
+    assert len(index) == 1
+
+
+def make_store(tmp_path) -> IndexStore:
+    return IndexStore(
+        SimpleNamespace(config={"snapshots": {"directory": str(tmp_path)}})
+    )
+
+
+@pytest.mark.parametrize("resident", [True, False])
+def test_expire_removes_old_rows(tmp_path, resident):
+    rows = make_rows(300, seed=2)
+    store = make_store(tmp_path)
+    index = SubredditIndex("test")
+    for image_hash, submission_id, created, row_id in rows[:200]:
+        index.add(image_hash, submission_id, created, row_id)
+    index.watermark.settled = 150
+    index = store.write_snapshot(index)
+    for image_hash, submission_id, created, row_id in rows[200:]:
+        index.add(image_hash, submission_id, created, row_id)
+    if resident:
+        store.indexes["test"] = index
+    else:
+        store.write_snapshot(index).close()
+
+    store.expire("test", 1500)
+    expired = SubredditIndex("test")
+    assert expired.load_snapshot(store.snapshot_path("test"))
+    if resident:
+        assert store.indexes["test"].subname == "test"
+        assert len(store.indexes["test"]) == len(expired)
+
+    kept = [row for row in rows if not 0 < row[2] < 1500]
+    assert len(expired) == len(kept)
+    assert expired.watermark.settled == 150
+    assert all(expired.contains(row_id) for row_id in range(1, 301))
+    for image_hash, submission_id, _, _ in rows[::30]:
+        found = {
+            (candidate, found_id)
+            for candidate, found_id, _ in expired.search(
+                image_hash, 8, exclude=submission_id
+            )
+        }
+        assert found == brute_force(kept, image_hash, 8, exclude=submission_id)
+    expired.close()
+
+
+def test_expire_ignores_missing_snapshots(tmp_path):
+    store = make_store(tmp_path)
+    store.expire("test", 1500)
+    assert not store.snapshot_path("test").exists()
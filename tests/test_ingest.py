@@ -0,0 +1,152 @@
+"""
+TheReposterminator Reddit bot to detect reposts
+Copyright (C) 2023 sardonicism-04
+
+TheReposterminator is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TheReposterminator is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with TheReposterminator.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import json
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from TheReposterminator.ingest import Ingester
+from TheReposterminator.types import SubData
+
+from .fakes import FakePool
+
+
+def write_dump(path: Path, ids: list[str], subname="pics") -> Path:
+    path.write_text(
+        "".join(
+            json.dumps(
+                {
+                    "id": id,
+                    "subreddit": subname,
+                    "url": f"https://i.redd.it/{id}.jpg",
+                    "created_utc": 1_600_000_000,
+                }
+            )
+            + "\n"
+            for id in ids
+        )
+    )
+    return path
+
+
+@pytest.fixture
+def ingester(tmp_path, monkeypatch) -> Ingester:
+    monkeypatch.setattr(
+        "TheReposterminator.ingest.generate_hash", lambda media: len(media)
+    )
+    images = tmp_path / "images"
+    images.mkdir()
+    for id in ("a", "b", "c", "d", "e"):
+        (images / f"{id}.jpg").write_bytes(b"x" * (ord(id) - ord("a") + 1))
+
+    bot = SimpleNamespace(subreddits=[SubData("pics", True)], pool=FakePool())
+    return Ingester(
+        bot,
+        images=images,
+        fetch=False,
+        workers=2,
+        batch_size=2,
+        checkpoints=tmp_path / "checkpoints",
+    )
+
+
+def loaded(ingester: Ingester) -> list[str]:
+    return [
+        line.split("\t")[1]
+        for _, rows in ingester.bot.pool.conn.copied
+        for line in rows.splitlines()
+    ]
+
+
+def test_ingests_every_batch(ingester, tmp_path):
+    dump = write_dump(tmp_path / "RS_pics", ["a", "b", "c"])
+    ingester.ingest(dump)
+
+    assert loaded(ingester) == ["a", "b", "c"]
+    assert +ingester.counts == {"indexed": 3}
+    checkpoint = ingester.read_checkpoint(dump)
+    assert checkpoint["complete"]
+    assert checkpoint["offset"] == dump.stat().st_size
+
+
+def test_resumes_from_the_last_committed_batch(ingester, tmp_path):
+    dump = write_dump(tmp_path / "RS_pics", ["a", "b", "c", "d", "e"])
+    load = ingester.load
+
+    def interrupted(outcomes):
+        if outcomes[0].post.id == "c":
+            raise KeyboardInterrupt
+        load(outcomes)
+
+    ingester.load = interrupted
+    with pytest.raises(KeyboardInterrupt):
+        ingester.ingest(dump)
+    checkpoint = ingester.read_checkpoint(dump)
+    assert not checkpoint["complete"]
+    assert checkpoint["counts"]["indexed"] == 2
+
+    ingester.load = load
+    ingester.ingest(dump)
+    assert loaded(ingester) == ["a", "b", "c", "d", "e"]
+    assert +ingester.counts == {"indexed": 5}
+
+    # A completed dump isn't read again
+    ingester.ingest(dump)
+    assert len(loaded(ingester)) == 5
+
+
+def test_restart_ignores_the_checkpoint(ingester, tmp_path):
+    dump = write_dump(tmp_path / "RS_pics", ["a"])
+    ingester.ingest(dump)
+    ingester.ingest(dump, restart=True)
+    assert loaded(ingester) == ["a", "a"]
+
+
+def test_checkpoints_of_changed_dumps_are_ignored(ingester, tmp_path):
+    dump = write_dump(tmp_path / "RS_pics", ["a", "b", "c"])
+    ingester.ingest(dump)
+
+    write_dump(dump, ["a", "b", "c", "d"])
+    assert ingester.read_checkpoint(dump) == {}
+    ingester.ingest(dump)
+    assert loaded(ingester) == ["a", "b", "c", "a", "b", "c", "d"]
+
+
+def test_passes_over_other_subreddits_and_indexed_posts(ingester, tmp_path):
+    dump = write_dump(tmp_path / "RS_pics", ["a", "b", "c"])
+    with dump.open("a") as file:
+        file.write(
+            json.dumps({"id": "x", "subreddit": "memes", "created_utc": 0}) + "\n"
+        )
+        file.write("not json\n")
+
+    ingester.bot.pool.conn.respond = lambda query, params: (
+        [("b",)] if query.startswith("SELECT id FROM indexed_submissions") else []
+    )
+    ingester.ingest(dump)
+
+    assert loaded(ingester) == ["a", "c"]
+    assert +ingester.counts == {
+        "indexed": 2,
+        "already_indexed": 1,
+        "other_subreddit": 1,
+        "skipped": 1,
+    }
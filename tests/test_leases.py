@@ -0,0 +1,156 @@
+"""
+TheReposterminator Reddit bot to detect reposts
+Copyright (C) 2023 sardonicism-04
+
+TheReposterminator is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TheReposterminator is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with TheReposterminator.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+from types import SimpleNamespace
+
+from TheReposterminator.leases import INBOX_RESOURCE, LeaseManager
+from TheReposterminator.types import SubData
+
+from .fakes import FakePool
+
+
+class Leases:
+    """Answers a worker's lease queries from a fixed view of the database"""
+
+    def __init__(self, *, workers=1, subreddits=4, held=(), free=(), inbox=True):
+        self.workers = workers
+        self.subreddits = subreddits
+        self.held = list(held)
+        self.free = list(free)
+        self.inbox = inbox
+
+    def respond(self, query: str, params: tuple | None) -> list[tuple]:
+        if query == "SELECT COUNT(*) FROM workers":
+            return [(self.workers,)]
+        if query == "SELECT COUNT(*) FROM subreddits":
+            return [(self.subreddits,)]
+        if query.startswith("UPDATE worker_leases"):
+            return [(resource,) for resource in self.held]
+        if query.startswith("INSERT INTO worker_leases"):
+            if "FROM subreddits" not in query:
+                return [(INBOX_RESOURCE,)] if self.inbox else []
+            assert params is not None
+            return [(resource,) for resource in self.free[: params[2]]]
+        return []
+
+
+def make_leases(leases: Leases, *, known=("a", "b", "c", "d")) -> LeaseManager:
+    bot = SimpleNamespace(
+        pool=FakePool(leases.respond),
+        subreddits=[SubData(subname, True) for subname in known],
+        subreddit_configs={subname: {} for subname in known},
+        loaded=[],
+        updates=0,
+    )
+
+    def update_subs():
+        bot.updates += 1
+
+    bot.update_subs = update_subs
+    bot.get_config = bot.loaded.append
+    return LeaseManager(bot, "worker-1", lease_ttl=60)
+
+
+def queries(manager: LeaseManager, prefix: str) -> list[tuple]:
+    return [
+        params
+        for query, params in manager.bot.pool.conn.executed
+        if query.startswith(prefix)
+    ]
+
+
+def test_claims_up_to_the_fair_share():
+    manager = make_leases(Leases(workers=2, held=["a"], free=["b", "c"]))
+    manager.refresh()
+
+    assert manager.owned == {"a", "b"}
+    assert manager.leader
+    # Only the remainder of the share is claimed
+    (claim, _) = queries(manager, "INSERT INTO worker_leases")
+    assert claim == ("worker-1", "60 seconds", 1)
+    assert queries(manager, "DELETE FROM worker_leases WHERE worker_id") == []
+    # Everything happens in one transaction
+    assert manager.bot.pool.conn.commits == 1
+
+
+def test_releases_leases_above_the_fair_share():
+    manager = make_leases(Leases(workers=2, held=["d", "a", "c"], inbox=False))
+    manager.refresh()
+
+    assert manager.owned == {"a", "c"}
+    assert not manager.leader
+    assert queries(manager, "DELETE FROM worker_leases WHERE worker_id") == [
+        ("worker-1", ["d"])
+    ]
+    # Nothing is left to claim, other than the inbox
+    assert len(queries(manager, "INSERT INTO worker_leases")) == 1
+
+
+def test_claimed_unknown_subreddits_are_loaded():
+    manager = make_leases(Leases(free=["a", "e"]), known=("a",))
+    manager.refresh()
+
+    assert manager.owned == {"a", "e"}
+    assert manager.bot.updates == 1
+    assert manager.bot.loaded == ["e"]
+
+    # Leases that are merely renewed don't reload anything
+    manager.bot.pool.conn.respond = Leases(held=["a", "e"]).respond
+    manager.bot.subreddit_configs["e"] = {}
+    manager.refresh()
+    assert manager.bot.updates == 1
+    assert manager.bot.loaded == ["e"]
+
+
+def test_refreshes_every_third_of_the_ttl(clock):
+    manager = make_leases(Leases(held=["a"]))
+    assert manager.holds("a")
+    assert not manager.holds("b")
+    assert manager.bot.pool.conn.commits == 1
+
+    clock.now += 19
+    assert manager.holds("a")
+    assert manager.bot.pool.conn.commits == 1
+
+    # The lease is lost to another worker by the next refresh
+    manager.bot.pool.conn.respond = Leases(held=[]).respond
+    clock.now += 1
+    assert not manager.holds("a")
+    assert manager.bot.pool.conn.commits == 2
+
+
+def test_concurrent_refreshes_are_skipped(clock):
+    manager = make_leases(Leases(held=["a"]))
+    with manager.lock:
+        manager.refresh_if_due()
+    assert manager.bot.pool.conn.executed == []
+
+
+def test_release_drops_every_lease():
+    manager = make_leases(Leases(held=["a"]))
+    manager.refresh()
+    manager.bot.pool.conn.executed.clear()
+    manager.release()
+
+    assert manager.owned == set()
+    assert not manager.leader
+    assert [params for _, params in manager.bot.pool.conn.executed] == [
+        ("worker-1",),
+        ("worker-1",),
+    ]
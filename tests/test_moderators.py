@@ -0,0 +1,107 @@
+"""
+TheReposterminator Reddit bot to detect reposts
+Copyright (C) 2023 sardonicism-04
+
+TheReposterminator is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TheReposterminator is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with TheReposterminator.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+from types import SimpleNamespace
+
+from TheReposterminator.moderators import ModeratorCache
+
+
+class Reddit:
+    """Serves moderator lists, and a moderation log from newest to oldest"""
+
+    def __init__(self, moderators: dict[str, list[str]]):
+        self.moderators = moderators
+        self.log: list[SimpleNamespace] = []
+        self.fetched: list[str] = []
+        self.read = 0
+
+    def subreddit(self, subname: str) -> SimpleNamespace:
+        return SimpleNamespace(
+            moderator=lambda: self.fetch(subname),
+            mod=SimpleNamespace(log=self.read_log),
+        )
+
+    def fetch(self, subname: str) -> list[str]:
+        self.fetched.append(subname)
+        return self.moderators[subname]
+
+    def read_log(self, *, limit: int | None):
+        for entry in self.log[:limit]:
+            self.read += 1
+            yield entry
+
+
+def make_cache(**moderators: list[str]) -> ModeratorCache:
+    cache = ModeratorCache(
+        SimpleNamespace(config={}, reddit=Reddit(moderators))
+    )
+    cache.modlog_seen = 0
+    return cache
+
+
+def entry(created_utc: float, action: str, subname: str) -> SimpleNamespace:
+    return SimpleNamespace(
+        created_utc=created_utc, action=action, subreddit=subname
+    )
+
+
+def test_caches_moderators(clock):
+    cache = make_cache(pics=["Alice", "bob"])
+    assert cache.is_moderator("Pics", "alice")
+    assert cache.is_moderator("pics", "BOB")
+    assert cache.bot.reddit.fetched == ["pics"]
+    assert cache.stats["hits"] == 1
+
+    # Unknown users refetch a list once it is old enough
+    assert not cache.is_moderator("pics", "carol")
+    assert cache.bot.reddit.fetched == ["pics"]
+    clock.now += 60
+    assert not cache.is_moderator("pics", "carol")
+    assert cache.bot.reddit.fetched == ["pics", "pics"]
+
+    # Every list is refetched after the TTL
+    clock.now += 3600
+    assert cache.is_moderator("pics", "alice")
+    assert cache.bot.reddit.fetched == ["pics"] * 3
+
+
+def test_modlog_drops_changed_subreddits_beyond_a_page(clock):
+    cache = make_cache(pics=["alice"], memes=["bob"])
+    cache.is_moderator("pics", "alice")
+    cache.is_moderator("memes", "bob")
+
+    reddit = cache.bot.reddit
+    reddit.log = [entry(1_000 - i, "approvelink", "memes") for i in range(150)]
+    reddit.log[120] = entry(880, "removemoderator", "Pics")
+    reddit.log.append(entry(0, "removemoderator", "memes"))
+
+    clock.now += 60
+    cache.check_modlog()
+    assert set(cache.moderators) == {"memes"}
+    assert cache.modlog_seen == 1_000
+    # Entries seen by a previous check aren't read
+    assert reddit.read == 151
+
+    # The log isn't checked again until the interval has passed
+    reddit.log.insert(0, entry(1_001, "addmoderator", "memes"))
+    cache.check_modlog()
+    assert set(cache.moderators) == {"memes"}
+    clock.now += 60
+    cache.check_modlog()
+    assert cache.moderators == {}
@@ -0,0 +1,70 @@
+"""
+TheReposterminator Reddit bot to detect reposts
+Copyright (C) 2023 sardonicism-04
+
+TheReposterminator is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TheReposterminator is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with TheReposterminator.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+from types import SimpleNamespace
+
+from TheReposterminator.notifications import (
+    CONFIG_CHANNEL,
+    SUBREDDITS_CHANNEL,
+    NotificationListener,
+)
+from TheReposterminator.types import SubData
+
+
+def make_listener() -> NotificationListener:
+    bot = SimpleNamespace(
+        subreddits=[SubData("pics", True)],
+        subreddit_configs={"pics": {}},
+        loaded=[],
+    )
+    bot.get_config = lambda subname: bot.loaded.append(subname)
+    return NotificationListener(bot)
+
+
+def test_added_subreddits_are_loaded_with_their_config():
+    listener = make_listener()
+    bot = listener.bot
+    listener.apply(
+        SUBREDDITS_CHANNEL, {"op": "INSERT", "name": "memes", "indexed": False}
+    )
+    assert bot.subreddits == [SubData("pics", True), SubData("memes", False)]
+    assert bot.loaded == ["memes"]
+
+    # Updates to known subreddits keep their config
+    listener.apply(
+        SUBREDDITS_CHANNEL, {"op": "UPDATE", "name": "pics", "indexed": True}
+    )
+    assert bot.loaded == ["memes"]
+
+
+def test_removed_subreddits_are_dropped():
+    listener = make_listener()
+    listener.apply(
+        SUBREDDITS_CHANNEL, {"op": "DELETE", "name": "pics", "indexed": True}
+    )
+    assert listener.bot.subreddits == []
+    assert listener.bot.loaded == []
+
+
+def test_config_changes_are_applied():
+    listener = make_listener()
+    listener.apply(
+        CONFIG_CHANNEL, {"subname": "pics", "config": {"sentry_threshold": 90}}
+    )
+    assert listener.bot.subreddit_configs["pics"] == {"sentry_threshold": 90}
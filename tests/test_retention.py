@@ -0,0 +1,123 @@
+"""
+TheReposterminator Reddit bot to detect reposts
+Copyright (C) 2023 sardonicism-04
+
+TheReposterminator is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TheReposterminator is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with TheReposterminator.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import gzip
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from TheReposterminator.notifications import EXPIRE_CHANNEL, INVALIDATE_CHANNEL
+from TheReposterminator.retention import RetentionPolicy
+
+from .fakes import FakePool
+
+
+class Index:
+    """Records the changes retention makes to the bot's indexes"""
+
+    def __init__(self):
+        self.expired: list[tuple[str, int]] = []
+        self.invalidated: list[str] = []
+
+    def expire(self, subname: str, horizon: int):
+        self.expired.append((subname, horizon))
+
+    def invalidate(self, subname: str):
+        self.invalidated.append(subname)
+
+
+def make_policy(respond, **config) -> RetentionPolicy:
+    return RetentionPolicy(
+        SimpleNamespace(
+            config={"retention": config},
+            pool=FakePool(respond),
+            index=Index(),
+        )
+    )
+
+
+def notifications(policy: RetentionPolicy) -> list[tuple]:
+    return [
+        params
+        for query, params in policy.bot.pool.conn.executed
+        if query.startswith("SELECT pg_notify")
+    ]
+
+
+def test_horizon():
+    assert make_policy(None).horizon == 0
+    horizon = make_policy(None, max_age_days=2).horizon
+    assert horizon == pytest.approx(time.time() - 2 * 86_400, abs=2)
+
+
+def test_prune_old_expires_indexes_without_invalidating(tmp_path):
+    def respond(query, params):
+        if query.startswith("WITH deleted"):
+            return [("pics", 3), ("memes", 1)]
+        if query.startswith("COPY"):
+            return [("123", "abc", "pics", 5)]
+
+    policy = make_policy(respond, archive_directory=str(tmp_path))
+    policy.prune_old(30)
+
+    horizon = policy.bot.index.expired[0][1]
+    assert policy.bot.index.expired == [("pics", horizon), ("memes", horizon)]
+    assert policy.bot.index.invalidated == []
+    assert [channel for channel, _ in notifications(policy)] == [
+        EXPIRE_CHANNEL,
+        EXPIRE_CHANNEL,
+    ]
+
+    queries = [query for query, _ in policy.bot.pool.conn.executed]
+    assert queries[0] == "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ"
+    (archive,) = tmp_path.glob("expired-*.csv.gz")
+    assert gzip.decompress(archive.read_bytes()) == b"123,abc,pics,5\n"
+
+
+def test_prune_departed_invalidates_indexes():
+    def respond(query, params):
+        if query.startswith("SELECT name FROM departed_subreddits"):
+            return [("pics",)]
+
+    policy = make_policy(respond)
+    policy.prune_departed(7)
+
+    assert policy.bot.index.invalidated == ["pics"]
+    assert notifications(policy) == [(INVALIDATE_CHANNEL, '"pics"')]
+    deletes = [
+        params
+        for query, params in policy.bot.pool.conn.executed
+        if query.startswith("DELETE")
+    ]
+    assert deletes == [("pics",), ("pics",)]
+
+
+def test_failed_prune_discards_its_archive(tmp_path):
+    def respond(query, params):
+        if query.startswith("WITH deleted"):
+            raise RuntimeError("deadlock detected")
+
+    policy = make_policy(respond, archive_directory=str(tmp_path))
+    with pytest.raises(RuntimeError):
+        policy.prune_old(30)
+
+    assert [*tmp_path.iterdir()] == []
+    assert policy.bot.pool.conn.rollbacks == 1
+    assert policy.bot.index.expired == []
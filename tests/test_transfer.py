@@ -0,0 +1,115 @@
+"""
+TheReposterminator Reddit bot to detect reposts
+Copyright (C) 2023 sardonicism-04
+
+TheReposterminator is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TheReposterminator is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with TheReposterminator.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import gzip
+import io
+from array import array
+
+import pytest
+
+from TheReposterminator.transfer import (
+    BLOCK_HEADER,
+    EXPORT_HEADER,
+    EXPORT_MAGIC,
+    EXPORT_TRAILER,
+    EXPORT_VERSION,
+    SECTION_HEADER,
+    Block,
+    ExportError,
+    encode_block,
+    read_block,
+    read_export,
+    read_hashes,
+)
+
+BLOCK = Block(
+    array("Q", [0, 1, 2**64 - 1, 0x0123456789ABCDEF]),
+    array("q", [0, 1_600_000_000, -1, 2**63 - 1]),
+    ["a", "abc123", "zzzzzzzzzz", "x"],
+)
+
+
+def encode_export(sections: list[tuple[str, list[Block]]]) -> bytes:
+    """Encodes an export the way `transfer.export` lays it out"""
+    raw = EXPORT_HEADER.pack(EXPORT_MAGIC, EXPORT_VERSION, 0.0)
+    total = 0
+    for subname, blocks in sections:
+        raw += SECTION_HEADER.pack(subname.encode())
+        for block in blocks:
+            raw += encode_block(block)
+            total += len(block.ids)
+        raw += BLOCK_HEADER.pack(0)
+    raw += SECTION_HEADER.pack(b"") + EXPORT_TRAILER.pack(total)
+    return gzip.compress(raw)
+
+
+def test_block_round_trip():
+    stream = io.BytesIO(encode_block(BLOCK) + BLOCK_HEADER.pack(0))
+    assert read_block(stream) == BLOCK
+    assert read_block(stream) is None
+
+
+def test_block_detects_corruption():
+    data = bytearray(encode_block(BLOCK))
+    data[10] ^= 0xFF
+    with pytest.raises(ExportError, match="checksum"):
+        read_block(io.BytesIO(bytes(data)))
+
+
+def test_block_detects_truncation():
+    data = encode_block(BLOCK)
+    for size in (0, 2, len(data) - 1):
+        with pytest.raises(ExportError, match="truncated"):
+            read_block(io.BytesIO(data[:size]))
+
+
+def test_export_round_trip():
+    other = Block(array("Q", [5]), array("q", [0]), ["b"])
+    data = encode_export([("pics", [BLOCK, other]), ("memes", [other])])
+
+    assert list(read_export(io.BytesIO(data))) == [
+        ("pics", BLOCK),
+        ("pics", other),
+        ("memes", other),
+    ]
+    assert list(read_hashes(io.BytesIO(data), subname="MEMES")) == [5]
+
+
+def test_export_detects_bad_header():
+    raw = gzip.decompress(encode_export([("pics", [BLOCK])]))
+    with pytest.raises(ExportError, match="Not an export"):
+        list(read_export(io.BytesIO(gzip.compress(b"X" + raw[1:]))))
+
+    newer = EXPORT_HEADER.pack(EXPORT_MAGIC, EXPORT_VERSION + 1, 0.0)
+    with pytest.raises(ExportError, match="version"):
+        list(
+            read_export(
+                io.BytesIO(gzip.compress(newer + raw[EXPORT_HEADER.size:]))
+            )
+        )
+
+
+def test_export_detects_truncation_and_miscount():
+    raw = gzip.decompress(encode_export([("pics", [BLOCK])]))
+    with pytest.raises(ExportError, match="truncated"):
+        list(read_export(io.BytesIO(gzip.compress(raw[:-1]))))
+
+    miscounted = raw[: -EXPORT_TRAILER.size] + EXPORT_TRAILER.pack(5)
+    with pytest.raises(ExportError, match="expected 5"):
+        list(read_export(io.BytesIO(gzip.compress(miscounted))))
@@ -0,0 +1,132 @@
+"""
+TheReposterminator Reddit bot to detect reposts
+Copyright (C) 2023 sardonicism-04
+
+TheReposterminator is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+TheReposterminator is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with TheReposterminator.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from __future__ import annotations
+
+import random
+from array import array
+from collections import Counter
+from datetime import datetime, timezone
+
+import pytest
+
+from TheReposterminator.common import max_distance
+from TheReposterminator.whatif import Analysis, estimate, neighbour_distances
+
+
+def make_rows(count: int, seed: int) -> tuple[array, array]:
+    """Generates rows, with clusters of near-duplicates of a few hashes"""
+    rng = random.Random(seed)
+    originals = [rng.getrandbits(64) for _ in range(6)]
+    hashes, created = array("Q"), array("q")
+    for _ in range(count):
+        image_hash = rng.getrandbits(64)
+        if rng.random() < 0.6:
+            image_hash = rng.choice(originals)
+            for bit in rng.sample(range(64), rng.randrange(16)):
+                image_hash ^= 1 << bit
+        hashes.append(image_hash)
+        created.append(rng.choice([0, rng.randrange(1_000, 5_000)]))
+    return hashes, created
+
+
+def earlier_distances(
+    hashes: array, created: array, *, max_distance: int, max_age: int = 0
+) -> list[set[int]]:
+    """The distances of each row's earlier near-duplicates, by brute force"""
+    distances = []
+    for position, image_hash in enumerate(hashes):
+        found = set()
+        for earlier in range(position):
+            if (
+                max_age
+                and created[position] > 0
+                and created[earlier] > 0
+                and created[position] - created[earlier] > max_age
+            ):
+                continue
+            distance = (hashes[earlier] ^ image_hash).bit_count()
+            if distance <= max_distance:
+                found.add(distance)
+        distances.append(found)
+    return distances
+
+
+@pytest.mark.parametrize(
+    ("max_distance", "max_age"), [(0, 0), (5, 0), (12, 0), (12, 1_500)]
+)
+def test_neighbour_distances_matches_brute_force(max_distance, max_age):
+    hashes, created = make_rows(400, seed=max_distance + max_age)
+    expected = Counter(
+        sum(1 << distance for distance in found)
+        for found in earlier_distances(
+            hashes, created, max_distance=max_distance, max_age=max_age
+        )
+    )
+    assert (
+        neighbour_distances(
+            hashes, created, max_distance=max_distance, max_age=max_age
+        )
+        == expected
+    )
+
+
+@pytest.mark.parametrize(
+    ("sentry_threshold", "autoremove_threshold"),
+    [(90, None), (85, 95), (81, 81), (100, 100), (81, 90)],
+)
+def test_estimate_matches_brute_force(sentry_threshold, autoremove_threshold):
+    hashes, created = make_rows(400, seed=7)
+    analyzed = max_distance(81)
+    analysis = Analysis(
+        "test",
+        len(hashes),
+        4.0,
+        analyzed,
+        0,
+        dict(neighbour_distances(hashes, created, max_distance=analyzed)),
+        datetime.now(timezone.utc),
+    )
+
+    reports = autoremovals = 0
+    for found in earlier_distances(hashes, created, max_distance=analyzed):
+        matched = {d for d in found if d <= max_distance(sentry_threshold)}
+        if not matched:
+            continue
+        reports += 1
+        if autoremove_threshold is not None and all(
+            d <= max_distance(autoremove_threshold) for d in matched
+        ):
+            autoremovals += 1
+
+    result = estimate(
+        analysis,
+        sentry_threshold=sentry_threshold,
+        autoremove_threshold=autoremove_threshold,
+    )
+    assert result.reports_per_day == pytest.approx(reports / 4)
+    assert result.autoremovals_per_day == pytest.approx(autoremovals / 4)
+
+
+def test_estimate_rejects_thresholds_outside_analysis():
+    analysis = Analysis(
+        "test", 0, 1.0, max_distance(85), 0, {}, datetime.now(timezone.utc)
+    )
+    with pytest.raises(ValueError, match="weren't analyzed"):
+        estimate(analysis, sentry_threshold=80)
+    with pytest.raises(ValueError, match="isn't a percentage"):
+        estimate(analysis, sentry_threshold=90, autoremove_threshold=101)